@@ -0,0 +1,99 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from DDFacet.compatibility import range
+
+import numpy as np
+
+# Flags are held as a bit-packed (row, channel) mask, plus a per-row summary.
+#
+# Since flags are always equalised across correlations (see ClassMS.UpdateFlags), the correlation axis
+# carries no information and is reduced away. Bits are packed along the channel axis in numpy's default
+# (big-endian) bit order, i.e. channel c of row r lives in bit 7-(c%8) of byte packed[r, c//8].
+# The per-row summary is one of the ROW_xxx constants below, and lets consumers (such as the gridder)
+# skip unflagged or fully flagged rows without looking at the mask.
+
+ROW_UNFLAGGED = 0
+ROW_PARTIAL = 1
+ROW_FLAGGED = 2
+
+def packedShape(nrow, nchan):
+    """Returns shape of packed flag array for nrow rows and nchan channels"""
+    return nrow, (nchan + 7) // 8
+
+def packInto(flags, packed, rowflags, row0=0, rows=None):
+    """
+    Packs a bool flag array into preallocated packed/rowflags arrays, starting at row row0.
+    Args:
+        flags: bool array of shape (nrow, nchan) or (nrow, nchan, ncorr). If a correlation axis is
+               present, a visibility is considered flagged if any of its correlations is flagged.
+        packed: uint8 array of shape packedShape(), receives the packed mask
+        rowflags: uint8 array, receives per-row summary
+        row0: row offset at which to place the result
+        rows: if given, index (or slice) of the rows at which to place the result, instead of row0
+    """
+    if flags.ndim == 3:
+        flags = flags.any(axis=2)
+    if rows is None:
+        rows = slice(row0, row0 + flags.shape[0])
+    packed[rows] = np.packbits(flags, axis=1)
+    nflag = flags.sum(axis=1)
+    summary = np.full(flags.shape[0], ROW_UNFLAGGED, np.uint8)
+    summary[nflag > 0] = ROW_PARTIAL
+    summary[nflag == flags.shape[1]] = ROW_FLAGGED
+    rowflags[rows] = summary
+
+def pack(flags):
+    """
+    Packs a bool flag array of shape (nrow, nchan[, ncorr]).
+    Returns tuple of packed, rowflags arrays.
+    """
+    nrow, nchan = flags.shape[:2]
+    packed = np.empty(packedShape(nrow, nchan), np.uint8)
+    rowflags = np.empty(nrow, np.uint8)
+    packInto(flags, packed, rowflags)
+    return packed, rowflags
+
+def unpack(packed, nchan, ncorr=None, rows=None):
+    """
+    Unpacks a packed flag array into bool array of shape (nrow, nchan), or (nrow, nchan, ncorr) if ncorr is
+    given. If rows is specified, only unpacks the given subset (index or slice) of rows.
+    """
+    if rows is not None:
+        packed = packed[rows]
+    flags = np.unpackbits(packed, axis=1)[:, :nchan].view(np.bool_)
+    if ncorr is not None:
+        flags = np.repeat(flags[:, :, np.newaxis], ncorr, axis=2)
+    return flags
+
+def flaggedRows(rowflags):
+    """Returns index of rows with at least one flagged visibility"""
+    return np.where(rowflags != ROW_UNFLAGGED)[0]
+
+def rowSummary(packed, nchan):
+    """Computes the per-row summary of a packed flag array"""
+    nflag = unpack(packed, nchan).sum(axis=1)
+    rowflags = np.full(packed.shape[0], ROW_PARTIAL, np.uint8)
+    rowflags[nflag == 0] = ROW_UNFLAGGED
+    rowflags[nflag == nchan] = ROW_FLAGGED
+    return rowflags
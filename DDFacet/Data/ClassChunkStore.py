@@ -0,0 +1,205 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from DDFacet.compatibility import range
+
+import os
+import time
+import struct
+import collections
+import numpy as np
+import six
+if six.PY3:
+    import pickle as cPickle
+else:
+    import cPickle
+from DDFacet.Other import logger
+log = logger.getLogger("ClassChunkStore")
+
+
+class ClassChunkStore(object):
+    """
+    Columnar, memory-mappable store of the visibility chunks of one MS.
+
+    The store is a single file (one per MS, kept in the MS's maincache). Its layout is fully determined by the
+    chunk boundaries and the data shape, so every (chunk, column) pair has a fixed, page-aligned region in the file,
+    and chunks may be written concurrently by different I/O processes. Each column is stored as one contiguous
+    row block per chunk, and can be read straight into a (shared) array with a single read, or mapped with np.memmap.
+
+    Validity of stored items is tracked with the usual CacheManager pattern. Each item (a set of columns written
+    together) has a small descriptor file in the per-chunk cache:
+
+        path, valid = store.checkCache(chunk_cache, "VisStore.meta", hashkeys)
+        if valid:
+            A0 = store.load(path, "A0")           # memmap
+            store.load(path, "data", out=buf)     # single read into buf
+        else:
+            ... compute ...
+            store.save(path, row0, row1, dict(A0=A0, ...))
+            chunk_cache.saveCache("VisStore.meta")
+
+    Descriptors also record the generation of the store file, so that they are invalidated if the store is
+    re-created (e.g. after a cache reset).
+    """
+
+    # store file header: magic + generation timestamp. Data regions start at one page
+    _MAGIC = b"DDFCHUNKSTORE001"
+    _HEADER_SIZE = 4096
+    _ALIGN = 4096
+
+    def __init__(self, cache, name, chunk_r0r1, nchan, ncorr):
+        """
+        Opens (or creates) a chunk store.
+
+        Args:
+            cache: the CacheManager (normally the MS maincache) in which the store file is kept
+            name: name of store element in cache
+            chunk_r0r1: list of [row0,row1] chunk boundaries
+            nchan: number of channels in the data column
+            ncorr: number of correlations in the data column
+        """
+        self.columns = ClassChunkStore.columnDefs(nchan, ncorr)
+        self._layout = {}
+        offset = self._HEADER_SIZE
+        for row0, row1 in chunk_r0r1:
+            nrow = row1 - row0
+            for column, (dtype, rowshape) in self.columns.items():
+                nbytes = nrow * np.dtype(dtype).itemsize * int(np.prod(rowshape))
+                self._layout[row0, row1, column] = offset
+                offset += self._align(nbytes)
+        self.size = offset
+        layout_key = dict(chunks=[tuple(r) for r in chunk_r0r1], nchan=nchan, ncorr=ncorr,
+                          columns=[(column, np.dtype(dtype).str, rowshape) for column, (dtype, rowshape) in
+                                   self.columns.items()])
+        self.path, valid = cache.checkCache(name, layout_key)
+        if valid:
+            try:
+                self.generation = self._readHeader()
+            except Exception as exc:
+                print("chunk store %s has invalid header (%s), will re-make" % (self.path, exc), file=log)
+                valid = False
+        if not valid:
+            self.generation = time.time()
+            with open(self.path, "wb") as f:
+                f.write(self._MAGIC + struct.pack("<d", self.generation))
+                # file is sparse: regions only consume disk space once written to
+                f.truncate(self.size)
+            cache.saveCache(name)
+            print("created chunk store %s (%.2f GB max)" % (self.path, self.size / 2.**30), file=log)
+
+    @staticmethod
+    def columnDefs(nchan, ncorr):
+        """Returns ordered dict of column: (dtype, per-row shape)"""
+        return collections.OrderedDict([
+            ("data",       (np.complex64, (nchan, ncorr))),
+            ("flags",      (np.uint8, ((nchan + 7) // 8,))),
+            ("rowflags",   (np.uint8, ())),
+            ("uvw",        (np.float64, (3,))),
+            ("A0",         (np.int32, ())),
+            ("A1",         (np.int32, ())),
+            ("times",      (np.float64, ())),
+            ("uniq_times", (np.float64, ())),
+            ("sort_index", (np.int64, ())),
+            ("uvw_dt",     (np.float64, (3,)))
+        ])
+
+    def _align(self, nbytes):
+        return ((nbytes + self._ALIGN - 1) // self._ALIGN) * self._ALIGN
+
+    def _readHeader(self):
+        with open(self.path, "rb") as f:
+            header = f.read(len(self._MAGIC) + 8)
+        if header[:len(self._MAGIC)] != self._MAGIC:
+            raise IOError("bad magic")
+        if os.path.getsize(self.path) != self.size:
+            raise IOError("size mismatch")
+        return struct.unpack("<d", header[len(self._MAGIC):])[0]
+
+    def checkCache(self, cache, name, hashkeys, ignore_key=False):
+        """
+        Checks if item 'name' in the given chunk cache is valid. Arguments as for CacheManager.checkCache().
+        Returns tuple of (descriptor path, valid)
+        """
+        path, valid = cache.checkCache(name, hashkeys, ignore_key=ignore_key)
+        if valid:
+            try:
+                with open(path, "rb") as f:
+                    desc = cPickle.load(f)
+                valid = desc["generation"] == self.generation and desc["store"] == self.path
+            except Exception:
+                valid = False
+            if not valid:
+                print("chunk store descriptor %s is stale, will re-make" % path, file=log)
+                # re-check with reset, so that the hash is marked for saving
+                path, _ = cache.checkCache(name, hashkeys, reset=True)
+        return path, valid
+
+    def load(self, path, column, out=None):
+        """
+        Loads column from item described by descriptor at 'path'.
+        If out is given, the column is read into it with a single read() call, and out is returned.
+        Otherwise a read-only memmap of the column is returned, or None if the column was stored as None.
+        """
+        with open(path, "rb") as f:
+            desc = cPickle.load(f)
+        shape, dtype, offset = desc["columns"][column]
+        if shape is None:
+            return None
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if out is None:
+            if not nbytes:
+                return np.zeros(shape, dtype)
+            return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        if out.shape != tuple(shape) or out.dtype != np.dtype(dtype) or not out.flags.c_contiguous:
+            raise TypeError("chunk store column %s: can't read %s %s into %s %s array" %
+                            (column, dtype, shape, out.dtype, out.shape))
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            nread = f.readinto(memoryview(out.reshape(-1).view(np.uint8)))
+        if nread != nbytes:
+            raise IOError("chunk store %s: short read of column %s (%d of %d bytes)" %
+                          (self.path, column, nread, nbytes))
+        return out
+
+    def save(self, path, row0, row1, columns):
+        """
+        Writes columns (dict of column: array or None) of chunk row0:row1 into the store, and writes the
+        item descriptor to path. The caller should then call saveCache() on the chunk cache.
+        """
+        desc = dict(store=self.path, generation=self.generation, row0=row0, row1=row1, columns={})
+        with open(self.path, "r+b") as f:
+            for column, array in columns.items():
+                dtype, rowshape = self.columns[column]
+                offset = self._layout[row0, row1, column]
+                if array is None:
+                    desc["columns"][column] = None, dtype, offset
+                    continue
+                if array.shape[1:] != rowshape or array.shape[0] > row1 - row0:
+                    raise TypeError("chunk store column %s: unexpected shape %s" % (column, array.shape))
+                array = np.ascontiguousarray(array, dtype=dtype)
+                f.seek(offset)
+                f.write(memoryview(array.reshape(-1).view(np.uint8)))
+                desc["columns"][column] = array.shape, dtype, offset
+        with open(path, "wb") as f:
+            cPickle.dump(desc, f)
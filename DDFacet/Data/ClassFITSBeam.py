@@ -77,6 +77,12 @@ class ClassFITSBeam (object):
         # a large enough array, the PA w.r.t. each antenna may change! But for now, use
         # the PA of the first antenna for all calculations
         self.pos0 = dm.position('itrf',*[ dq.quantity(x,'m') for x in self.ms.StationPos[0] ]) 
+        # latitude of antenna 0, matching the zenith measure: geocentric for AZEL, geodetic for AZELGEO
+        if self._frame == "altaz":
+            x, y, z = self.ms.StationPos[0]
+            self._lat = np.arctan2(z, np.sqrt(x*x + y*y))
+        else:
+            self._lat = dm.get_value(dm.measure(self.pos0, "WGS84"))[1].get_value("rad")
 
         # make direction measure from field centre
         ra,dec = self.ms.OriginalRadec
@@ -147,6 +153,8 @@ class ClassFITSBeam (object):
                       RealImag=REALIMAG[reim].title());
 
         self.vbs = {}
+        # beam pattern files in use (so that cached beam Jones matrices can be keyed on them)
+        self.beamfiles = []
 
         # now, self.beamsets specifies a list of filename patterns. We need to find the one with the closest
         # frequency coverage
@@ -187,10 +195,54 @@ class ClassFITSBeam (object):
                     print("  MS coverage is %.1f to %.1f GHz, beams are %.1f to %.1f MHz"%(
                         self.freqs[0]*1e-6, self.freqs[-1]*1e-6, vb._freqgrid[0]*1e-6, vb._freqgrid[-1]*1e-6), file=log)
                 self.vbs[corr] = vb
+                self.beamfiles += [os.path.abspath(filename) for filename in filenames]
 
 
     _vb_cache = {}
 
+    # sidereal rate, in radians per second of UT
+    _SIDEREAL_RATE = 2*np.pi*1.00273781191135448/86400
+
+    def _hourAngles (self, ra, dec, t0):
+        """
+        Returns apparent hour angles and declinations of the given J2000 directions at time t0, as seen from
+        antenna 0. This is the only part of the astrometry that needs measures: other times follow from the
+        sidereal rate (see parallacticAngles() and _azel()).
+        """
+        dm.do_frame(self.pos0)
+        dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s")))
+        ha = numpy.zeros(len(ra), float)
+        decapp = numpy.zeros(len(ra), float)
+        for i, (r1, d1) in enumerate(zip(ra, dec)):
+            hadec = dm.get_value(dm.measure(dm.direction('J2000', dq.quantity(r1, "rad"), dq.quantity(d1, "rad")), "HADEC"))
+            ha[i], decapp[i] = hadec[0].get_value("rad"), hadec[1].get_value("rad")
+        return ha, decapp
+
+    def parallacticAngles (self, times):
+        """
+        Returns parallactic angles (in radians) of the field centre at the given times. The apparent hour angle
+        and declination are computed once with measures, and advanced at the sidereal rate, which is accurate to
+        well below the PA sampling increments.
+        """
+        times = np.asarray(times, np.float64)
+        t0 = times[len(times)//2]
+        ra, dec = self.ms.OriginalRadec
+        (ha0,), (dec,) = self._hourAngles([ra], [dec], t0)
+        ha = ha0 + self._SIDEREAL_RATE*(times - t0)
+        lat = self._lat
+        return np.arctan2(np.sin(ha)*np.cos(lat), np.sin(lat)*np.cos(dec) - np.cos(lat)*np.sin(dec)*np.cos(ha))
+
+    def _azel (self, times, ra, dec):
+        """Returns ntime x ndir arrays of azimuth and elevation (radians) of the given directions"""
+        times = np.asarray(times, np.float64)
+        t0 = times[len(times)//2]
+        ha0, dec = self._hourAngles(ra, dec, t0)
+        ha = ha0[np.newaxis, :] + self._SIDEREAL_RATE*(times - t0)[:, np.newaxis]
+        lat = self._lat
+        el = np.arcsin(np.sin(lat)*np.sin(dec) + np.cos(lat)*np.cos(dec)*np.cos(ha))
+        az = np.arctan2(-np.cos(dec)*np.sin(ha), np.sin(dec)*np.cos(lat) - np.cos(dec)*np.cos(ha)*np.sin(lat))
+        return az, el
+
     def getBeamSampleTimes (self, times, quiet=False):
         """For a given list of timeslots, returns times at which the beam must be sampled"""
         if not quiet:
@@ -203,13 +255,7 @@ class ClassFITSBeam (object):
         if not quiet:
             print("  DtBeamMin=%.2f min results in %d samples"%(self.time_inc, len(beam_times)), file=log)
         if self.pa_inc:
-            pas = [ 
-                # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
-                dm.do_frame(self.pos0) and 
-                # put time into reference frame
-                dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s"))) and
-                # compute PA 
-                dm.posangle(self.field_centre,self.zenith).get_value("deg") for t0 in beam_times ]
+            pas = np.rad2deg(self.parallacticAngles(beam_times))
             pa0 = pas[0]
             beam_times1 = [ beam_times[0] ]
             for t, pa in zip(beam_times[1:], pas[1:]):
@@ -235,44 +281,40 @@ class ClassFITSBeam (object):
         Inputs: t0 is a single time. ra, dec are Ndir vectors of directions.
         Output: a complex array of shape [Ndir,Nant,Nfreq,2,2] giving the Jones matrix per antenna, direction and frequency
         """
+        return self.evaluateBeams([t0], ra, dec)[0]
+
+    def evaluateBeams (self, times, ra, dec):
+        """Evaluates beam at all the given times, in directions ra, dec.
+        Inputs: times is an Ntime vector. ra, dec are Ndir vectors of directions.
+        Output: a complex array of shape [Ntime,Ndir,Nant,Nfreq,2,2] giving the Jones matrix per time, antenna,
+        direction and frequency
+        """
+        times = np.atleast_1d(np.asarray(times, np.float64))
+        ra = np.atleast_1d(np.asarray(ra, np.float64))
+        dec = np.atleast_1d(np.asarray(dec, np.float64))
+        ntime, ndir, nfreq = len(times), len(ra), len(self.freqs)
 
-        # setup reference frame and compute PA
+        # compute PA per time
         if self._frame != "equatorial":
-            # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
-            dm.do_frame(self.pos0)
-            # put time into reference frame
-            dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s")))
-            # compute PA
-            parad = dm.posangle(self.field_centre,self.zenith).get_value("rad")
+            parad = self.parallacticAngles(times)
         else:
-            parad = 0
-        # print("time %f, position angle %f"%(t0, parad*180/math.pi), file=log)
-
-        # compute l,m per direction
-        ndir = len(ra)
-        l = numpy.zeros(ndir,float)
-        m = numpy.zeros(ndir,float)
+            parad = np.zeros(ntime)
 
+        # compute l,m per time and direction
         if self._frame == "altaz" or self._frame == "equatorial" or self._frame == "altazgeo":
-            # convert each ra/dec to l/m
-            for i,(r1,d1) in enumerate(zip(ra,dec)):
-                l[i], m[i] = self.ms.radec2lm_scalar(r1,d1,original=True)
+            # convert ra/dec to l/m
+            l, m = self.ms.radec2lm_scalar(ra, dec, original=True)
+            l = np.broadcast_to(l, (ntime, ndir))
+            m = np.broadcast_to(m, (ntime, ndir))
             # for alt-az mounts, rotate by PA
             if self._frame == "altaz" or self._frame == "altazgeo":
                 # rotate each by parallactic angle
                 r = numpy.sqrt(l*l+m*m)
-                angle = numpy.arctan2(m, l)
-                l = r*numpy.cos(angle + parad + np.deg2rad(self.feedangle))
-                m = r*numpy.sin(angle + parad + np.deg2rad(self.feedangle))
+                angle = numpy.arctan2(m, l) + (parad + np.deg2rad(self.feedangle))[:, np.newaxis]
+                l = r*numpy.cos(angle)
+                m = r*numpy.sin(angle)
         elif self._frame == "zenith":
-            az = numpy.zeros(ndir, float)
-            el = numpy.zeros(ndir, float)
-            for i, (r1,d1) in enumerate(zip(ra,dec)):
-                dir_j2000 = dm.direction('J2000', dq.quantity(r1, "rad"), dq.quantity(d1, "rad"))
-                dir_azel = dm.measure(dir_j2000, "AZELGEO")
-                dir_azel_val = dm.get_value(dir_azel)
-                az[i], el[i] = dir_azel_val[0].get_value(), dir_azel_val[1].get_value()
-
+            az, el = self._azel(times, ra, dec)
             r = numpy.cos(el)
             l = r*numpy.sin(az)   # az=0 is North, l=0, M>0
             m = r*numpy.cos(az)   # az=90 is East, m=0, l>0
@@ -281,67 +323,59 @@ class ClassFITSBeam (object):
 
         log(2).print("Beam evaluated for l,m {}, {}".format(l, m))
 
-        # get interpolated values. Output shape will be [ndir,nfreq]
+        # get interpolated values for all times and directions at once. Output shape will be [ntime*ndir,nfreq]
         if self.use_unity_ejones:
-            beamjones = [ np.ones([ndir, len(self.freqs)], dtype=numpy.complex64),
-                          np.zeros([ndir, len(self.freqs)], dtype=numpy.complex64),
-                          np.zeros([ndir, len(self.freqs)], dtype=numpy.complex64),
-                          np.ones([ndir, len(self.freqs)], dtype=numpy.complex64) ]
+            beamjones = [ np.ones([ntime*ndir, nfreq], dtype=numpy.complex64),
+                          np.zeros([ntime*ndir, nfreq], dtype=numpy.complex64),
+                          np.zeros([ntime*ndir, nfreq], dtype=numpy.complex64),
+                          np.ones([ntime*ndir, nfreq], dtype=numpy.complex64) ]
         else:
+            l, m = np.ascontiguousarray(l).ravel(), np.ascontiguousarray(m).ravel()
             beamjones = [ self.vbs[corr].interpolate(l,m,freq=self.freqs,freqaxis=1) for corr in self.corrs ]
 
-        # now make output matrix
-
-        jones = numpy.zeros((ndir,self.ms.na,len(self.freqs),2,2),dtype=numpy.complex64)
-        # populate it with values
-        # NB: here we copy the same Jones to every antenna. In principle we could compute
-        # a parangle per antenna. When we have pointing error, it's also going to be per
-        # antenna
-        for iant in range(self.ms.na):
-            for ijones,(ix,iy) in enumerate(((0,0),(0,1),(1,0),(1,1))):
-                bj = beamjones[ijones]
-                jones[:,iant,:,ix,iy] = beamjones[ijones].reshape((len(bj),1)) if bj.ndim == 1 else bj
+        # now make per-direction Jones matrices
+        E = numpy.zeros((ntime*ndir,nfreq,2,2),dtype=numpy.complex64)
+        for ijones,(ix,iy) in enumerate(((0,0),(0,1),(1,0),(1,1))):
+            bj = beamjones[ijones]
+            E[:,:,ix,iy] = bj.reshape((len(bj),1)) if bj.ndim == 1 else bj
+        E = E.reshape((ntime,ndir,nfreq,2,2))
 
         feedswap_jones = np.array([[1., 0.], [0., 1.]], dtype=numpy.complex64)
         if self.applyantidiagonal:
             feedswap_jones = np.array([[0., 1.], [1., 0.]], dtype=numpy.complex64)
 
-        Pjones = np.array([[1., 0.], [0., 1.]], dtype=numpy.complex64)
+        Pjones = np.zeros((ntime, 2, 2), dtype=numpy.complex64)
+        Pjones[:, 0, 0] = Pjones[:, 1, 1] = 1
         if self.applyrotation:
             print("Applying derotation to data, since beam is sampled in time. "
                   "If you have equatorial mounts this is not what you should be doing!", file=log)
+            rot = parad + np.deg2rad(self.feedangle)
             if self.feedbasis == "linear":
                 """ 2D rotation matrix according to Hales, 2017: 
                 Calibration Errors in Interferometric Radio Polarimetry """
-                c1, s1 = np.cos(parad + np.deg2rad(self.feedangle)), np.sin(parad + np.deg2rad(self.feedangle))
+                c1, s1 = np.cos(rot), np.sin(rot)
                 # assume all stations has same parallactic angle
-                Pjones[0, 0] = c1
-                Pjones[0, 1] = s1
-                Pjones[1, 0] = -s1
-                Pjones[1, 1] = c1
+                Pjones[:, 0, 0] = c1
+                Pjones[:, 0, 1] = s1
+                Pjones[:, 1, 0] = -s1
+                Pjones[:, 1, 1] = c1
             elif self.feedbasis == "circular":
                 """ phase rotation matrix according to Hales, 2017: 
                 Calibration Errors in Interferometric Radio Polarimetry """
-                e1 = np.exp(1.0j * -(parad + np.deg2rad(self.feedangle)))
-                e2 = np.exp(1.0j * (parad + np.deg2rad(self.feedangle)))
                 # assume all stations has same parallactic angle
-                Pjones[0, 0] = e1
-                Pjones[0, 1] = 0
-                Pjones[1, 0] = 0
-                Pjones[1, 1] = e2
+                Pjones[:, 0, 0] = np.exp(1.0j * -rot)
+                Pjones[:, 1, 1] = np.exp(1.0j * rot)
             else:
                 raise RuntimeError("Feed basis not supported")
 
         # dot diagonal block matrix of P with E diagonal block vector 
         # again assuming constant P matrix across all stations
-        E_vec = jones.reshape(ndir * self.ms.na * len(self.freqs), 2, 2)
-        for i in range(E_vec.shape[0]):
-            E_vec[i,:,:] = np.dot(Pjones, np.dot(E_vec[i, :, :], feedswap_jones))
-
-        return E_vec.reshape(ndir, self.ms.na, len(self.freqs), 2, 2)
-
-
-
-
+        E = np.einsum("tij,tdfjk,kl->tdfil", Pjones, E, feedswap_jones).astype(numpy.complex64)
 
+        # NB: here we copy the same Jones to every antenna. In principle we could compute
+        # a parangle per antenna. When we have pointing error, it's also going to be per
+        # antenna
+        jones = numpy.empty((ntime,ndir,self.ms.na,nfreq,2,2),dtype=numpy.complex64)
+        jones[...] = E[:, :, np.newaxis]
+        return jones
 
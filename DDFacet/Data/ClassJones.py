@@ -29,7 +29,10 @@ from DDFacet.Other import logger
 log = logger.getLogger("ClassJones")
 from DDFacet.Other import reformat
 from DDFacet.Array import NpShared
+from DDFacet.Array import shared_dict
+from DDFacet.Other.AsyncProcessPool import APP
 import os
+import hashlib
 from DDFacet.Array import ModLinAlg
 from DDFacet.Other.progressbar import ProgressBar
 from DDFacet.Data import ClassLOFARBeam
@@ -136,13 +139,44 @@ def _parse_solsfile(SolsFile):
         raise ValueError("No valid soltabs specified")
     return h5file, apply_solsets, apply_map
 
+def resolveSolsFile(GD, MSName, SolsFile):
+    """Returns path of killMS .npz solution file of the given MS, given a solution name or file (see --DDESolutions-SolsDir)"""
+    if not(".npz" in SolsFile):
+        SolsDir=GD["DDESolutions"]["SolsDir"]
+        if SolsDir is None or SolsDir=="":
+            ThisMSName = reformat.reformat(os.path.abspath(MSName), LastSlash=False)
+            SolsFile = "%s/killMS.%s.sols.npz" % (ThisMSName, SolsFile)
+        else:
+            _MSName=reformat.reformat(os.path.abspath(MSName).split("/")[-1])
+            DirName=os.path.abspath("%s%s"%(reformat.reformat(SolsDir),_MSName))
+            if not os.path.isdir(DirName):
+                os.makedirs(DirName)
+            SolsFile="%s/killMS.%s.sols.npz"%(DirName,SolsFile)
+    return SolsFile
+
+def solsFileList(GD, MSName):
+    """Returns list of the solution files (see --DDESolutions-DDSols) that are applied to the given MS"""
+    SolsFile = GD["DDESolutions"]["DDSols"]
+    if not SolsFile:
+        return []
+    SolsFileList = SolsFile if isinstance(SolsFile, list) else [SolsFile]
+    files = []
+    for File in SolsFileList:
+        if ".h5" in File:
+            files += sorted(glob.glob(_parse_solsfile(File)[0]))
+        else:
+            files.append(resolveSolsFile(GD, MSName, File))
+    return files
+
 
 class ClassJones():
 
-    def __init__(self, GD, MS, FacetMachine=None, CacheMode=True):
+    def __init__(self, GD, MS, FacetMachine=None, CacheMode=True, BeamWorkers=None):
         self.GD = GD
         self.FacetMachine = FacetMachine
         self.MS = MS
+        # if set, beam evaluation is spread over the compute workers (see ClassBeamWorkers)
+        self.BeamWorkers = BeamWorkers
         self.HasKillMSSols = False
         self.BeamTimes_kMS = np.array([], np.float32)
         self.CacheMode=CacheMode
@@ -298,7 +332,10 @@ class ClassJones():
         print("Build solution Dico for %s" % StrType, file=log)
 
         if StrType == "killMS":
-            DicoClusterDirs_killMS, DicoSols = self.GiveKillMSSols()
+            if self.CacheMode and self.GD["Cache"]["DDESols"]:
+                DicoClusterDirs_killMS, DicoSols = self.GiveKillMSSolsSlice(DATA["times"])
+            else:
+                DicoClusterDirs_killMS, DicoSols = self.GiveKillMSSols()
             DicoClusterDirs = DicoClusterDirs_killMS
             print("  Build VisTime-to-Solution mapping", file=log)
             TimeMapping = self.GiveTimeMapping(DicoSols, DATA["times"])
@@ -480,6 +517,78 @@ class ClassJones():
 
         return DicoClusterDirs, DicoJones
 
+    def _solsFileList(self):
+        """Returns list of solution files that GiveKillMSSols() will read (for the cache keys of the solution store)"""
+        return solsFileList(self.GD, self.MS.MSName)
+
+    def GiveKillMSSolsSlice(self, times):
+        """
+        Like GiveKillMSSols(), but only returns the solution intervals overlapping the given (chunk) times.
+
+        Reading and normalising the solutions is done once per MS: the result is kept in a columnar store in the MS
+        maincache ("DDESols"), with the Jones matrices as an .npy file indexed by solution interval. Subsequent
+        chunks (and major cycles) memory-map the store, and only read in their own slice of it.
+        """
+        files = self._solsFileList()
+        mtimes = [ os.path.getmtime(f) if os.path.exists(f) else None for f in files ]
+        hashkeys = dict(DDESolutions=self.GD["DDESolutions"], Files=files, mtimes=mtimes,
+                        ChanSlice=str(self.MS.ChanSlice), Nchan=self.MS.NSPWChan, Average=self.MS.AverageSteps)
+        path, valid = self.MS.maincache.checkCache("DDESols", hashkeys, directory=True)
+        if valid:
+            try:
+                index = np.load(os.path.join(path, "index.npz"))
+                Jones = np.load(os.path.join(path, "Jones.npy"), mmap_mode="r")
+            except Exception as exc:
+                # only remake the store files: resetting the directory could wipe a store being written by another
+                # I/O process
+                print("  DDE solution store %s can't be read (%s), will re-make" % (path, exc), file=log)
+                for name in ("Jones.npy", "index.npz"):
+                    try:
+                        os.unlink(os.path.join(path, name))
+                    except OSError:
+                        pass
+                valid = False
+        if not valid:
+            DicoClusterDirs, DicoSols = self.GiveKillMSSols()
+            index = dict(t0=DicoSols["t0"], t1=DicoSols["t1"], tm=DicoSols["tm"],
+                         VisToJonesChanMapping=DicoSols["VisToJonesChanMapping"],
+                         BeamTimes=self.BeamTimes_kMS,
+                         **dict([("Dir_%s" % key, DicoClusterDirs[key]) for key in ("ra", "dec", "I", "Cluster")]))
+            if "FreqDomains" in DicoSols:
+                index["FreqDomains"] = DicoSols["FreqDomains"]
+            # write under temporary names and rename, so that concurrent readers never see partial files
+            tmpname = os.path.join(path, "tmp.%d" % os.getpid())
+            with open(tmpname, "wb") as f:
+                np.save(f, np.require(DicoSols["Jones"], np.complex64, "C"))
+            os.rename(tmpname, os.path.join(path, "Jones.npy"))
+            with open(tmpname, "wb") as f:
+                np.savez(f, **index)
+            os.rename(tmpname, os.path.join(path, "index.npz"))
+            self.MS.maincache.saveCache("DDESols")
+            print("  saved DDE solution store %s (%d intervals)" % (path, len(DicoSols["t0"])), file=log)
+            index = np.load(os.path.join(path, "index.npz"))
+            Jones = np.load(os.path.join(path, "Jones.npy"), mmap_mode="r")
+
+        # solution intervals overlapping the chunk (at least one, so that the time mapping is always valid)
+        t0, t1 = index["t0"], index["t1"]
+        nt = len(t0)
+        it0 = min(np.searchsorted(t1, times.min(), side="right"), nt - 1)
+        it1 = max(np.searchsorted(t0, times.max(), side="right"), it0 + 1)
+        print("  using DDE solution intervals %d:%d of %d from %s" % (it0, it1, nt, path), file=log)
+
+        self.BeamTimes_kMS = index["BeamTimes"]
+        DicoClusterDirs = dict([(key, index["Dir_%s" % key]) for key in ("ra", "dec", "I", "Cluster")])
+        DicoSols = dict(t0=t0[it0:it1], t1=t1[it0:it1], tm=index["tm"][it0:it1],
+                        VisToJonesChanMapping=index["VisToJonesChanMapping"],
+                        Jones=np.array(Jones[it0:it1]))
+        if "FreqDomains" in index:
+            DicoSols["FreqDomains"] = index["FreqDomains"]
+        return DicoClusterDirs, DicoSols
+
+    def _resolveSolsFile(self, SolsFile):
+        """Returns path of killMS .npz solution file, given a solution name or file (see --DDESolutions-SolsDir)"""
+        return resolveSolsFile(self.GD, self.MS.MSName, SolsFile)
+
     def ReadNPZ(self,SolsFile):
         print("  Loading solution file %s" % (SolsFile), file=log)
 
@@ -769,26 +878,7 @@ class ClassJones():
         GlobalMode=""):
 
         if not ".h5" in SolsFile:
-            # if not(".npz" in SolsFile):
-            #     Method = SolsFile
-            #     ThisMSName = reformat.reformat(
-            #         os.path.abspath(self.MS.MSName),
-            #         LastSlash=False)
-            #     SolsFile = "%s/killMS.%s.sols.npz" % (ThisMSName, Method)
-
-            if not(".npz" in SolsFile):
-                SolsDir=self.GD["DDESolutions"]["SolsDir"]
-                if SolsDir is None or SolsDir=="":
-                    Method = SolsFile
-                    ThisMSName = reformat.reformat(os.path.abspath(self.MS.MSName), LastSlash=False)
-                    SolsFile = "%s/killMS.%s.sols.npz" % (ThisMSName, SolsFile)
-                else:
-                    _MSName=reformat.reformat(os.path.abspath(self.MS.MSName).split("/")[-1])
-                    DirName=os.path.abspath("%s%s"%(reformat.reformat(SolsDir),_MSName))
-                    if not os.path.isdir(DirName):
-                        os.makedirs(DirName)
-                    SolsFile="%s/killMS.%s.sols.npz"%(DirName,SolsFile)
-
+            SolsFile = self._resolveSolsFile(SolsFile)
             VisToJonesChanMapping,DicoClusterDirs,DicoSols,G=self.ReadNPZ(SolsFile)
         else:
             VisToJonesChanMapping,DicoClusterDirs,DicoSols,G=self.ReadH5(SolsFile)
@@ -995,6 +1085,32 @@ class ClassJones():
 
         return np.argmin(DFreq, axis=1)
 
+    def _beamJonesCachePath(self, TimesBeam, RA, DEC):
+        """
+        Returns path of the beam Jones cache entry (see EstimateBeam()) for the given beam sample times and
+        directions. Entries live in the BeamJones directory of the MS maincache, and are named by a digest of
+        the sample times and directions, so they can be shared by all chunks, cycles and reruns. The directory
+        itself is a cache element keyed on the beam settings (including the paths and mtimes of any beam
+        pattern files), so entries made with other settings are dropped rather than accumulated.
+        """
+        files = getattr(self.BeamMachine, "beamfiles", [])
+        mtimes = [ os.path.getmtime(f) if os.path.exists(f) else None for f in files ]
+        hashkeys = dict(Beam=self.GD["Beam"], Files=files, mtimes=mtimes,
+                        Radec=[float(x) for x in self.MS.OriginalRadec],
+                        ChanFreq=np.asarray(self.MS.ChanFreq, np.float64).ravel().tolist())
+        try:
+            dirname, valid = self.MS.maincache.checkCache("BeamJones", hashkeys, directory=True)
+        except OSError:
+            # directory may have been (re)made concurrently by another I/O process
+            dirname, valid = self.MS.maincache.checkCache("BeamJones", hashkeys, directory=True)
+        if not valid:
+            # an empty directory is a valid cache, so mark it as such straight away
+            self.MS.maincache.saveCache("BeamJones")
+        digest = hashlib.md5()
+        for array in (TimesBeam, RA, DEC):
+            digest.update(np.ascontiguousarray(array, np.float64).tobytes())
+        return os.path.join(dirname, "%s.npy" % digest.hexdigest())
+
     def EstimateBeam(self, TimesBeam, RA, DEC,progressBar=True, quiet=False):
         TimesBeam = np.float64(np.array(TimesBeam))
         T0s = TimesBeam[:-1].copy()
@@ -1011,27 +1127,87 @@ class ClassJones():
         if not quiet:
             print("VisToJonesChanMapping: %s"%DicoBeam["VisToJonesChanMapping"], file=log)
 
-
-        DicoBeam["Jones"]=np.zeros((Tm.size,NDir,self.MS.na,FreqDomains.shape[0],2,2),dtype=np.complex64)
-        DicoBeam["t0"]=np.zeros((Tm.size,),np.float64)
-        DicoBeam["t1"]=np.zeros((Tm.size,),np.float64)
-        DicoBeam["tm"]=np.zeros((Tm.size,),np.float64)
+        # evaluated beams are cached per MS, keyed on the beam settings, sample times and directions
+        cachepath = self._beamJonesCachePath(TimesBeam, RA, DEC) if self.GD["Cache"]["BeamJones"] else None
+        if cachepath is not None and os.path.exists(cachepath):
+            try:
+                Jones = np.load(cachepath, mmap_mode="r")
+            except Exception as exc:
+                print("  beam Jones cache %s can't be read (%s), will re-make" % (cachepath, exc), file=log)
+            else:
+                if Jones.shape == (Tm.size, NDir, self.MS.na, FreqDomains.shape[0], 2, 2):
+                    if not quiet:
+                        print("  using cached beam Jones matrices from %s" % cachepath, file=log)
+                    DicoBeam["Jones"] = Jones
+                    DicoBeam["t0"] = T0s
+                    DicoBeam["t1"] = T1s
+                    DicoBeam["tm"] = Tm
+                    DicoBeam["FreqDomains"] = FreqDomains
+                    return DicoBeam
+
+
+        DicoBeam["t0"]=T0s
+        DicoBeam["t1"]=T1s
+        DicoBeam["tm"]=Tm
         DicoBeam["FreqDomains"]=FreqDomains
-        
-        
+
+        # with beam workers, time blocks are evaluated in parallel by the compute workers
+        if self.BeamWorkers is not None and Tm.size > 1:
+            DicoBeam["Jones"]=self.BeamWorkers.evaluate(self.MS, Tm, RA, DEC, FreqDomains.shape[0])
+        else:
+            DicoBeam["Jones"]=np.zeros((Tm.size,NDir,self.MS.na,FreqDomains.shape[0],2,2),dtype=np.complex64)
+            pBAR= ProgressBar(Title="  Init E-Jones ")#, HeaderSize=10,TitleSize=13)
+            if not progressBar: pBAR.disable()
+            pBAR.render(0, Tm.size)
+            # evaluate in blocks of times, to show progress
+            nblock = max(1, min(Tm.size, 10))
+            for it0 in range(0, Tm.size, nblock):
+                it1 = min(it0 + nblock, Tm.size)
+                self.EvaluateBeamBlock(Tm[it0:it1], RA, DEC, DicoBeam["Jones"][it0:it1])
+                pBAR.render(it1, Tm.size)
+
+        nt, nd, na, nch, _, _ = DicoBeam["Jones"].shape
+
+        # only reached if all time blocks were evaluated successfully (evaluate() raises otherwise)
+        if cachepath is not None:
+            # write under a temporary name and rename, so that concurrent readers never see a partial file
+            tmpname = "%s.tmp.%d" % (cachepath, os.getpid())
+            with open(tmpname, "wb") as f:
+                np.save(f, DicoBeam["Jones"])
+            os.rename(tmpname, cachepath)
+
+        # DicoBeam["Jones"]=np.mean(DicoBeam["Jones"],axis=3).reshape((nt,nd,na,1,2,2))
+
+        # print TimesBeam-TimesBeam[0]
+        # print t0-t1
+        # print DicoBeam["t1"][-1]-DicoBeam["t0"][0]
+
+        return DicoBeam
+
+    def EvaluateBeamBlock(self, Tm, RA, DEC, Jones):
+        """
+        Evaluates the beam Jones matrices at times Tm in directions RA, DEC (normalising to the phase centre if
+        --Beam-CenterNorm is set), and puts them into Jones (a ntime x ndir x nant x nfreq x 2 x 2 array)
+        """
         rac,decc=self.MS.OriginalRadec
-        pBAR= ProgressBar(Title="  Init E-Jones ")#, HeaderSize=10,TitleSize=13)
-        if not progressBar: pBAR.disable()
-        pBAR.render(0, Tm.size)
+        # beam models with a batched API are evaluated for all times and directions at once
+        evaluateBeams = getattr(self.BeamMachine, "evaluateBeams", None)
+        if evaluateBeams is not None:
+            AllBeams = evaluateBeams(Tm, RA, DEC)
+            if self.GD["Beam"]["CenterNorm"]==1:
+                AllBeams0 = evaluateBeams(Tm, np.array([rac]), np.array([decc]))
         for itime in range(Tm.size):
-            DicoBeam["t0"][itime]=T0s[itime]
-            DicoBeam["t1"][itime]=T1s[itime]
-            DicoBeam["tm"][itime]=Tm[itime]
             ThisTime=Tm[itime]
-            Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
+            if evaluateBeams is not None:
+                Beam=AllBeams[itime]
+            else:
+                Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
             #
             if self.GD["Beam"]["CenterNorm"]==1:
-                Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
+                if evaluateBeams is not None:
+                    Beam0=AllBeams0[itime]
+                else:
+                    Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
                 Beam0inv= ModLinAlg.BatchInverse(Beam0)
                 nd,_,_,_,_=Beam.shape
                 Ones=np.ones((nd, 1, 1, 1, 1),np.float32)
@@ -1039,21 +1215,7 @@ class ClassJones():
                 BeamN= ModLinAlg.BatchDot(Beam0inv, Beam)
                 Beam=BeamN
 
-            DicoBeam["Jones"][itime]=Beam
-            NDone=itime+1
-            pBAR.render(NDone,Tm.size)
-
-            DicoBeam["Jones"][itime] = Beam
-
-        nt, nd, na, nch, _, _ = DicoBeam["Jones"].shape
-
-        # DicoBeam["Jones"]=np.mean(DicoBeam["Jones"],axis=3).reshape((nt,nd,na,1,2,2))
-
-        # print TimesBeam-TimesBeam[0]
-        # print t0-t1
-        # print DicoBeam["t1"][-1]-DicoBeam["t0"][0]
-
-        return DicoBeam
+            Jones[itime] = Beam
 
     def MergeJones(self, DicoJ0, DicoJ1):
         import DDFacet.Other.ClassJonesDomains
@@ -1121,3 +1283,73 @@ class ClassJones():
             DicoOut["Jones"][itime] = ModLinAlg.BatchDot(G0, G1)
 
         return DicoOut
+
+
+class ClassBeamWorkers(object):
+    """
+    Evaluates the beam Jones matrices of a chunk (see ClassJones.EstimateBeam()) in the compute workers, with
+    one job per block of beam sample times, writing straight into a shared Jones array. This is meant to be
+    used from the I/O process loading the chunk, while the compute workers would otherwise be idle.
+    Must be created before the workers are started.
+    """
+    def __init__(self, VS, name="BeamJones"):
+        # MSs are looked up through the VisServer, as its MS list may be re-made (see ClassVisServer.Init())
+        self.VS = VS
+        self.name = name
+        APP.registerJobHandlers(self)
+        # one job counter per I/O process, since several I/O processes may be loading chunks concurrently, and
+        # each should only wait for its own jobs
+        self._job_counters = [ APP.createJobCounter("%s:io%02d" % (self.name, i))
+                               for i in range(APP.num_io_processes) ]
+        # per-process JonesMachines, so that each worker only initializes the beam model of an MS once
+        self._jones_machines = {}
+
+    def _giveJonesMachine(self, iMS):
+        MS = self.VS.ListMS[iMS]
+        JonesMachine = self._jones_machines.get(id(MS))
+        if JonesMachine is None:
+            JonesMachine = self._jones_machines[id(MS)] = ClassJones(self.VS.GD, MS, CacheMode=False)
+            JonesMachine.InitBeamMachine()
+        return JonesMachine
+
+    def _beam_worker(self, beamdict, iMS, it0, it1):
+        beamdict.reload()
+        # jobs are not collected, so failures are flagged in the shared status array for evaluate() to check
+        try:
+            JonesMachine = self._giveJonesMachine(iMS)
+            JonesMachine.EvaluateBeamBlock(beamdict["Tm"][it0:it1], beamdict["RA"], beamdict["DEC"],
+                                           beamdict["Jones"][it0:it1])
+        except:
+            beamdict["Status"][it0:it1] = -1
+            raise
+        beamdict["Status"][it0:it1] = 1
+
+    def evaluate(self, MS, Tm, RA, DEC, nfreq):
+        """Returns ntime x ndir x nant x nfreq x 2 x 2 array of beam Jones matrices of the given MS"""
+        iMS = [ id(ms) for ms in self.VS.ListMS ].index(id(MS))
+        job_counter = self._job_counters[APP.ioProcessIndex()]
+        beamdict = shared_dict.create("%s:%d:%d" % (self.name, os.getpid(), iMS))
+        beamdict["Tm"] = np.asarray(Tm, np.float64)
+        beamdict["RA"] = np.atleast_1d(np.asarray(RA, np.float64))
+        beamdict["DEC"] = np.atleast_1d(np.asarray(DEC, np.float64))
+        Jones = beamdict.addSharedArray("Jones", (Tm.size, beamdict["RA"].size, MS.na, nfreq, 2, 2), np.complex64)
+        # per-time status: 0 not done, 1 evaluated, -1 failed
+        status = beamdict.addSharedArray("Status", (Tm.size,), np.int8)
+        # a few blocks per worker, for load balancing
+        nblock = max(1, Tm.size // (APP.ncpu * 2))
+        njobs = 0
+        for it0 in range(0, Tm.size, nblock):
+            it1 = min(it0 + nblock, Tm.size)
+            APP.runJob("%s:%d:%d:%d" % (self.name, iMS, it0, it1), self._beam_worker,
+                       counter=job_counter, collect_result=False,
+                       args=(beamdict.readwrite(), iMS, it0, it1))
+            njobs += 1
+        APP.awaitJobCounter(job_counter, progress="Init E-Jones", total=njobs, timeout=1)
+        failed = (status != 1).sum()
+        Jones = Jones.copy()
+        beamdict.delete()
+        if failed:
+            raise RuntimeError("beam evaluation failed for %d of %d time samples of %s (see worker errors above)" %
+                               (failed, Tm.size, MS.MSName))
+        return Jones
+
@@ -33,6 +33,11 @@ from datetime import datetime as dt
 
 import ephem
 import numpy as np
+import six
+if six.PY3:
+    import pickle as cPickle
+else:
+    import cPickle
 from DDFacet.Other import ModColor
 from DDFacet.Other import logger
 from DDFacet.Other import reformat
@@ -41,7 +46,9 @@ from DDFacet.ToolsDir.rad2hmsdms import rad2hmsdms
 log = logger.getLogger("ClassMS")
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other.CacheManager import CacheManager
+from DDFacet.Data.ClassChunkStore import ClassChunkStore
 from DDFacet.Array import NpShared
+from DDFacet.Array import PackedFlags
 from DDFacet.Data import sidereal
 from DDFacet.Array import PrintRecArray
 
@@ -62,7 +69,7 @@ from DDFacet.Other.progressbar import ProgressBar
 
 class ClassMS():
     def __init__(self,MSname,Col="DATA",zero_flag=True,ReOrder=False,EqualizeFlag=False,DoPrint=True,DoReadData=True,
-                 TimeChunkSize=None,GetBeam=False,RejectAutoCorr=False,SelectSPW=None,DelStationList=None,
+                 TimeChunkSize=None,ChunkMemBytes=None,ChunkFootprint=None,GetBeam=False,RejectAutoCorr=False,SelectSPW=None,DelStationList=None,
                  AverageTimeFreq=None,
                  Field=0,DDID=0,TaQL=None,ChanSlice=None,GD=None,
                  DicoSelectOptions={},
@@ -80,11 +87,15 @@ class ClassMS():
             DoPrint:
             DoReadData:
             TimeChunkSize:
+            ChunkMemBytes: if set, chunks are also limited to this (estimated) shared memory footprint
+            ChunkFootprint: model of the per-chunk shared memory footprint (see estimateChunkFootprint()).
+                If None, ClassMS.DefaultChunkFootprint is used.
             GetBeam:
             RejectAutoCorr:
             SelectSPW:
             DelStationList:
-            AverageTimeFreq:
+            AverageTimeFreq: if set, a tuple of (StepTime, StepFreq). Data is then pre-averaged over up to StepTime
+                timeslots (see giveAveragingMap()) and StepFreq channels as it is read.
             Field:
             DDID:
             ChanSlice:
@@ -99,7 +110,7 @@ class ClassMS():
         if not self.ToRADEC:
             self.ToRADEC = None
 
-        self.AverageSteps=AverageTimeFreq
+        self.AverageSteps=AverageTimeFreq if AverageTimeFreq and max(AverageTimeFreq) > 1 else None
         self.MSName = MSName = reformat.reformat(os.path.abspath(MSname), LastSlash=False)
         
         self.ColName=Col
@@ -109,6 +120,8 @@ class ClassMS():
         self.EqualizeFlag=EqualizeFlag
         self.DoPrint=DoPrint
         self.TimeChunkSize=TimeChunkSize
+        self._chunk_mem_bytes = ChunkMemBytes
+        self._chunk_footprint = ChunkFootprint or ClassMS.DefaultChunkFootprint
         self.RejectAutoCorr=RejectAutoCorr
         self.SelectSPW=SelectSPW
         self.DelStationList=DelStationList
@@ -124,11 +137,22 @@ class ClassMS():
         # once.
         self._reset_cache = ResetCache
         self._chunk_caches = {}
+        self._chunk_store = None
         self.maincache = CacheManager(MSName+".F%d.D%d.ddfcache"%(self.Field, self.DDID), reset=ResetCache, cachedir=self.GD["Cache"]["Dir"], nfswarn=True)
+        # the row index (see giveRowIndex()) only depends on the MS rows, so it has its own cache, which is not
+        # cleared by --Cache-Reset
+        index_mode = self.GD["Cache"]["RowIndex"]
+        self.indexcache = None if index_mode == "off" else \
+            CacheManager(MSName+".F%d.D%d.ddfindex"%(self.Field, self.DDID), reset=(index_mode == "reset"),
+                         cachedir=self.GD["Cache"]["Dir"])
 
         self.ReadMSInfo(first_ms=first_ms,DoPrint=DoPrint)
         self.LFlaggedStations=[]
         self.DicoSelectOptions = DicoSelectOptions
+        # row selection index (see _initRowSelection()): None means all rows are read
+        self._rowsel_runs = self._rowsel_key = None
+        if DicoSelectOptions and not self.empty:
+            self._initRowSelection()
         self._datapath = self._flagpath = None
         self._start_time = time.time()
 
@@ -505,7 +529,11 @@ class ClassMS():
         
         Lon=np.arctan2(self.StationPos[:,1],self.StationPos[:,0]).mean()
         h= sidereal.raToHourAngle(ra, D, Lon)
-        
+        # if given per-row times, evaluate hour angle per row: it advances at the sidereal rate
+        ttVec = np.asarray(ttVec)
+        if ttVec.shape == np.shape(A0):
+            h = h + 2*np.pi*1.0027379093/(24*3600)*(ttVec - tt)
+
 
         c=np.cos
         s=np.sin
@@ -528,12 +556,14 @@ class ClassMS():
         else:
         # stop
             K=2.*np.pi/(24.*3600)
-            R_dt=np.array([[K*c(h)      , -K*s(h)     , 0.  ],
-                           [K*s(d)*s(h) , K*s(d)*c(h) , 0.  ],
-                           [-K*c(d)*s(h), -K*c(d)*c(h), 0.  ]])
-
-            UVW_dt=np.dot(R_dt,L.T).T
-            return np.float32(UVW_dt)
+            # rows of d(R)/dt applied to the baseline vectors (third column of R_dt is null),
+            # elementwise so that h may be per-row
+            Lx, Ly = L[:,0], L[:,1]
+            UVW_dt = np.empty(L.shape, np.float32)
+            UVW_dt[:,0] = K*(c(h)*Lx - s(h)*Ly)
+            UVW_dt[:,1] = K*s(d)*(s(h)*Lx + c(h)*Ly)
+            UVW_dt[:,2] = -K*c(d)*(s(h)*Lx + c(h)*Ly)
+            return UVW_dt
 
     def ReinitChunkIter(self):
         self.current_chunk = -1
@@ -561,12 +591,412 @@ class ClassMS():
         return "EndMS"
 
 
+    # default chunk footprint model: visibilities, packed flags and weights, plus ~64 bytes of per-row metadata
+    # (uvw, antennas, times, etc.)
+    DefaultChunkFootprint = dict(fixed=0, row=64, chan=4 + 1/8., vis=8, ant_hour=0, ant_chan_hour=0, span=0)
+
+    def _chunkFootprintCoeffs(self):
+        """Returns fixed, per-row and per-hour terms of the chunk footprint model, in bytes"""
+        model = self._chunk_footprint
+        rowbytes = model["row"] + self.Nchan*model["chan"] + self.Nchan*self.Ncorr*model["vis"]
+        hourbytes = self.na*(model["ant_hour"] + self.Nchan*model["ant_chan_hour"]) + \
+                    model.get("span", 0)/max(self._span_hours, 1e-6)
+        return model["fixed"], rowbytes, hourbytes
+
+    def estimateChunkFootprint(self, nrows, hours):
+        """
+        Returns estimated shared memory footprint (in bytes) of a loaded chunk of nrows rows spanning the
+        given number of hours. The footprint model is a dict of
+            fixed:          bytes per chunk
+            row:            bytes per row
+            chan:           bytes per row and channel
+            vis:            bytes per visibility (row, channel and correlation)
+            ant_hour:       bytes per antenna per hour of data
+            ant_chan_hour:  bytes per antenna and channel per hour of data
+            span:           bytes of per-MS data of which each chunk loads its own time slice (e.g. DDE solutions),
+                            taken to be spread evenly over the time span of the MS
+        """
+        fixed, rowbytes, hourbytes = self._chunkFootprintCoeffs()
+        return fixed + nrows*rowbytes + hours*hourbytes
+
+    def _makeChunkMapping(self, info, dt):
+        """
+        Splits the MS into chunks of rows, of at most --Data-ChunkHours each, and, if a memory budget is set,
+        with an estimated footprint (see estimateChunkFootprint()) of at most that budget.
+        Chunks are always split on time slot boundaries, as given by the time slots of the metadata
+        snapshot (see giveMSSnapshot()). Returns first and last time.
+        """
+        budget = self._chunk_mem_bytes
+        # unique time slots, and their starting rows
+        slot_times, slot_row0 = info["slot_times"], info["slot_row0"]
+        nslot = len(slot_times)
+        T0, T1 = slot_times[0], slot_times[-1]
+        # time span of the MS, over which the "span" term of the footprint model is spread
+        self._span_hours = (T1 - T0 + dt)/3600.
+        if not self.TimeChunkSize and not budget:
+            print("--Data-ChunkHours is null: MS %s (%d rows) column %s will be processed as a single chunk"%(self.MSName, self.F_nrows, self.ColName), file=log)
+            chunk_row0 = [0]
+            chunk_hours = [(T1 - T0 + dt)/3600.]
+        else:
+            if not info["time_ordered"]:
+                raise RuntimeError("MS %s: the TIME column must be in increasing order"%self.MSName)
+            if not budget:
+                chunk_t0 = np.arange(T0, T1, self.TimeChunkSize*3600)
+                # chunk_t0 now gives starting time of each chunk. Convert to starting slot, ensuring no duplicates
+                chunk_slot0 = sorted(set(np.searchsorted(slot_times, chunk_t0).tolist()))
+            else:
+                fixed, rowbytes, hourbytes = self._chunkFootprintCoeffs()
+                if fixed >= budget:
+                    print(ModColor.Str("MS %s: fixed per-chunk footprint (%.2f GB) exceeds --Data-ChunkMemGB"%(
+                        self.MSName, fixed/2.**30)), file=log)
+                # footprint of the data up to the start and end of each slot. The footprint of a chunk
+                # of slots i..j is then fixed + cost_end[j] - cost_start[i]
+                slot_row1 = np.append(slot_row0[1:], self.F_nrows)
+                cost_start = slot_row0*rowbytes + (slot_times - T0)/3600.*hourbytes
+                cost_end = slot_row1*rowbytes + (slot_times - T0 + dt)/3600.*hourbytes
+                chunk_slot0 = []
+                islot = 0
+                while islot < nslot:
+                    chunk_slot0.append(islot)
+                    # last slot that still fits into the chunk (but take at least one)
+                    jslot = np.searchsorted(cost_end, cost_start[islot] + budget - fixed, side="right") - 1
+                    if self.TimeChunkSize:
+                        jslot = min(jslot, np.searchsorted(slot_times, slot_times[islot] + self.TimeChunkSize*3600) - 1)
+                    islot = max(jslot, islot) + 1
+            chunk_row0 = [ int(slot_row0[i]) for i in chunk_slot0 ]
+            chunk_hours = [ (slot_times[j-1] - slot_times[i] + dt)/3600. for i, j in
+                            zip(chunk_slot0, chunk_slot0[1:] + [nslot]) ]
+            # chunk_row0 gives the starting row of each chunk
+            if len(chunk_row0) == 1:
+                print("MS %s DDID %d FIELD %d (%d rows) column %s will be processed as a single chunk"%(self.MSName, self.DDID, self.Field, self.F_nrows, self.ColName), file=log)
+            else:
+                print("MS %s DDID %d FIELD %d (%d rows) column %s will be split into %d chunks, at rows %s"%(self.MSName, self.DDID, self.Field,  self.F_nrows,
+                                                                                       self.ColName, len(chunk_row0), " ".join(map(str,chunk_row0))), file=log)
+        self.Nchunk = len(chunk_row0)
+        chunk_row0.append(self.F_nrows)
+        self._chunk_r0r1 = [ chunk_row0[i:i+2] for i in range(self.Nchunk) ]
+        self._chunk_hours = chunk_hours
+        if budget:
+            print("  estimated footprint of largest chunk is %.2f GB (budget %.2f GB)" % (
+                max(self.getChunkFootprints())/2.**30, budget/2.**30), file=log)
+        return T0, T1
+
+    def getChunkFootprints(self):
+        """Returns list of estimated shared memory footprints (in bytes) of each chunk"""
+        return [ self.estimateChunkFootprint(row1 - row0, hours) for (row0, row1), hours in
+                 zip(self._chunk_r0r1, self._chunk_hours) ]
+
     def numChunks (self):
         return len(self._chunk_r0r1)
 
     def getChunkRow0Row1 (self):
         return self._chunk_r0r1
         
+    # max size of the row blocks used by readColumnSorted()
+    ReadBlockBytes = 256*2**20
+
+    @staticmethod
+    def giveSortIndex(A0, A1, times):
+        """
+        Returns index that sorts rows in baseline-time order. The sort is stable, so rows with identical
+        (A0, A1, time) keep their MS order.
+        """
+        return np.lexsort((times, A1, A0))
+
+    @staticmethod
+    def giveBaselineRanges(A0, A1):
+        """
+        Given antenna arrays of rows in baseline order, returns an nbl x 4 array of (a0, a1, i0, i1) giving
+        the range of rows i0:i1 of each baseline present
+        """
+        change = np.where((A0[1:] != A0[:-1]) | (A1[1:] != A1[:-1]))[0] + 1
+        i0 = np.concatenate(([0], change)).astype(np.int64)
+        i1 = np.append(i0[1:], len(A0)).astype(np.int64)
+        if not len(A0):
+            i0, i1 = i0[:0], i1[:0]
+        return np.stack((A0[i0].astype(np.int64), A1[i0].astype(np.int64), i0, i1), axis=1)
+
+    @staticmethod
+    def giveBaselineRows(DATA, ibl):
+        """Returns index of the rows of baseline number ibl (in DATA["BaselineRanges"]) in the DATA arrays"""
+        _, _, i0, i1 = DATA["BaselineRanges"][ibl]
+        rows = DATA["BaselineRows"]
+        return np.arange(i0, i1) if rows is None else rows[i0:i1]
+
+    def giveRowIndex(self, row0, row1, A0, A1, times):
+        """
+        Returns the row index of rows row0:row1 (A0, A1 and times given in MS order), as a tuple of
+        (perm, bl_ranges, uniq_times). perm sorts the rows in baseline-time order (see giveSortIndex()),
+        bl_ranges (see giveBaselineRanges()) gives the rows perm[i0:i1] of each baseline, and uniq_times
+        is the sorted vector of unique timestamps.
+
+        The index only depends on the MS rows, so it is kept in a separate per-MS cache (see --Cache-RowIndex),
+        keyed on the row selection only.
+        """
+        name = "R%d:%d.npz" % (row0, row1)
+        path = None
+        if self.indexcache is not None:
+            path, valid = self.indexcache.checkCache(name, dict(TaQL=self.TaQL, nrows=self.F_nrows,
+                                                                selection=self._rowsel_key))
+            if valid:
+                try:
+                    index = np.load(path)
+                    return index["perm"], index["bl_ranges"], index["uniq_times"]
+                except Exception as exc:
+                    print("row index %s can't be read (%s), will re-make" % (path, exc), file=log)
+        print("making baseline-time row index", file=log)
+        perm = self.giveSortIndex(A0, A1, times)
+        bl_ranges = self.giveBaselineRanges(A0[perm], A1[perm])
+        uniq_times = np.unique(times)
+        if path is not None:
+            np.savez(path, perm=perm, bl_ranges=bl_ranges, uniq_times=uniq_times)
+            self.indexcache.saveCache(name)
+        return perm, bl_ranges, uniq_times
+
+    def iterColumnBlocks(self, table_all, colname, row0, nrow, sort_index=None, rowbytes=None, slicer=None,
+                         selection=None):
+        """
+        Iterates over nrow rows of a column starting at row0, in blocks of at most ReadBlockBytes, given the size of a
+        row in bytes (rowbytes, defaulting to that of a complex128 visibility row). If selection is given, the rows
+        are rather the selected rows given by it (see giveChunkRows()), and nrow should be its length.
+        Yields tuples of (rows, block), where rows gives the positions of the block's rows in the output: a slice,
+        or, if sort_index is given, an index array placing them in sorted order.
+        Cells are sliced with the channel/correlation selection (cs_tlc, cs_brc and cs_inc), or by slicer,
+        which can be a (blc, trc, inc) tuple, or False to read whole cells.
+        """
+        rowbytes = rowbytes or self.ReadNchan*self.Ncorr*16
+        blockrows = max(1, min(nrow, self.ReadBlockBytes // max(rowbytes, 1)))
+        if sort_index is not None:
+            # inverse permutation: MS row i goes to out[inverse[i]]
+            inverse = np.empty_like(sort_index)
+            inverse[sort_index] = np.arange(nrow)
+        if slicer is None:
+            slicer = self.cs_tlc, self.cs_brc, self.cs_inc
+        def read(r0, n):
+            if slicer is False:
+                return table_all.getcol(colname, r0, n)
+            return table_all.getcolslice(colname, slicer[0], slicer[1], slicer[2], r0, n)
+        for i0 in range(0, nrow, blockrows):
+            nblock = min(blockrows, nrow - i0)
+            if selection is None:
+                block = read(row0 + i0, nblock)
+            else:
+                block = self._readSelectedRows(read, row0, selection[i0:i0 + nblock], blockrows)
+            yield (slice(i0, i0 + nblock) if sort_index is None else inverse[i0:i0 + nblock]), block
+
+    # when reading selected rows, gaps of up to this many deselected rows are read through rather than skipped
+    MaxSelectionGap = 64
+
+    def _readSelectedRows(self, read, row0, rows, maxrows):
+        """
+        Helper method: reads the given (sorted) rows, relative to row0, using read(r0, n). Rows are merged into
+        contiguous spans (bridging small gaps), which are read in pieces of at most maxrows, and only the selected
+        rows of each piece are kept.
+        """
+        if not len(rows):
+            return read(row0, 0)
+        breaks = np.where(np.diff(rows) > self.MaxSelectionGap + 1)[0] + 1
+        pieces = []
+        for i, j in zip(np.concatenate(([0], breaks)), np.append(breaks, len(rows))):
+            span = rows[i:j]
+            for r0 in range(span[0], span[-1] + 1, maxrows):
+                r1 = min(r0 + maxrows, span[-1] + 1)
+                sel = span[(span >= r0) & (span < r1)] - r0
+                if len(sel):
+                    block = read(row0 + r0, r1 - r0)
+                    pieces.append(block if len(sel) == r1 - r0 else block[sel])
+        return np.concatenate(pieces)
+
+    def readColumn(self, table_all, colname, row0, nrow, selection=None):
+        """Reads whole cells of nrow rows of a column from row0, or of the selected rows (see iterColumnBlocks())"""
+        if selection is None:
+            return table_all.getcol(colname, row0, nrow)
+        blocks = [ block for _, block in self.iterColumnBlocks(table_all, colname, row0, nrow, rowbytes=64,
+                                                               slicer=False, selection=selection) ]
+        return np.concatenate(blocks) if blocks else table_all.getcol(colname, row0, 0)
+
+    def readColumnSorted(self, table_all, colname, out, row0, nrow, sort_index=None, reduce=None, slicer=None,
+                         selection=None):
+        """
+        Reads rows row0:row0+nrow of a column (with the channel/correlation selection given by
+        cs_tlc, cs_brc and cs_inc) into the preallocated array out. If sort_index is given, MS rows are
+        read in blocks and scattered straight into their sorted positions in out, so no full-size
+        intermediate array is needed.
+        If reduce is given, it is applied to each block of rows (e.g. to reduce over correlations)
+        before the result goes into out. The block is then sliced by slicer (see iterColumnBlocks()).
+        If selection is given, only the selected rows are read (see iterColumnBlocks()).
+        """
+        if reduce is not None or selection is not None:
+            rowbytes = out[0].nbytes*self.Ncorr if len(out) else None
+            for rows, block in self.iterColumnBlocks(table_all, colname, row0, nrow, sort_index,
+                                                     rowbytes=rowbytes, slicer=slicer, selection=selection):
+                out[rows] = reduce(block) if reduce is not None else block
+            return out
+        if sort_index is None:
+            table_all.getcolslicenp(colname, out, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nrow)
+            return out
+        # inverse permutation: MS row i goes to out[inverse[i]]
+        inverse = np.empty_like(sort_index)
+        inverse[sort_index] = np.arange(nrow)
+        blockrows = max(1, min(nrow, self.ReadBlockBytes // max(out[0].nbytes, 1)))
+        blockbuf = np.empty((blockrows,) + out.shape[1:], out.dtype)
+        for i0 in range(0, nrow, blockrows):
+            nblock = min(blockrows, nrow - i0)
+            block = blockbuf[:nblock]
+            table_all.getcolslicenp(colname, block, self.cs_tlc, self.cs_brc, self.cs_inc, row0 + i0, nblock)
+            out[inverse[i0:i0 + nblock]] = block
+        return out
+
+    def readVisWeights(self, table_all, row0, nrow, colname, out=None, selection=None):
+        """
+        Reads per-visibility weights of rows row0:row0+nrow (in MS order) from the given weight column,
+        taking the mean across correlations. Returns an nrow x ReadNchan float32 array (at full resolution,
+        if pre-averaging in frequency). If out is given, weights are read block by block straight into it.
+        If selection is given, only the selected rows are read (see iterColumnBlocks()).
+        """
+        weight = out if out is not None else np.empty((nrow, self.ReadNchan), np.float32)
+        if colname == "WEIGHT_SPECTRUM":
+            # take mean weight across correlations and apply this to all
+            if self._reverse_channel_order:
+                reduce = lambda w: w.mean(axis=2)[:, ::-1]
+            else:
+                reduce = lambda w: w.mean(axis=2)
+            self.readColumnSorted(table_all, colname, weight, row0, nrow, reduce=reduce, selection=selection)
+        elif colname == "None" or colname == None:
+            weight.fill(1)
+        elif colname == "WEIGHT":
+            # take mean weight across correlations, and expand to have frequency axis
+            self.readColumnSorted(table_all, colname, weight, row0, nrow, slicer=False, selection=selection,
+                                  reduce=lambda w: w.mean(axis=1)[:, np.newaxis])
+        else:
+            # in all other cases (i.e. IMAGING_WEIGHT) assume a column
+            # of shape NRow,NFreq to begin with, check for this:
+            def reduce(w):
+                if w.shape[1:] != weight.shape[1:]:
+                    raise TypeError("weights column expected to have shape of %s" % (weight.shape,))
+                return w
+            self.readColumnSorted(table_all, colname, weight, row0, nrow, reduce=reduce, selection=selection,
+                                  slicer=(self.cs_tlc[:1], self.cs_brc[:1], self.cs_inc[:1]))
+        return weight
+
+    def giveAveragingMap(self, row0, row1):
+        """
+        Returns the time averaging map of rows row0:row1 (see --Data-AverageTime), as a tuple of (perm, starts).
+        perm sorts the (selected, see giveChunkRows()) MS rows in baseline-time order (see giveRowIndex()), and
+        averaged row i is the average
+        of rows perm[starts[i]:starts[i+1]], so averaged rows are in baseline-time order as well.
+
+        Each baseline is averaged over bins of up to StepTime timeslots, aligned on the start of the chunk.
+        Longer baselines get shorter bins, so that the amplitude loss from time smearing, at the corners of the
+        image, stays within --Data-AverageMaxDecorr. The map is kept in the chunk cache.
+        """
+        navg = self.AverageSteps[0]
+        maxdecorr = self.GD["Data"]["AverageMaxDecorr"]
+        npix, cell = self.GD["Image"]["NPix"], self.GD["Image"]["Cell"]
+        cache = self.getChunkCache(row0, row1)
+        path, valid = cache.checkCache("AveragingMap.npz", dict(TaQL=self.TaQL, nrows=self.F_nrows, AverageTime=navg,
+                                                                MaxDecorr=maxdecorr, NPix=npix, Cell=cell,
+                                                                selection=self._rowsel_key))
+        if valid:
+            try:
+                avgmap = np.load(path)
+                return avgmap["perm"], avgmap["starts"]
+            except Exception as exc:
+                print("averaging map %s can't be read (%s), will re-make" % (path, exc), file=log)
+        selection = self.giveChunkRows(row0, row1)
+        nrow = row1 - row0 if selection is None else len(selection)
+        table_all = self.GiveMainTable()
+        A0, A1, times, uvw = [ self.readColumn(table_all, colname, row0, nrow, selection)
+                               for colname in ("ANTENNA1", "ANTENNA2", "TIME", "UVW") ]
+        table_all.close()
+        perm, bl_ranges, _ = self.giveRowIndex(row0, row1, A0, A1, times)
+        i0, i1 = bl_ranges[:, 2], bl_ranges[:, 3]
+        # number of timeslots per bin, per baseline
+        nslots = np.full(len(bl_ranges), navg, np.int64)
+        if navg > 1 and len(bl_ranges):
+            # phase change over one timeslot of a source at the corner of the image, at the highest frequency
+            radius = np.sin(npix*cell/np.sqrt(2)*np.pi/(180*3600))
+            dot_uvw = self.ComputeDotUVW(A0, A1, times, uvw, bl_ranges=bl_ranges, bl_rows=perm)
+            dphi = 2*np.pi*self.ChanFreq.max()/299792458.*radius*self.dt*np.sqrt((dot_uvw[perm, :2]**2).sum(axis=1))
+            dphi = np.maximum.reduceat(dphi, i0)
+            # averaging over a phase range x loses a fraction of ~x^2/24 of the amplitude
+            with np.errstate(divide="ignore"):
+                nslots = np.clip(np.sqrt(24*maxdecorr)/dphi, 1, navg).astype(np.int64)
+        # bin of each row, in baseline-time order. A new averaged row starts at each change of bin or baseline
+        tt = times[perm]
+        slot = np.round((tt - tt.min())/self.dt).astype(np.int64) if len(tt) else tt.astype(np.int64)
+        tbin = slot // np.repeat(nslots, i1 - i0)
+        newrow = np.ones(len(tt), bool)
+        newrow[1:] = tbin[1:] != tbin[:-1]
+        newrow[i0] = True
+        starts = np.where(newrow)[0]
+        print("averaging map: %d rows averaged to %d" % (nrow, len(starts)), file=log)
+        # write to temp file and rename, since the weights computation may be making the same map concurrently
+        tmppath = "%s.%d.npz" % (path, os.getpid())
+        np.savez(tmppath, perm=perm, starts=starts)
+        os.rename(tmppath, path)
+        cache.saveCache("AveragingMap.npz")
+        return perm, starts
+
+    @staticmethod
+    def _averageRowMeans(array, perm, starts):
+        """Helper method: returns unweighted means of the MS-order rows of array over the bins of an averaging map"""
+        counts = np.diff(np.append(starts, len(perm))).reshape((-1,) + (1,)*(array.ndim - 1))
+        return np.add.reduceat(array[perm], starts, axis=0) / counts
+
+    def averageWeights(self, row0, row1, uvw, weight):
+        """
+        Pre-averages per-row uvw and per-visibility weights (nrow x ReadNchan, zero for flagged visibilities) of
+        rows row0:row1, given in MS order, in the same way as ReadData() pre-averages the data. The averaged weight
+        is the sum of the weights. Returns tuple of averaged (uvw, weight).
+        """
+        perm, starts = self.giveAveragingMap(row0, row1)
+        uvw = self._averageRowMeans(uvw, perm, starts)
+        weight = np.add.reduceat(weight[perm], starts, axis=0)
+        if self._avg_chan_starts is not None:
+            weight = np.add.reduceat(weight, self._avg_chan_starts, axis=1)
+        return uvw, weight
+
+    def readAveraged(self, table_all, row0, nrow, avgmap, vis_out, flags_out, selection=None):
+        """
+        Reads flags and (if vis_out is not None) visibilities of rows row0:row0+nrow at full resolution, and pre-averages
+        them into flags_out and vis_out (nout x Nchan x Ncorr), using the given averaging map (see giveAveragingMap()).
+        The flag selection (see UpdateFlags()) is applied at full resolution. Visibilities are weighted by --Weight-ColName,
+        with flagged ones excluded, and averaged visibilities are flagged if they have no unflagged inputs.
+        If selection is given, only the selected rows are read (see iterColumnBlocks()).
+        """
+        perm, starts = avgmap
+        A0, A1, times, uvw = [ self.readColumn(table_all, colname, row0, nrow, selection)[perm]
+                               for colname in ("ANTENNA1", "ANTENNA2", "TIME", "UVW") ]
+        shape = (nrow, self.ReadNchan, self.Ncorr)
+        flags = np.empty(shape, np.bool)
+        self.readColumnSorted(table_all, "FLAG", flags, row0, nrow, perm, selection=selection)
+        vis = None
+        if vis_out is not None:
+            vis = np.empty(shape, np.complex64)
+            self.readColumnSorted(table_all, self.ColName, vis, row0, nrow, perm, selection=selection)
+        if self._reverse_channel_order:
+            flags = flags[:, ::-1]
+            vis = vis[:, ::-1] if vis is not None else None
+        self.UpdateFlags(flags, uvw, vis, A0, A1, times)
+        weight = self.readVisWeights(table_all, row0, nrow, self.GD["Weight"]["ColName"], selection=selection)[perm]
+        chan_starts = self._avg_chan_starts if self._avg_chan_starts is not None else np.arange(self.ReadNchan)
+        ends = np.append(starts[1:], nrow)
+        # go through in blocks of averaged rows, to keep the temporaries small
+        blockrows = max(1, self.ReadBlockBytes // (self.ReadNchan*self.Ncorr*8))
+        o0 = 0
+        while o0 < len(starts):
+            o1 = max(o0 + 1, np.searchsorted(ends, starts[o0] + blockrows, side="right"))
+            i0, i1 = starts[o0], ends[o1 - 1]
+            bstarts = starts[o0:o1] - i0
+            wv = weight[i0:i1, :, np.newaxis] * ~flags[i0:i1]
+            wsum = np.add.reduceat(np.add.reduceat(wv, bstarts, axis=0), chan_starts, axis=1)
+            flags_out[o0:o1] = wsum == 0
+            if vis is not None:
+                vsum = np.add.reduceat(np.add.reduceat(vis[i0:i1]*wv, bstarts, axis=0), chan_starts, axis=1)
+                vis_out[o0:o1] = vsum / np.where(wsum == 0, 1, wsum)
+            o0 = o1
+
     def ReadData(self,DATA,row0,row1,
                  ReadWeight=False,
                  use_cache=False, read_data=True,
@@ -586,15 +1016,21 @@ class ClassMS():
         """
         self.ROW0 = row0
         self.ROW1 = row1
-        self.nRowRead = nRowRead = row1-row0
+        # rows deselected by the row selection index are not read at all
+        selection = self.giveChunkRows(row0, row1)
+        self.nRowRead = nRowRead = row1-row0 if selection is None else len(selection)
 
         if row0 >= self.F_nrows:# or nRowRead == 0:
             return "EndMS"
         if row1 > self.F_nrows:
             row1 = self.F_nrows
-        
+
+        # if pre-averaging, rows row0:row1 become the rows of the averaging map
+        avgmap = self.giveAveragingMap(row0, row1) if self.AverageSteps is not None else None
+        nRowOut = len(avgmap[1]) if avgmap is not None else nRowRead
+
         # expected data column shape
-        DATA["datashape"] = datashape = (nRowRead, len(self.ChanFreq), len(self.CorrelationNames))
+        DATA["datashape"] = datashape = (nRowOut, len(self.ChanFreq), len(self.CorrelationNames))
         DATA["datatype"]  = np.complex64
 
         strMS = "%s" % (ModColor.Str(self.MSName, col="green"))
@@ -602,6 +1038,10 @@ class ClassMS():
             strMS, row0, row1), file=log)
         table_all = None
 
+        # caching goes via the columnar chunk store
+        store = self._chunk_store
+        if store is None:
+            use_cache = False
         # check cache for A0,A1,time,uvw
         if use_cache:
             # In force-cache mode, cache has no keys, so use it if it exists (i.e. if we have visibilities
@@ -615,47 +1055,63 @@ class ClassMS():
             cache_key = dict(data=self.GD["Data"],
                              selection=self.GD["Selection"],
                              Comp=self.GD["Comp"])
-            metadata_path, metadata_valid = self.cache.checkCache("A0A1UVWT.npz", cache_key, ignore_key=(use_cache=="force"))
+            # the time averaging map also depends on the image size
+            if avgmap is not None:
+                cache_key["image"] = dict(NPix=self.GD["Image"]["NPix"], Cell=self.GD["Image"]["Cell"])
+            metadata_path, metadata_valid = store.checkCache(self.cache, "VisStore.meta", cache_key, ignore_key=(use_cache=="force"))
         else:
             metadata_valid = False
-        # if cache is valid, we're all good
+        # if cache is valid, we're all good: map metadata columns straight from the store
         if metadata_valid:
-            npz = np.load(metadata_path)
             A0, A1, uvw, time_all, time_uniq, sort_index, dot_uvw = \
-                (npz["A0"], npz["A1"], npz["UVW"], npz["TIME"], npz["TIME_UNIQ"], npz["SORT_INDEX"], npz["DOT_UVW"])
-            if not sort_index.size:
-                sort_index = None
-            if not dot_uvw.size:
-                dot_uvw = None
+                [ store.load(metadata_path, column) for column in
+                  ("A0", "A1", "uvw", "times", "uniq_times", "sort_index", "uvw_dt") ]
+            # sorted (or pre-averaged) rows are already in baseline order, so per-baseline ranges are a simple scan.
+            # Else go via the row index
+            if sort_index is not None or avgmap is not None:
+                bl_ranges, bl_rows = self.giveBaselineRanges(A0, A1), None
+            else:
+                bl_rows, bl_ranges, _ = self.giveRowIndex(row0, row1, A0, A1, time_all)
         else:
             table_all = table_all or self.GiveMainTable()
             # SPW=table_all.getcol('DATA_DESC_ID',row0,nRowRead)
-            A0 = table_all.getcol('ANTENNA1', row0, nRowRead) # [SPW==self.ListSPW[0]]
-            A1 = table_all.getcol('ANTENNA2', row0, nRowRead) # [SPW==self.ListSPW[0]]
+            A0 = self.readColumn(table_all, 'ANTENNA1', row0, nRowRead, selection) # [SPW==self.ListSPW[0]]
+            A1 = self.readColumn(table_all, 'ANTENNA2', row0, nRowRead, selection) # [SPW==self.ListSPW[0]]
             # print self.ListSPW[0]
-            time_all = table_all.getcol('TIME', row0, nRowRead)  # [SPW==self.ListSPW[0]]
+            time_all = self.readColumn(table_all, 'TIME', row0, nRowRead, selection)  # [SPW==self.ListSPW[0]]
             # print np.max(time_all)-np.min(time_all)
             # time_slots_all=np.array(sorted(list(set(time_all))))
-            uvw = table_all.getcol('UVW', row0, nRowRead)
-            if sort_by_baseline:
-                # make sort index
-                print("sorting by baseline-time", file=log)
-                sortby = sorted(zip(A0, A1, time_all, range(nRowRead)))
-                sort_index = np.array([ s[3] for s in sortby ])
-                print("applying sort index to metadata rows", file=log)
-                A0 = A0[sort_index]
-                A1 = A1[sort_index]
-                uvw = uvw[sort_index]
-                time_all = time_all[sort_index]
+            uvw = self.readColumn(table_all, 'UVW', row0, nRowRead, selection)
+            if avgmap is not None:
+                # pre-averaged rows are in baseline-time order already
+                perm, starts = avgmap
+                A0, A1 = A0[perm][starts], A1[perm][starts]
+                uvw = self._averageRowMeans(uvw, perm, starts)
+                time_all = self._averageRowMeans(time_all, perm, starts)
+                sort_index, bl_rows = None, None
+                bl_ranges = self.giveBaselineRanges(A0, A1)
+                time_uniq = np.unique(time_all)
             else:
-                sort_index = None
-            time_uniq = np.array(sorted(set(time_all)))
+                # get baseline-time order and per-baseline row ranges from the row index
+                perm, bl_ranges, time_uniq = self.giveRowIndex(row0, row1, A0, A1, time_all)
+                if sort_by_baseline:
+                    print("applying sort index to metadata rows", file=log)
+                    sort_index, bl_rows = perm, None
+                    A0 = A0[sort_index]
+                    A1 = A1[sort_index]
+                    uvw = uvw[sort_index]
+                    time_all = time_all[sort_index]
+                else:
+                    sort_index, bl_rows = None, perm
+            del perm
             dot_uvw = None
 
         if ReadWeight:
             table_all = table_all or self.GiveMainTable()
-            weights = table_all.getcol("WEIGHT", row0, nRowRead)
-            if sort_index is not None:
+            weights = self.readColumn(table_all, "WEIGHT", row0, nRowRead, selection)
+            if avgmap is not None:
+                weights = np.add.reduceat(weights[avgmap[0]], avgmap[1], axis=0)
+            elif sort_index is not None:
                 weights = weights[sort_index]
             DATA["weights"] = weights
 
@@ -663,68 +1119,72 @@ class ClassMS():
 
         DATA["uvw"]   = uvw
         visdata = DATA.addSharedArray("data", shape=datashape, dtype=np.complex64)
+        # when pre-averaging, flags are averaged along with the visibilities
+        avgflags = None
         if read_data:
             # check cache for visibilities
             if use_cache:
-                datapath, datavalid = self.cache.checkCache("Data.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+                datapath, datavalid = store.checkCache(self.cache, "VisStore.data", dict(time=self._start_time), ignore_key=(use_cache=="force"))
             else:
                 datavalid = False
             # read from cache if available, else from MS
             if datavalid:
-                print("reading cached visibilities from %s" % datapath, file=log)
-                visdata[...] = np.load(datapath)
+                print("reading cached visibilities from %s" % store.path, file=log)
+                store.load(datapath, "data", out=visdata)
                 #self.RotateType=["uvw"]
             else:
                 print("reading MS visibilities from column %s" % self.ColName, file=log)
                 table_all = table_all or self.GiveMainTable()
-                if sort_index is not None:
-                    visdata1 = np.ndarray(shape=datashape, dtype=np.complex64)
-                    table_all.getcolslicenp(self.ColName, visdata1, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
-                    print("sorting visibilities", file=log)
-                    t0 = time.time()
-                    visdata[...] = visdata1[sort_index]
-                    del visdata1
-                    print("sorting took %.1fs"%(time.time()-t0), file=log)
+                t0 = time.time()
+                if avgmap is not None:
+                    avgflags = np.empty(datashape, np.bool)
+                    self.readAveraged(table_all, row0, nRowRead, avgmap, visdata, avgflags, selection)
+                    print("reading and averaging took %.1fs"%(time.time()-t0), file=log)
                 else:
-                    table_all.getcolslicenp(self.ColName, visdata, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
-                if self._reverse_channel_order:
-                    visdata[:,:,:]= visdata[:,::-1,:]
+                    self.readColumnSorted(table_all, self.ColName, visdata, row0, nRowRead, sort_index,
+                                          selection=selection)
+                    print("reading%s took %.1fs"%(" and sorting" if sort_index is not None else "", time.time()-t0), file=log)
+                    if self._reverse_channel_order:
+                        visdata[:,:,:]= visdata[:,::-1,:]
   
                 if self.ToRADEC is not None:
                     self.Rotate(DATA,RotateType=["vis"])
 
                 if use_cache:
-                    print("caching visibilities to %s" % datapath, file=log)
-                    np.save(datapath, visdata)
-                    self.cache.saveCache("Data.npy")
+                    print("caching visibilities to %s" % store.path, file=log)
+                    store.save(datapath, row0, row1, dict(data=visdata))
+                    self.cache.saveCache("VisStore.data")
         # create flag array (if flagbuf is not None, array uses memory of buffer)
-        flags = DATA.addSharedArray("flags", shape=datashape, dtype=np.bool)
+        # flags are held bit-packed per row/channel, plus a per-row summary (see PackedFlags)
+        packed_flags = DATA.addSharedArray("flags", shape=PackedFlags.packedShape(nRowOut, len(self.ChanFreq)), dtype=np.uint8)
+        rowflags = DATA.addSharedArray("rowflags", shape=(nRowOut,), dtype=np.uint8)
         # check cache for flags
         if use_cache:
-            flagpath, flagvalid = self.cache.checkCache("Flags.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+            flagpath, flagvalid = store.checkCache(self.cache, "VisStore.flags", dict(time=self._start_time), ignore_key=(use_cache=="force"))
         else:
             flagvalid = False
         # read from cache if available, else from MS
         if flagvalid:
-            print("reading cached flags from %s" % flagpath, file=log)
-            flags[...] = np.load(flagpath)
+            print("reading cached flags from %s" % store.path, file=log)
+            store.load(flagpath, "flags", out=packed_flags)
+            store.load(flagpath, "rowflags", out=rowflags)
         else:
             print("reading MS flags from column FLAG", file=log)
             table_all = table_all or self.GiveMainTable()
-            if sort_index is not None:
-                flags1 = table_all.getcolslice("FLAG", self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
-                print("sorting flags", file=log)
-                t0 = time.time()
-                flags[...] = flags1[sort_index]
-                del flags1
-                print("sorting took %.1fs"%(time.time()-t0), file=log)
+            if avgmap is not None:
+                flags = avgflags
+                if flags is None:
+                    flags = np.empty(datashape, np.bool)
+                    self.readAveraged(table_all, row0, nRowRead, avgmap, None, flags, selection)
+                PackedFlags.packInto(flags, packed_flags, rowflags)
+                del flags, avgflags
             else:
-                table_all.getcolslicenp("FLAG", flags, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
-            self.UpdateFlags(flags, uvw, visdata, A0, A1, time_all)
+                self.readFlags(table_all, row0, nRowRead, sort_index, packed_flags, rowflags,
+                               uvw, A0, A1, time_all, visdata if read_data else None, selection=selection)
             if use_cache:
-                print("caching flags to %s" % flagpath, file=log)
-                np.save(flagpath, flags)
-                self.cache.saveCache("Flags.npy")
+                print("caching flags to %s" % store.path, file=log)
+                store.save(flagpath, row0, row1, dict(flags=packed_flags, rowflags=rowflags))
+                self.cache.saveCache("VisStore.flags")
         if table_all:
             table_all.close()
 
@@ -734,7 +1194,7 @@ class ClassMS():
         DecorrMode=self.GD["RIME"]["DecorrMode"]
         if 'F' in DecorrMode or "T" in DecorrMode:
             if dot_uvw is None:
-                dot_uvw = self.ComputeDotUVW(A0, A1, time_all, uvw)
+                dot_uvw = self.giveDotUVW(A0, A1, time_all, uvw, bl_ranges=bl_ranges, bl_rows=bl_rows)
             DATA["uvw_dt"] = dot_uvw
             # if 'UVWDT' not in ColNames:
             #     print>>log,"Adding dot-uvw info to main table: %s"%self.MSName
@@ -749,6 +1209,9 @@ class ClassMS():
         DATA["lm_PhaseCenter"] = self.lm_PhaseCenter
 
         DATA["sort_index"] = sort_index
+        # per-baseline row ranges: rows of baseline i are rows[i0:i1] (see giveBaselineRows())
+        DATA["BaselineRanges"] = bl_ranges
+        DATA["BaselineRows"] = bl_rows
 
         DATA["times"] = time_all
         DATA["uniq_times"] = time_uniq   # vector of unique timestamps
@@ -759,7 +1222,13 @@ class ClassMS():
         DATA["dnu"] = self.ChanWidth
 
         if self.zero_flag and visdata is not None:
-            visdata[flags] = 1e10
+            # only the flagged rows need to be unpacked
+            rows = PackedFlags.flaggedRows(rowflags)
+            if rows.size:
+                vis_rows = visdata[rows]
+                vis_rows[PackedFlags.unpack(packed_flags, datashape[1], datashape[2], rows=rows)] = 1e10
+                visdata[rows] = vis_rows
+                del vis_rows
 
         # print "count",np.count_nonzero(flag_all),np.count_nonzero(np.isnan(vis_all))
             visdata[np.isnan(visdata)] = 0.
@@ -770,112 +1239,14 @@ class ClassMS():
 
         # save cache
         if use_cache and not metadata_valid:
-            np.savez(metadata_path,A0=A0,A1=A1,UVW=uvw,TIME=time_all,TIME_UNIQ=time_uniq,
-                     SORT_INDEX=sort_index if sort_index is not None else np.array([]),
-                     DOT_UVW=dot_uvw if dot_uvw is not None else np.array([]))
-            self.cache.saveCache("A0A1UVWT.npz")
-
-
-        # if self.AverageSteps is not None:
-        #     StepTime,StepFreq=self.AverageSteps
-        #     DATA=self.GiveAverageTimeFreq(DATA,StepTime=StepTime,StepFreq=StepFreq)
+            store.save(metadata_path, row0, row1,
+                       dict(A0=A0, A1=A1, uvw=uvw, times=time_all, uniq_times=time_uniq,
+                            sort_index=sort_index, uvw_dt=dot_uvw))
+            self.cache.saveCache("VisStore.meta")
 
         return DATA
             
 
-    def GiveAverageTimeFreq(self,DicoData,StepTime=None,StepFreq=None):
-        DicoDataOut={}
-        DicoDataOut["A0"]=DicoData["A0"]
-        DicoDataOut["A1"]=DicoData["A1"]
-        #DicoDataOut["nrows"]=DicoData["nrows"]
-        DicoDataOut["uvw"]=DicoData["uvw"]
-
-        if StepFreq is None:
-            StepFreq=1
-
-        if StepTime is None:
-            StepTime=1
-            
-        NTimesIn=(DicoData["times"][-1]-DicoData["times"][0])/DicoData["dt"]
-
-        NTimesOut=int(NTimesIn/StepTime)+1
-
-        NChanMS=self.ChanFreqOrig.size
-        NChanOut=NChanMS/StepFreq
-        
-        VisOut=np.zeros((NTimesOut,self.nbl,NChanOut,4),dtype=DicoData["data"].dtype)
-        FlagOut=np.ones((NTimesOut,self.nbl,NChanOut,4),dtype=DicoData["flag"].dtype)
-        NPointsOutChan=np.zeros((NTimesOut,self.nbl,NChanOut,4),dtype=np.int32)
-
-        UVWOut=np.zeros((NTimesOut,self.nbl,3),dtype=DicoData["uvw"].dtype)
-        TimeOut=np.zeros((NTimesOut,self.nbl),dtype=DicoData["times"].dtype)
-        A0Out=np.zeros((NTimesOut,self.nbl),dtype=DicoData["A0"].dtype)
-        A1Out=np.zeros((NTimesOut,self.nbl),dtype=DicoData["A0"].dtype)
-        NPointsOut=np.zeros((NTimesOut,self.nbl),dtype=np.int32)
-
-        blNum=np.zeros((self.na,self.na),dtype=np.int32)
-        for itime in range(NTimesOut):
-            ibl=0
-            for iA0 in range(self.na):
-                for iA1 in range(iA0,self.na):
-                    A0Out[itime,ibl]=iA0
-                    A1Out[itime,ibl]=iA1
-                    blNum[iA0,iA1]=ibl
-                    ibl+=1
-
-        T0=DicoData["times"][0]
-        
-        dtOut=self.dt*StepTime
-        nrow=DicoData["times"].size
-        for irow in range(nrow):
-            print(irow,"/",nrow)
-            ThisTime=DicoData["times"][irow]
-            iTimeOut=int((ThisTime-DicoData["times"][0])/dtOut)
-            iA0=DicoData["A0"][irow]
-            iA1=DicoData["A1"][irow]
-            ibl=blNum[iA0,iA1]
-
-            A0Out[iTimeOut,ibl]=iA0
-            A1Out[iTimeOut,ibl]=iA1
-            TimeOut[iTimeOut,ibl]+=ThisTime
-            UVWOut[iTimeOut,ibl,:]+=DicoData["uvw"][irow,:]
-            NPointsOut[iTimeOut,ibl]+=1
-
-            for ichan in range(NChanMS):
-                ichanOut=int(ichan/StepFreq)
-                V4=DicoData["data"][irow,ichan,:].copy()
-                F4=DicoData["flag"][irow,ichan,:].copy()
-                AllFlagged=(np.count_nonzero(F4)==F4.size)
-                if not(AllFlagged):
-                    V4[F4==1]=0.
-                    VisOut[iTimeOut,ibl,ichanOut,:]+=V4[:]
-                    FlagOut[iTimeOut,ibl,ichanOut,:]=0
-                    NPointsOutChan[iTimeOut,ibl,ichanOut,:]+=1
-
-        VisOut/=NPointsOutChan
-        
-        TimeOut/=NPointsOut
-        UVWOut/=NPointsOut.reshape((NTimesOut,self.nbl,1))
-
-
-        NRowOut=NTimesOut*self.nbl
-        DATA={}
-        ind=np.where(TimeOut!=0.)[0]
-
-        
-        DATA["uvw"]=(UVWOut.reshape((NRowOut,3))[ind]).copy()
-        DATA["times"]=(TimeOut.reshape((NRowOut,))[ind]).copy()
-        DATA["nrows"]=TimeOut.shape[0]
-        DATA["A0"]=(A0Out.reshape((NRowOut,))[ind]).copy()
-        DATA["A1"]=(A1Out.reshape((NRowOut,))[ind]).copy()
-        DATA["dt"]=self.dt*StepTime
-        DATA["dnu"]=np.ones((NChanOut,),np.float32)*(self.ChanWidth[0])
-        
-        
-        DATA["data"]=(VisOut.reshape((NRowOut,NChanOut,4))[ind]).copy()
-        DATA["flags"]=(FlagOut.reshape((NRowOut,NChanOut,4))[ind]).copy()
-        return DATA
-
     def SaveAllDataStruct(self):
         t=self.GiveMainTable(readonly=False)
 
@@ -919,12 +1290,40 @@ class ClassMS():
     # static member caching DDID/FIELD_ID lookups
     _ddid_field_cache = {}
 
-    def ReadMSInfo(self,first_ms=None,DoPrint=True):
-        """radec_first: ra/dec of first MS, if available"""
-        T= ClassTimeIt.ClassTimeIt()
-        T.enableIncr()
-        T.disable()
+    # subtables whose contents go into the metadata snapshot (see giveMSSnapshot())
+    _snapshot_subtables = ("ANTENNA", "DATA_DESCRIPTION", "POLARIZATION", "SPECTRAL_WINDOW", "FIELD")
 
+    def giveMSSnapshot(self):
+        """
+        Returns a dict of the MS metadata needed by ReadMSInfo(): antenna names and positions, channel frequencies
+        and widths, correlation types, time slots, row counts and phase centre. If --Cache-MSInfo is enabled, this
+        is kept in the maincache, validated by the modification times of the main table and the relevant subtables,
+        and by the row count of the main table, so that repeat runs only need to open the main table, to count its
+        rows, and don't need to query any subtables.
+        """
+        if not self.GD["Cache"]["MSInfo"]:
+            return self._readMSSnapshot()
+        mtimes = [ os.path.getmtime(os.path.join(self.MSName, subtable, "table.dat"))
+                   for subtable in ("",) + self._snapshot_subtables ]
+        maintab = table(self.MSName, ack=False)
+        nrows = maintab.nrows()
+        maintab.close()
+        path, valid = self.maincache.checkCache("MSInfo", dict(TaQL=self.TaQL, mtimes=mtimes, nrows=nrows))
+        if valid:
+            try:
+                info = cPickle.load(open(path, "rb"))
+                print("using cached metadata for %s" % self.MSName, file=log)
+                return info
+            except Exception as exc:
+                print("metadata snapshot %s can't be read (%s), will re-make" % (path, exc), file=log)
+        info = self._readMSSnapshot()
+        cPickle.dump(info, open(path, "wb"), 2)
+        self.maincache.saveCache("MSInfo")
+        return info
+
+    def _readMSSnapshot(self):
+        """Helper method: reads the metadata snapshot (see giveMSSnapshot()) from the MS tables"""
+        info = dict(empty=True)
         # quick check if DDID and FieldId is present at all. This is much faster than running a full query
         # (which GiveMainTable() does), helps when many MSs are specified, many of them missing DDIDs
         if self.MSName in ClassMS._ddid_field_cache:
@@ -933,38 +1332,75 @@ class ClassMS():
             maintab = table(self.MSName, ack=False)
             ddid_fields = set(zip(maintab.getcol("FIELD_ID"), maintab.getcol("DATA_DESC_ID")))
             ClassMS._ddid_field_cache[self.MSName] = ddid_fields
-
-        self.empty = (self.Field,self.DDID) not in ddid_fields
-        if self.empty:
-            print(ModColor.Str("MS %s (field %d, ddid %d): no rows, skipping"%(self.MSName, self.Field, self.DDID)), file=log)
-            return
+        if (self.Field,self.DDID) not in ddid_fields:
+            return info
 
         # open main table
         table_all = self.GiveMainTable()
-        self.empty = not table_all.nrows()
+        info["nrows"] = table_all.nrows()
+        if not info["nrows"]:
+            table_all.close()
+            return info
+        info["empty"] = False
+
+        ta=table(table_all.getkeyword('ANTENNA'),ack=False)
+        info["StationNames"] = ta.getcol('NAME')
+        info["StationPos"] = ta.getcol('POSITION')
+        ta.close()
+
+        # get spectral window and polarization id
+        ta_ddid = table(table_all.getkeyword('DATA_DESCRIPTION'),ack=False)
+        info["spwid"] = spwid = ta_ddid.getcol("SPECTRAL_WINDOW_ID")[self.DDID]
+        polid = ta_ddid.getcol("POLARIZATION_ID")[self.DDID]
+        ta_ddid.close()
+
+        tp = table(table_all.getkeyword('POLARIZATION'),ack=False)
+        info["CorrelationIds"] = tp.getcol('CORR_TYPE',polid,1)[0]
+        tp.close()
+
+        ta_spectral=table(table_all.getkeyword('SPECTRAL_WINDOW'),ack=False)
+        info["NSPW"] = ta_spectral.nrows()
+        info["reffreq"] = ta_spectral.getcol('REF_FREQUENCY')[spwid]
+        info["chan_freq"] = ta_spectral.getcol('CHAN_FREQ')[spwid,:]
+        info["chan_width"] = ta_spectral.getcol('CHAN_WIDTH')[spwid,:]
+        ta_spectral.close()
+
+        ta=table(table_all.getkeyword('FIELD'),ack=False)
+        info["phase_dir"] = ta.getcol('PHASE_DIR')[self.Field][0]
+        ta.close()
+
+        info["ColNames"] = table_all.colnames()
+        info["dt"] = table_all.getcol('INTERVAL',0,1)[0]
+        # unique time slots, and their starting rows (used for chunking, see _makeChunkMapping())
+        all_times = table_all.getcol("TIME")
+        info["slot_times"], info["slot_row0"] = np.unique(all_times, return_index=True)
+        info["time_ordered"] = bool((all_times[1:] >= all_times[:-1]).all())
+        table_all.close()
+        return info
+
+    def ReadMSInfo(self,first_ms=None,DoPrint=True):
+        """radec_first: ra/dec of first MS, if available"""
+        T= ClassTimeIt.ClassTimeIt()
+        T.enableIncr()
+        T.disable()
+
+        info = self.giveMSSnapshot()
+        self.empty = info["empty"]
         if self.empty:
             print(ModColor.Str("MS %s (field %d, ddid %d): no rows, skipping"%(self.MSName, self.Field, self.DDID)), file=log)
             return
 #            raise RuntimeError,"no rows in MS %s, check your Field/DDID/TaQL settings"%(self.MSName)
 
-        #print MSname+'/ANTENNA'
-        ta=table(table_all.getkeyword('ANTENNA'),ack=False)
-
-        StationNames=ta.getcol('NAME')
+        StationNames=info["StationNames"]
 
-        na=ta.getcol('POSITION').shape[0]
-        self.StationPos=ta.getcol('POSITION')
+        na=info["StationPos"].shape[0]
+        self.StationPos=info["StationPos"]
         nbl=(na*(na-1))/2+na
         #nbl=(na*(na-1))/2
-        ta.close()
         T.timeit()
 
-        # get spectral window and polarization id
-        ta_ddid = table(table_all.getkeyword('DATA_DESCRIPTION'),ack=False)
-        self._spwid = ta_ddid.getcol("SPECTRAL_WINDOW_ID")[self.DDID]
-        self._polid = ta_ddid.getcol("POLARIZATION_ID")[self.DDID]
-        ta_ddid.close()
-
+        # get spectral window id
+        self._spwid = info["spwid"]
 
         # get polarizations
         # This a list of the Stokes enums (as defined in casacore header measures/Stokes.h)
@@ -973,90 +1409,29 @@ class ClassMS():
         MS_STOKES_ENUMS = [
             "Undefined", "I", "Q", "U", "V", "RR", "RL", "LR", "LL", "XX", "XY", "YX", "YY", "RX", "RY", "LX", "LY", "XR", "XL", "YR", "YL", "PP", "PQ", "QP", "QQ", "RCircular", "LCircular", "Linear", "Ptotal", "Plinear", "PFtotal", "PFlinear", "Pangle"
           ]
-        tp = table(table_all.getkeyword('POLARIZATION'),ack=False)
         # get list of corrype enums for first row of polarization table, and convert to strings via MS_STOKES_ENUMS. 
         # self.CorrelationNames will be a list of strings
-        self.CorrelationIds = tp.getcol('CORR_TYPE',self._polid,1)[0]
+        self.CorrelationIds = info["CorrelationIds"]
         self.CorrelationNames = [ (ctype >= 0 and ctype < len(MS_STOKES_ENUMS) and MS_STOKES_ENUMS[ctype]) or
                 None for ctype in self.CorrelationIds ]
         self.Ncorr = len(self.CorrelationNames)
         # NB: it is possible for the MS to have different polarization
 
-        self.ColNames=table_all.colnames()
-        self.F_nrows=table_all.nrows()#-nbl
+        self.ColNames=info["ColNames"]
+        self.F_nrows=info["nrows"]
 
-        # make mapping into chunks
-        if not self.TimeChunkSize:
-            T0=table_all.getcol('TIME',0,1)[0]
-            T1=table_all.getcol('TIME',self.F_nrows-1,1)[0]
-            print("--Data-ChunkHours is null: MS %s (%d rows) column %s will be processed as a single chunk"%(self.MSName, self.F_nrows, self.ColName), file=log)
-            chunk_row0 = [0]
-        else:
-            all_times = table_all.getcol("TIME")
-            if (all_times[1:] - all_times[:-1]).min() < 0:
-                raise RuntimeError("MS %s: the TIME column must be in increasing order"%self.MSName)
-            T0, T1 = all_times[0], all_times[-1]
-            chunk_t0 = np.arange(T0, T1, self.TimeChunkSize*3600)
-            # chunk_t0 now gives starting time of each chunk
-            chunk_row0 = [ np.argmax(all_times>=ch_t0) for ch_t0 in chunk_t0 ]
-            # ensure there is no duplicate starting rows
-            chunk_row0 = sorted(set(chunk_row0))
-            # chunk_row0 gives the starting row of each chunk
-            if len(chunk_row0) == 1:
-                print("MS %s DDID %d FIELD %d (%d rows) column %s will be processed as a single chunk"%(self.MSName, self.DDID, self.Field, self.F_nrows, self.ColName), file=log)
-            else:
-                print("MS %s DDID %d FIELD %d (%d rows) column %s will be split into %d chunks, at rows %s"%(self.MSName, self.DDID, self.Field,  self.F_nrows,
-                                                                                       self.ColName, len(chunk_row0), " ".join(map(str,chunk_row0))), file=log)
-        self.Nchunk = len(chunk_row0)
-        chunk_row0.append(self.F_nrows)
-        self._chunk_r0r1 = [ chunk_row0[i:i+2] for i in range(self.Nchunk) ]
-
-        # init the per-chunk caches
-        for row0, row1 in self._chunk_r0r1:
-            # note that we don't need to reset the chunk cache -- the top-level MS cache would already have been reset,
-            # being the parent directory
-            self._chunk_caches[row0, row1] = CacheManager(
-                os.path.join(self.maincache.dirname, "R%d:%d" % (row0, row1)),
-                reset=False)
-
-        #SPW=table_all.getcol('DATA_DESC_ID')
-        # if self.SelectSPW is not None:
-        #     self.ListSPW=self.SelectSPW
-        #     #print "dosel"
-        # else:
-        #     self.ListSPW=sorted(list(set(SPW.tolist())))
-        # T.timeit()
-
-        #self.F_nrows=table_all.getcol("TIME").shape[0]
-        #F_time_all=table_all.getcol("TIME")[SPW==self.ListSPW[0]]
-
-        #self.F_A0=table_all.getcol("ANTENNA1")[SPW==self.ListSPW[0]]
-        #self.F_A1=table_all.getcol("ANTENNA2")[SPW==self.ListSPW[0]]
-
-        #nbl=(np.where(F_time_all==F_time_all[0])[0]).shape[0]
-        T.timeit()
-
-        #F_time_slots_all=np.array(sorted(list(set(F_time_all.tolist()))))
-        #F_ntimes=F_time_slots_all.shape[0]
-        dt=table_all.getcol('INTERVAL',0,1)[0]
+        dt=info["dt"]
 
         T.timeit()
 
-        ta_spectral=table(table_all.getkeyword('SPECTRAL_WINDOW'),ack=False)
-        NSPW = ta_spectral.nrows()
-        reffreq=ta_spectral.getcol('REF_FREQUENCY')[self._spwid]
-        orig_freq = ta_spectral.getcol('CHAN_FREQ')[self._spwid,:] 
+        NSPW = info["NSPW"]
+        reffreq=info["reffreq"]
+        orig_freq = info["chan_freq"]
         chan_freq = orig_freq[self.ChanSlice]
 
 
-        self.dFreq = ta_spectral.getcol("CHAN_WIDTH")[self._spwid,self.ChanSlice].flatten()[0]
-        self.ChanWidth = np.abs(ta_spectral.getcol('CHAN_WIDTH')[self._spwid,self.ChanSlice])
-
-        # if chan_freq.shape[0]>len(self.ListSPW):
-        #     print ModColor.Str("  ====================== >> More SPW in headers, modifying that error....")
-        #     chan_freq=chan_freq[np.array(self.ListSPW),:]
-        #     reffreq=reffreq[np.array(self.ListSPW)]
-            
+        self.dFreq = info["chan_width"][self.ChanSlice].flatten()[0]
+        self.ChanWidth = np.abs(info["chan_width"][self.ChanSlice])
 
         T.timeit()
 
@@ -1065,18 +1440,24 @@ class ClassMS():
         self.Freq_Mean=np.mean(chan_freq)
         wavelength_chan=299792458./chan_freq
 
-        # # read UVW column to get max |W| and max uv (useful for weighting later)
-        # uvw = table_all.getcol("UVW")
-        # self.uv = uvw[:2]
-        # self.maxW = abs(uvw[:3]).max()
-        # self.maxUV_wavelengths = abs(uvw).max() / min(wavelength_chan)
-
         #if NSPW>1:
         #    print "Don't deal with multiple SPW yet"
 
         self.Nchan = Nchan = len(wavelength_chan)
         NSPWChan=NSPW*Nchan
 
+        # make mapping into chunks
+        self.na = na
+        T0, T1 = self._makeChunkMapping(info, dt)
+
+        # init the per-chunk caches
+        for row0, row1 in self._chunk_r0r1:
+            # note that we don't need to reset the chunk cache -- the top-level MS cache would already have been reset,
+            # being the parent directory
+            self._chunk_caches[row0, row1] = CacheManager(
+                os.path.join(self.maincache.dirname, "R%d:%d" % (row0, row1)),
+                reset=False)
+
         # set up cs_tlc,cd_brc,cs_inc: these are pyrap-style slice selection arguments
         # to select the [subset] of the column
         if self.ChanSlice is not None:
@@ -1089,11 +1470,9 @@ class ClassMS():
             self.cs_brc = (self.Nchan - 1, self.Ncorr - 1)
             self.cs_inc = (1, 1)
 
-        ta=table(table_all.getkeyword('FIELD'),ack=False)
-        rarad,decrad=ta.getcol('PHASE_DIR')[self.Field][0]
+        rarad,decrad=info["phase_dir"]
         if rarad<0.: rarad+=2.*np.pi
         self.OriginalRadec = self.OldRadec = rarad,decrad
-
         if self.ToRADEC is not None:
             ranew, decnew = rarad, decrad
             # get RA/Dec from first MS, or else parse as coordinate string
@@ -1121,7 +1500,6 @@ class ClassMS():
 
         self.radeg=rarad*180./np.pi
         self.decdeg=decrad*180./np.pi
-        ta.close()
          
         self._reverse_channel_order = Nchan>1 and self.ChanFreq[0] > self.ChanFreq[-1]
         if self._reverse_channel_order:
@@ -1130,23 +1508,18 @@ class ClassMS():
             self.ChanFreq = self.ChanFreq[::-1]
             self.dFreq = np.abs(self.dFreq)
 
-        # if self.AverageSteps is not None:
-        #     _,StepFreq=self.AverageSteps
-        #     NChanOut=self.ChanFreq.size/StepFreq
-        #     NChanMS=self.ChanFreq.size
-        #     if (self.ChanFreq.size%StepFreq!=0):
-        #         raise NameError('Number of channels should be a multiple of d_channels')
-        #     ChanFreq=np.zeros((NChanOut,),self.ChanFreq.dtype)
-        #     ChanFreqPoint=np.zeros((NChanOut,),self.ChanFreq.dtype)
-        #     for ichan in range(NChanMS):
-        #         ichanOut=int(ichan/StepFreq)
-        #         ChanFreq[ichanOut]+=self.ChanFreq.ravel()[ichan]
-        #         ChanFreqPoint+=1
-        #     ChanFreq/=ChanFreqPoint
-        #     self.ChanFreq=ChanFreq.reshape((1,NChanOut))
-        #     self.dFreq*=StepFreq
-        #     chan_freq=self.ChanFreq
-
+        # channels are read from the MS at full resolution (ReadNchan of them), and pre-averaged in groups starting
+        # at _avg_chan_starts. From here on, the MS then looks like an averaged MS
+        self.ReadNchan = Nchan
+        self._avg_chan_starts = None
+        if self.AverageSteps is not None and self.AverageSteps[1] > 1:
+            self._avg_chan_starts = starts = np.arange(0, Nchan, self.AverageSteps[1])
+            self.ChanFreq = np.add.reduceat(self.ChanFreq, starts) / np.diff(np.append(starts, Nchan))
+            self.ChanWidth = np.add.reduceat(self.ChanWidth.ravel(), starts)
+            self.dFreq *= self.AverageSteps[1]
+            wavelength_chan = 299792458./self.ChanFreq
+            Nchan = len(self.ChanFreq)
+            print("MS %s: %d channels will be pre-averaged into %d" % (self.MSName, self.ReadNchan, Nchan), file=log)
 
         T.timeit()
 
@@ -1174,9 +1547,12 @@ class ClassMS():
         self.StrRA  = rad2hmsdms(self.rarad,Type="ra").replace(" ",":")
         self.StrDEC = rad2hmsdms(self.decrad,Type="dec").replace(" ",".")
         self.lm_PhaseCenter=self.radec2lm_scalar(self.OldRadec[0],self.OldRadec[1])
-        self.ColNames=table_all.colnames()
-        table_all.close()
         T.timeit()
+
+        # init the columnar chunk store, if caching of visibilities is enabled
+        if self.GD["Cache"]["VisData"] not in (None, "off"):
+            self._chunk_store = ClassChunkStore(self.maincache, "VisData.store", self._chunk_r0r1,
+                                                len(self.ChanFreq), self.Ncorr)
         # self.StrRADEC=(rad2hmsdms(self.rarad,Type="ra").replace(" ",":")\
         #                ,rad2hmsdms(self.decrad,Type="dec").replace(" ","."))
 
@@ -1188,8 +1564,6 @@ class ClassMS():
         """
         print("Updating flags", file=log)
 
-        ThresholdFlag = 0.9 # flag antennas with % of flags over threshold
-
         # flag autocorrelations
         # print>>log,"  flagging autocorrelations"
         flags[A0==A1] = True
@@ -1204,7 +1578,68 @@ class ClassMS():
         flags1 = flags.any(axis=2)
         flags[flags1] = True
 
-        FlagAntNumber = set()
+        flags[self._rowSelectionFlags(uvw, A0, A1, times)] = True
+
+        # print>>log,"  forming per-antenna index"
+        # per each antenna, form up boolean mask indicating its rows
+        antenna_rows = [(A0 == A) | (A1 == A) for A in range(self.na)]
+        # print>>log,"  row index formed"
+        antenna_flagfrac = [flags1[rows].sum() / float(flags1[rows].size or 1) for rows in antenna_rows]
+
+        for A in self._antennaSelection(antenna_flagfrac):
+            flags[antenna_rows[A], :, :] = True
+        print("Flags updated", file=log)
+
+    def readFlags(self, table_all, row0, nrow, sort_index, packed_flags, rowflags, uvw, A0, A1, times, data=None,
+                  selection=None):
+        """
+        Reads the FLAG column of rows row0:row0+nrow straight into the packed flag arrays (see PackedFlags),
+        one block of rows at a time, applying the same flag selection as UpdateFlags() on the way. uvw, A0, A1
+        and times are the per-row metadata (in sorted order, if sort_index is given). If data is given, NaN
+        visibilities are flagged, and flagged visibilities are set to 1e9. If selection is given, only the
+        selected rows are read (see iterColumnBlocks()).
+        """
+        print("Updating flags", file=log)
+        nchan = len(self.ChanFreq)
+        rowsel = self._rowSelectionFlags(uvw, A0, A1, times)
+        # flagged and total (row, channel) counts per antenna, for the flagged fractions
+        antflags = np.zeros(self.na)
+        antcount = np.zeros(self.na)
+        for rows, flags in self.iterColumnBlocks(table_all, "FLAG", row0, nrow, sort_index, selection=selection):
+            if self._reverse_channel_order:
+                flags = flags[:, ::-1]
+            a0, a1 = A0[rows], A1[rows]
+            cross = a0 != a1
+            # flag autocorrelations
+            flags[~cross] = True
+            # flag NaNs
+            if data is not None:
+                vis = data[rows]
+                flags |= np.isnan(vis)
+                if flags.any():
+                    vis[flags] = 1e9
+                    data[rows] = vis
+                del vis
+            # if one of 4 correlations is flagged, flag all 4
+            flags = flags.any(axis=2)
+            nflag = flags.sum(axis=1)
+            antflags += np.bincount(a0, nflag, self.na) + np.bincount(a1, nflag*cross, self.na)
+            antcount += (np.bincount(a0, None, self.na) + np.bincount(a1, cross, self.na))*nchan
+            flags[rowsel[rows]] = True
+            PackedFlags.packInto(flags, packed_flags, rowflags, rows=rows)
+        ants = sorted(self._antennaSelection(antflags/np.maximum(antcount, 1)))
+        if ants:
+            rows = np.isin(A0, ants) | np.isin(A1, ants)
+            packed_flags[rows] = PackedFlags.pack(np.ones((1, nchan), bool))[0][0]
+            rowflags[rows] = PackedFlags.ROW_FLAGGED
+        print("Flags updated", file=log)
+
+    def _rowSelectionFlags(self, uvw, A0, A1, times):
+        """
+        Helper method: returns per-row bool array of the rows deselected by --Selection-UVRangeKm and
+        --Selection-TimeRange (see UpdateFlags())
+        """
+        sel = np.zeros(len(A0), bool)
 
         if self.DicoSelectOptions["UVRangeKm"]:
             d0, d1 = self.DicoSelectOptions["UVRangeKm"]
@@ -1212,7 +1647,7 @@ class ClassMS():
             d0 = d0**2*1e6
             d1 = d1**2*1e6
             duv = (uvw[:,:2]**2).sum(1)  # u^2+v^2... and we already squared d0 and d1
-            flags[(duv < d0) | (duv > d1),:,:] = True
+            sel |= (duv < d0) | (duv > d1)
 
         if self.DicoSelectOptions["TimeRange"]:
             st0, st1 = list(map(lambda x: dt.utcfromtimestamp(qa.quantity(x).to_unix_time()),
@@ -1221,8 +1656,16 @@ class ClassMS():
             st0, st1 = list(map(lambda x: qa.quantity(x).to_unix_time(),
                                 self.DicoSelectOptions["TimeRange"]))
             times_utc = np.array(list(map(lambda x: qa.quantity("{}s".format(x)).to_unix_time(), times)))
-            sel = np.logical_or(times_utc < st0, times_utc > st1)
-            flags[sel, :, :] = True
+            sel |= np.logical_or(times_utc < st0, times_utc > st1)
+
+        return sel
+
+    def _antennaDeselection(self, verbose=True):
+        """
+        Helper method: returns the set of antennas deselected outright: those too far from the core
+        (--Selection-DistMaxToCore), and those given by --Selection-FlagAnts
+        """
+        FlagAntNumber = set()
 
         if self.DicoSelectOptions["DistMaxToCore"]:
             DMax = self.DicoSelectOptions["DistMaxToCore"] * 1e3
@@ -1231,23 +1674,35 @@ class ClassMS():
             Dist = np.sqrt((X - Xm) ** 2 + (Y - Ym) ** 2 + (Z - Zm) ** 2)
             ind = np.where(Dist > DMax)[0]
             for iAnt in ind.tolist():
-                print("  flagging antenna #%2.2i[%s] (distance to core: %.1f km)" % (
-                iAnt, self.StationNames[iAnt], Dist[iAnt] / 1e3), file=log)
+                if verbose:
+                    print("  flagging antenna #%2.2i[%s] (distance to core: %.1f km)" % (
+                    iAnt, self.StationNames[iAnt], Dist[iAnt] / 1e3), file=log)
                 FlagAntNumber.add(iAnt)
 
-        # C0=(A0 == 7) & (A1 == 17)
-        # C1=(A1 == 7) & (A0 == 17)
-        # ind = np.where(np.logical_not(C0|C1))[0]
-        # flags[ind, :, :] = True
+        if self.DicoSelectOptions["FlagAnts"]:
+            FlagAnts = self.DicoSelectOptions["FlagAnts"]
+            if not ((FlagAnts == None) | (FlagAnts == "") | (FlagAnts == [])):
+                if type(FlagAnts) == str: FlagAnts = [FlagAnts]
+                for Name in FlagAnts:
+                    for iAnt in range(self.na):
+                        if Name in self.StationNames[iAnt]:
+                            if verbose:
+                                print("  explicitly flagging antenna #%2.2i[%s]" % (
+                                iAnt, self.StationNames[iAnt]), file=log)
+                            FlagAntNumber.add(iAnt)
 
-        # print>>log,"  forming per-antenna index"
-        # per each antenna, form up boolean mask indicating its rows
-        antenna_rows = [(A0 == A) | (A1 == A) for A in range(self.na)]
-        # print>>log,"  row index formed"
+        return FlagAntNumber
+
+    def _antennaSelection(self, antenna_flagfrac):
+        """
+        Helper method: given the flagged fraction of each antenna, returns the set of antennas to be flagged
+        entirely: those mostly flagged already, plus those deselected by _antennaDeselection() (see UpdateFlags()).
+        The latter will normally have been skipped by the row selection index already (see _initRowSelection())
+        """
+        ThresholdFlag = 0.9 # flag antennas with % of flags over threshold
+
+        FlagAntNumber = self._antennaDeselection(verbose=self._rowsel_runs is None)
 
-        
-        
-        antenna_flagfrac = [flags1[rows].sum() / float(flags1[rows].size or 1) for rows in antenna_rows]
         print("  flagged fractions per antenna: %s" % " ".join(["%.2f" % frac for frac in antenna_flagfrac]), file=log)
 
         FlagAntFrac = [ant for ant, frac in enumerate(antenna_flagfrac) if frac > ThresholdFlag]
@@ -1257,20 +1712,75 @@ class ClassMS():
             print("    antenna %i has ~%4.1f%s of flagged data (more than %4.1f%s)" % \
                          (A, antenna_flagfrac[A] * 100, "%", ThresholdFlag * 100, "%"), file=log)
 
-        if self.DicoSelectOptions["FlagAnts"]:
-            FlagAnts = self.DicoSelectOptions["FlagAnts"]
-            if not ((FlagAnts == None) | (FlagAnts == "") | (FlagAnts == [])):
-                if type(FlagAnts) == str: FlagAnts = [FlagAnts]
-                for Name in FlagAnts:
-                    for iAnt in range(self.na):
-                        if Name in self.StationNames[iAnt]:
-                            print("  explicitly flagging antenna #%2.2i[%s]" % (
-                            iAnt, self.StationNames[iAnt]), file=log)
-                            FlagAntNumber.add(iAnt)
+        return FlagAntNumber
 
-        for A in FlagAntNumber:
-            flags[antenna_rows[A], :, :] = True
-        print("Flags updated", file=log)
+    def _initRowSelection(self):
+        """
+        Forms up the row selection index of the MS. Rows deselected by --Selection-UVRangeKm, --Selection-FlagAnts
+        or --Selection-DistMaxToCore are never used, so rather than reading and flagging them, ReadData() skips them
+        altogether (see giveChunkRows()). The index is a sorted nrun x 2 array of [start,stop) runs of selected rows,
+        kept in the index cache, so the UVW column only needs to be scanned once. Sets self._rowsel_runs to None
+        if all rows are selected.
+        """
+        opts = self.DicoSelectOptions
+        self._rowsel_key = dict([(key, opts.get(key)) for key in ("UVRangeKm", "FlagAnts", "DistMaxToCore")])
+        ants = sorted(self._antennaDeselection())
+        uvrange = opts.get("UVRangeKm")
+        if uvrange:
+            d0, d1 = uvrange
+            # the range can't exclude anything if it covers all baseline lengths
+            baseline_max = np.sqrt(((self.StationPos[:, np.newaxis] - self.StationPos[np.newaxis]) ** 2).sum(-1)).max()
+            if d0 <= 0 and d1 * 1e3 >= baseline_max:
+                uvrange = None
+        if not ants and not uvrange:
+            return
+        path = None
+        if self.indexcache is not None:
+            path, valid = self.indexcache.checkCache("Selection.npz", dict(TaQL=self.TaQL, nrows=self.F_nrows,
+                                                                           selection=self._rowsel_key))
+            if valid:
+                self._rowsel_runs = np.load(path)["runs"]
+                print("  loaded row selection index (%d rows selected in %d runs)" % (
+                    (self._rowsel_runs[:, 1] - self._rowsel_runs[:, 0]).sum(), len(self._rowsel_runs)), file=log)
+                return
+        t0 = time.time()
+        table_all = self.GiveMainTable()
+        selected = np.ones(self.F_nrows, bool)
+        blockrows = max(1, self.ReadBlockBytes // 64)
+        for row0 in range(0, self.F_nrows, blockrows):
+            nrow = min(blockrows, self.F_nrows - row0)
+            sel = selected[row0:row0 + nrow]
+            if ants:
+                sel &= ~np.isin(table_all.getcol("ANTENNA1", row0, nrow), ants)
+                sel &= ~np.isin(table_all.getcol("ANTENNA2", row0, nrow), ants)
+            if uvrange:
+                duv = (table_all.getcol("UVW", row0, nrow)[:, :2] ** 2).sum(1)
+                sel &= (duv >= d0 ** 2 * 1e6) & (duv <= d1 ** 2 * 1e6)
+        table_all.close()
+        # runs of selected rows
+        edges = np.diff(np.concatenate(([0], selected.astype(np.int8), [0])))
+        self._rowsel_runs = np.array([np.where(edges == 1)[0], np.where(edges == -1)[0]]).T
+        print("  row selection index: %d of %d rows selected in %d runs (%.1fs)" % (
+            selected.sum(), self.F_nrows, len(self._rowsel_runs), time.time() - t0), file=log)
+        if path is not None:
+            np.savez(path, runs=self._rowsel_runs)
+            self.indexcache.saveCache("Selection.npz")
+
+    def giveChunkRows(self, row0, row1):
+        """
+        Returns the selected rows of chunk row0:row1 (see _initRowSelection()), as an array of row offsets
+        relative to row0, or None if all rows are selected.
+        """
+        runs = self._rowsel_runs
+        if runs is None:
+            return None
+        i0, i1 = np.searchsorted(runs[:, 1], row0, side="right"), np.searchsorted(runs[:, 0], row1)
+        starts = np.clip(runs[i0:i1, 0], row0, row1)
+        stops = np.clip(runs[i0:i1, 1], row0, row1)
+        lengths = stops - starts
+        # row offset = start of run + position within run
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.repeat(starts - row0, lengths) + offsets
 
     def __str__(self):
         ll=[]
@@ -1308,48 +1818,80 @@ class ClassMS():
 
 
     def PutVisColumn(self, colname, vis, row0, row1, likecol="DATA", sort_index=None):
-        self.AddCol(colname, LikeCol=likecol, quiet=True)
+        self.PutVisColumns([(colname, vis, likecol)], row0, row1, sort_index=sort_index)
+
+    def PutVisColumns(self, columns, row0, row1, sort_index=None):
+        """
+        Writes several columns of rows row0:row1 in a single pass over the table.
+
+        Args:
+            columns: list of (colname, array, likecol) tuples. Arrays are nrow x nchan [x ncorr]
+            sort_index: if not None, arrays are in sorted order (see ReadData()), and are put back into MS order
+                one block of rows at a time, so that no full-size copy is made
+
+        If the row selection index skips some rows of the chunk (see giveChunkRows()), arrays only contain the
+        selected rows, and deselected rows are left untouched in the MS.
+        """
+        if self.AverageSteps is not None:
+            raise RuntimeError("MS %s is pre-averaged (see --Data-AverageTime/--Data-AverageFreq): can't write column(s) %s"%(
+                self.MSName, ", ".join([col[0] for col in columns])))
+        for colname, vis, likecol in columns:
+            self.AddCol(colname, LikeCol=likecol, quiet=True)
+            if vis.ndim == 2 and likecol != "IMAGING_WEIGHT":
+                import warnings
+                warnings.warn("Your dataset does not conform to NRAO MS v2 specification (memo 229) and only "
+                              "contains 2D axis. We will assume this means nrow x nchan x (ncorr == 1). "
+                              "Please notify your observatory of this issue.")
         nrow = row1 - row0
+        print("writing column(s) %s rows %d:%d"%(", ".join([col[0] for col in columns]), row0, row1), file=log)
         if self._reverse_channel_order:
-            vis = vis[:,::-1,...]
-        print("writing column %s rows %d:%d"%(colname,row0,row1), file=log)
-        t = self.GiveMainTable(readonly=False, ack=False)
-
-        # if sorting rows, rearrange vis array back into MS order
-        # if not sorting, then using slice(None) for row has no effect
+            columns = [ (colname, vis[:,::-1,...], likecol) for colname, vis, likecol in columns ]
+        selection = self.giveChunkRows(row0, row1)
+        nsel = nrow if selection is None else len(selection)
+        # if sorting rows, rows of MS block r0:r1 are found at reverse_index[r0:r1] of the arrays
         if sort_index is not None:
-            reverse_index = np.empty(nrow,dtype=int)
-            reverse_index[sort_index] = np.arange(0,nrow,dtype=int)
-        else:
-            reverse_index = slice(None)
-        if self.ChanSlice and self.ChanSlice != slice(None):
-            # if getcol fails, maybe because this is a new col which hasn't been filled
-            # in this case read DATA instead
-            try:
-                vis0 = t.getcol(colname, row0, nrow)
-            except RuntimeError:
-                vis0 = t.getcol("DATA", row0, nrow)
-            vis0[:, self.ChanSlice, ...] = vis[reverse_index, :, ...]
-            t.putcol(colname, vis0, row0, nrow)
+            reverse_index = np.empty(nsel, dtype=np.int64)
+            reverse_index[sort_index] = np.arange(0, nsel, dtype=np.int64)
         else:
-            if sort_index is None:
-                vis0 = vis
-            else:
-                if len(vis.shape)==3:
-                    vis0 = np.zeros((nrow,vis.shape[1],vis.shape[2]),vis.dtype)
-                elif len(vis.shape)==2:
-                    import warnings
-                    warnings.warn("Your dataset does not conform to NRAO MS v2 specification (memo 229) and only "
-                                  "contains 2D axis. We will assume this means nrow x nchan x (ncorr == 1). "
-                                  "Please notify your observatory of this issue.")
-                    vis0 = np.zeros((nrow,vis.shape[1]),vis.dtype)
-                    
-                vis0[sort_index,...] = vis
-            t.putcol(colname, vis0, row0, nrow)
-        t.close()
-
+            reverse_index = None
+        # with a row selection, reverse_index covers all MS rows, and is -1 for deselected ones
+        if selection is not None:
+            full_index = np.full(nrow, -1, dtype=np.int64)
+            full_index[selection] = reverse_index if reverse_index is not None else np.arange(nsel)
+            reverse_index = full_index
+        chanslice = self.ChanSlice if self.ChanSlice and self.ChanSlice != slice(None) else None
+        rowbytes = max([ vis[0:1].nbytes for _, vis, _ in columns ] + [1])
+        nrow_block = max(self.ReadBlockBytes // rowbytes, 1)
+        t = self.GiveMainTable(readonly=False, ack=False)
+        try:
+            for r0 in range(0, nrow, nrow_block):
+                r1 = min(r0 + nrow_block, nrow)
+                rows = reverse_index[r0:r1] if reverse_index is not None else None
+                if selection is not None:
+                    rowsel = rows >= 0
+                    if not rowsel.any():
+                        continue
+                    partial = not rowsel.all()
+                else:
+                    partial = False
+                for colname, vis, likecol in columns:
+                    block = vis[rows] if rows is not None else vis[r0:r1]
+                    if chanslice is not None or partial:
+                        # if getcol fails, maybe because this is a new col which hasn't been filled
+                        # in this case read DATA (or the template column) instead
+                        try:
+                            vis0 = t.getcol(colname, row0+r0, r1-r0)
+                        except RuntimeError:
+                            vis0 = t.getcol("DATA" if chanslice is not None else likecol, row0+r0, r1-r0)
+                        if partial:
+                            vis0[rowsel, chanslice or slice(None), ...] = block[rowsel]
+                        else:
+                            vis0[:, chanslice, ...] = block
+                        block = vis0
+                    t.putcol(colname, np.ascontiguousarray(block), row0+r0, r1-r0)
+        finally:
+            t.close()
 
-        
     def SaveVis(self,vis=None,Col="CORRECTED_DATA",spw=0,DoPrint=True):
         if vis is None:
             vis=self.data
@@ -1576,28 +2118,60 @@ class ClassMS():
         #self.PutNewCol("CORRECTED_DATA")
         #self.PutNewCol("MODEL_DATA")
 
-    def ComputeDotUVW (self, A0, A1, times, UVW):
-        na = self.na
+    def ComputeDotUVW (self, A0, A1, times, UVW, bl_ranges=None, bl_rows=None):
+        """
+        Computes d(UVW)/dt per row, by finite differences along each baseline. bl_ranges and bl_rows give
+        the rows of each baseline (as in DATA["BaselineRanges"] and DATA["BaselineRows"]). If not given,
+        they're worked out here. Autocorrelations and single-row baselines get zero derivatives.
+        """
+        if bl_ranges is None:
+            bl_rows = self.giveSortIndex(A0, A1, times)
+            bl_ranges = self.giveBaselineRanges(A0[bl_rows], A1[bl_rows])
         UVW_dt = np.zeros(UVW.shape, np.float64)
-        pBAR = ProgressBar(Title=" Calc dUVW/dt ")
-        pBAR.render(0, na)
-        for ant0 in range(na):
-            for ant1 in range(ant0+1, na):
-                C0 = ((A0 == ant0) & (A1 == ant1))
-                C1 = ((A1 == ant0) & (A0 == ant1))
-                ind = np.where(C0 | C1)[0]
-                if not ind.size:
-                    continue
-                UVWs = UVW[ind]
-                timess = times[ind]
-                dtimess = timess[1::] - timess[0:-1]
-                UVWs_dt0 = (UVWs[1::] - UVWs[0:-1]) / dtimess.reshape((-1, 1))
-                UVW_dt[ind[0:-1]] = UVWs_dt0
-                UVW_dt[ind[-1]] = UVWs_dt0[-1]
-            intPercent = int(100 * (ant0 + 1) / float(na))
-            pBAR.render(ant0 + 1, na)
+        if not len(bl_ranges):
+            return UVW_dt
+        # work in baseline-time order
+        uvw = UVW if bl_rows is None else UVW[bl_rows]
+        tt = times if bl_rows is None else times[bl_rows]
+        dt = tt[1:] - tt[:-1]
+        dt[dt == 0] = np.inf    # no derivative across duplicate timestamps
+        dudt = np.zeros(uvw.shape, np.float64)
+        # forward differences (this also produces junk across baseline boundaries, which is fixed up below)
+        dudt[:-1] = (uvw[1:] - uvw[:-1]) / dt[:, np.newaxis]
+        a0, a1, i0, i1 = bl_ranges.T
+        # last row of each baseline takes the derivative of the previous row
+        multi = i1 - i0 > 1
+        dudt[i1[multi] - 1] = dudt[i1[multi] - 2]
+        # zero autocorrelations and single-row baselines
+        nulls = (a0 == a1) | ~multi
+        if nulls.any():
+            lens = (i1 - i0)[nulls]
+            dudt[np.repeat(i0[nulls] - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())] = 0
+        if bl_rows is None:
+            UVW_dt[...] = dudt
+        else:
+            UVW_dt[bl_rows] = dudt
         return UVW_dt
 
+    def giveDotUVW (self, A0, A1, times, UVW, bl_ranges=None, bl_rows=None):
+        """
+        Returns d(UVW)/dt per row of the current chunk (see ComputeDotUVW()). If --Cache-DotUVW is set,
+        this is cached in the chunk cache.
+        """
+        if not self.GD["Cache"]["DotUVW"]:
+            return self.ComputeDotUVW(A0, A1, times, UVW, bl_ranges=bl_ranges, bl_rows=bl_rows)
+        path, valid = self.cache.checkCache("DotUVW.npy", dict(TaQL=self.TaQL, nrows=self.F_nrows,
+                                                                sorted=bl_rows is None, ToRADEC=self.ToRADEC,
+                                                                average=self.AverageSteps, selection=self._rowsel_key))
+        if valid:
+            dot_uvw = np.load(path)
+            if dot_uvw.shape == UVW.shape:
+                return dot_uvw
+        dot_uvw = self.ComputeDotUVW(A0, A1, times, UVW, bl_ranges=bl_ranges, bl_rows=bl_rows)
+        np.save(path, dot_uvw)
+        self.cache.saveCache("DotUVW.npy")
+        return dot_uvw
+
     def AddUVW_dt(self):
         print("Compute UVW speed column", file=log)
         MSName=self.MSName
@@ -1607,41 +2181,15 @@ class ClassMS():
         A0=t.getcol("ANTENNA1")
         A1=t.getcol("ANTENNA2")
         UVW=t.getcol("UVW")
-        UVW_dt=np.zeros_like(UVW)
         if "UVWDT" not in t.colnames():
             print("Adding column UVWDT in %s"%self.MSName, file=log)
             desc=t.getcoldesc("UVW")
             desc["name"]="UVWDT"
             desc['comment']=desc['comment'].replace(" ","_")
             t.addcols(desc)
-        
-        # # #######################
-        # LTimes=np.sort(np.unique(times))
-        # for iTime,ThisTime in enumerate(LTimes):
-        #     print iTime,LTimes.size
-        #     ind=np.where(times==ThisTime)[0]
-        #     UVW_dt[ind]=MS.Give_dUVW_dt(times[ind],A0[ind],A1[ind])
-        # # #######################
-        
-        na=MS.na
-        pBAR= ProgressBar(Title=" Calc dUVW/dt ")
-        pBAR.render(0,na)
-        for ant0 in range(na):
-            for ant1 in range(ant0,MS.na):
-                if ant0==ant1: continue
-                C0=((A0==ant0)&(A1==ant1))
-                C1=((A1==ant0)&(A0==ant1))
-                ind=np.where(C0|C1)[0]
-                UVWs=UVW[ind]
-                timess=times[ind]
-                dtimess=timess[1::]-timess[0:-1]
-                UVWs_dt0=(UVWs[1::]-UVWs[0:-1])/dtimess.reshape((-1,1))
-                UVW_dt[ind[0:-1]]=UVWs_dt0
-                UVW_dt[ind[-1]]=UVWs_dt0[-1]
-            intPercent = int(100 * (ant0+1) / float(na))
-            pBAR.render(ant0+1, na)
-                    
-    
+
+        UVW_dt = MS.ComputeDotUVW(A0, A1, times, UVW).astype(UVW.dtype)
+
         print("Writing in column UVWDT", file=log)
         t.putcol("UVWDT",UVW_dt)
         t.close()
@@ -34,23 +34,33 @@ log = logger.getLogger("ClassSmearMapping")
 from DDFacet.Other import Multiprocessing, ClassTimeIt
 from DDFacet.Array import shared_dict
 from DDFacet.Other.AsyncProcessPool import APP
+from DDFacet.Data.ClassMS import ClassMS
 
 bda_dicts = {}
 
+# first word of a run-length BDA mapping. Row-list mappings start with the number of blocks instead. See
+# SmearMappingMachine._collectRangeMapping() and Gridder/BDAMapping.h
+RunLengthTag = -1
+
 class SmearMappingMachine (object):
     def __init__ (self, name=None, mode=2):
         self.name = name or "SMM.%x"%id(self)
         APP.registerJobHandlers(self)
-        self._job_counter = APP.createJobCounter(self.name)
+        # one job counter per I/O process, since chunks may be loaded (and mapped) by several I/O processes
+        # concurrently, and each should only wait for its own jobs
+        self._job_counters = [ APP.createJobCounter("%s:io%02d" % (self.name, i))
+                               for i in range(APP.num_io_processes) ]
         self._data = self._blockdict = self._sizedict = None
 
-    def _smearmapping_worker(self, DATA, blockdict, sizedict, a0, a1, dPhi, l, channel_mapping, mode):
+    def _smearmapping_worker(self, DATA, blockdict, sizedict, ibl, dPhi, l, channel_mapping, mode):
         t = ClassTimeIt.ClassTimeIt()
         t.disable()
+        a0, a1 = DATA["BaselineRanges"][ibl, :2]
+        row_index = ClassMS.giveBaselineRows(DATA, ibl)
         if mode == 1:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping)
+            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping, row_index=row_index)
         elif mode == 2:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
+            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping, row_index=row_index)
         else:
             raise ValueError("unknown BDAMode setting %d"%mode)
 
@@ -61,27 +71,111 @@ class SmearMappingMachine (object):
             blockdict[key] = np.array(BlocksRowsListBL)
             t.timeit('store')
 
-    def computeSmearMappingInBackground (self, base_job_id, MS, DATA, radiusDeg, Decorr, channel_mapping, mode):
+    def _timeblocks_worker(self, DATA, outdict, ijob, ibl0, ibl1, dPhi, l):
+        rows, block_len, fracmin = GiveTimeBlocksBaselines(DATA, ibl0, ibl1, dPhi, l)
+        outdict["rows:%d" % ijob] = rows
+        outdict["blocklen:%d" % ijob] = block_len
+        outdict["fracmin:%d" % ijob] = fracmin
+
+    # BDAMode=2 rows per job: baselines are mapped in a few large row ranges
+    RowsPerJob = 2**20
+
+    def computeSmearMappingInBackground (self, base_job_id, MS, DATA, radiusDeg, Decorr, channel_mapping, mode,
+                                         timeblocks=None, runlength=False):
+        """
+        Starts computing the BDA mapping of a chunk. With BDAMode=2, this is done in two layers: the time blocks
+        (see GiveTimeBlocksBaselines()), which only depend on the uvw, FoV and decorrelation, and are computed
+        here in the background unless already given by timeblocks (e.g. from the cache), and the channel blocks
+        (see GiveChannelBlocks()), which are cheap, and are made in collectSmearMapping(). The time blocks are
+        then available as self.timeblocks, for caching.
+
+        If runlength is True, and the rows of every block are contiguous (which is the case for baseline-sorted
+        data), a BDAMode=2 mapping is made in the run-length format:
+
+            [RunLengthTag, 0, NTotBlocks (two words), then for each block: row0, nrows, ch0, ch1]
+
+        rather than the row-list format:
+
+            [NTotBlocks (two words), block sizes..., then for each block: ch0, ch1, rows...]
+        """
         l = radiusDeg * np.pi / 180
         dPhi = np.sqrt(6. * (1. - Decorr))
+        self._mode = mode
+        self._channel_mapping = channel_mapping
+        self._runlength = runlength
+        self._nbl = 0
+        self._job_counter = self._job_counters[APP.ioProcessIndex()]
+        self.timeblocks = timeblocks
+        if mode == 2 and timeblocks is not None:
+            return
         # create new empty shared dicts for results
         self._outdict = shared_dict.create("%s:%s:tmp" %(DATA.path, self.name))
+        if mode == 2:
+            # a few jobs over contiguous ranges of baselines, each mapping all its baselines at once
+            bl_ranges = DATA["BaselineRanges"]
+            nbl = len(bl_ranges)
+            nrows = bl_ranges[-1, 3] if nbl else 0
+            njobs = int(max(1, min(nbl, APP.ncpu, np.ceil(nrows / float(self.RowsPerJob)))))
+            # split at baselines, so that jobs have roughly equal numbers of rows
+            cuts = np.searchsorted(bl_ranges[:, 2], np.arange(1, njobs) * nrows / float(njobs)) if nbl else []
+            bounds = np.unique(np.concatenate(([0], cuts, [nbl]))).astype(int)
+            for ibl0, ibl1 in zip(bounds[:-1], bounds[1:]):
+                APP.runJob("%s:%s:%d" % (base_job_id, self.name, self._nbl), self._timeblocks_worker,
+                           counter=self._job_counter, collect_result=False,
+                           args=(DATA.readonly(), self._outdict.writeonly(), self._nbl, ibl0, ibl1, dPhi, l))
+                self._nbl += 1
+            return
         blockdict = self._outdict.addSubdict("blocks")
         sizedict  = self._outdict.addSubdict("sizes")
-        self._nbl = 0
-        for a0 in range(MS.na):
-            for a1 in range(MS.na):
-                if a0 != a1:
-                    self._nbl += 1
-                    APP.runJob("%s:%s:%d:%d" % (base_job_id, self.name, a0, a1), self._smearmapping_worker,
-                               counter=self._job_counter, collect_result=False,
-                               args=(DATA.readonly(), blockdict.writeonly(), sizedict.writeonly(), a0, a1, dPhi, l,
-                                     channel_mapping, mode))
-
-
+        # one job per baseline actually present in the data (see ClassMS.giveBaselineRanges())
+        for ibl, (a0, a1, _, _) in enumerate(DATA["BaselineRanges"]):
+            if a0 != a1:
+                self._nbl += 1
+                APP.runJob("%s:%s:%d:%d" % (base_job_id, self.name, a0, a1), self._smearmapping_worker,
+                           counter=self._job_counter, collect_result=False,
+                           args=(DATA.readonly(), blockdict.writeonly(), sizedict.writeonly(), ibl, dPhi, l,
+                                 channel_mapping, mode))
+
+    def _collectRangeMapping (self, DATA, field):
+        """Helper for collectSmearMapping(): forms up the BDAMode=2 mapping from the time blocks"""
+        if self.timeblocks is None:
+            # concatenate the per-job time blocks
+            self._outdict.reload()
+            self.timeblocks = dict([ (key, np.concatenate([ self._outdict["%s:%d" % (key, i)] for i in range(self._nbl) ]
+                                                          or [np.zeros(0, dtype)]))
+                                     for key, dtype in (("rows", np.int32), ("blocklen", np.int32), ("fracmin", np.float64)) ])
+            self._outdict.delete()
+        NVis = np.where(DATA["A0"] != DATA["A1"])[0].size * DATA["freqs"].size
+        args = (self.timeblocks["rows"], self.timeblocks["blocklen"], self.timeblocks["fracmin"],
+                DATA["freqs"].size, self._channel_mapping)
+        blocks = GiveRunLengthBlocks(*args) if self._runlength else None
+        if blocks is not None:
+            NTotBlocks = len(blocks)
+            mapping = DATA.addSharedArray(field, (4 + 4*NTotBlocks,), np.int32)
+            mapping[0] = RunLengthTag
+            mapping[1] = 0
+            mapping[2] = NTotBlocks
+            mapping[3] = NTotBlocks>>32
+            mapping[4:] = blocks.ravel()
+            fact = (100.*(NVis-NTotBlocks)/float(NVis or 1))
+            return mapping, fact
+        if self._runlength:
+            print("  rows of %s blocks are not contiguous, using row-list mapping" % field, file=log)
+        sizes, rows = GiveChannelBlocks(*args)
+        NTotBlocks = len(sizes)
+        NTotRows = len(rows)
+        mapping = DATA.addSharedArray(field, (2 + NTotBlocks + NTotRows,), np.int32)
+        mapping[0] = NTotBlocks
+        mapping[1] = NTotBlocks>>32
+        mapping[2:2+NTotBlocks] = sizes
+        mapping[2+NTotBlocks:] = rows
+        fact = (100.*(NVis-NTotBlocks)/float(NVis or 1))
+        return mapping, fact
 
     def collectSmearMapping (self, DATA, field):
         APP.awaitJobCounter(self._job_counter, progress="Mapping %s"%self.name, total=self._nbl, timeout=1)
+        if self._mode == 2:
+            return self._collectRangeMapping(DATA, field)
         self._outdict.reload()
         #self._outdict.save("bda.dict")
         blockdict = self._outdict["blocks"]
@@ -345,11 +439,12 @@ class ClassSmearMapping():
         return OutputMapping, fact
 
 
-def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping):
+def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping, row_index=None):
 
-    A0 = DATA["A0"]
-    A1 = DATA["A1"]
-    row_index = np.where((A0 == a0) & (A1 == a1))[0]
+    if row_index is None:
+        A0 = DATA["A0"]
+        A1 = DATA["A1"]
+        row_index = np.where((A0 == a0) & (A1 == a1))[0]
     nrows = row_index.size
     if not nrows:
         return None, None, None
@@ -492,11 +587,180 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping):
 
 #BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
 
+def _segmentOffsets(lengths):
+    """Helper: for segments of the given lengths, returns the position of each element within its segment"""
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+def GiveTimeBlocksBaselines(DATA, ibl0, ibl1, dPhi, l_max):
+    """
+    Time layer of the vectorised BDA mapping (see GiveBlocksRowsListBaselines()): finds the time blocks of
+    baselines ibl0:ibl1 of DATA["BaselineRanges"] (skipping autocorrelations) in one pass, using a cumulative
+    delta-phase that is restarted at each baseline.
+
+    Returns tuple of (rows, block_len, fracmin): the rows of all blocks (in baseline-time order), the number of
+    rows per block, and the minimum fractional channel block size per block (see GiveBlocksRowsListBL()).
+    """
+    C = 3e8
+    bl_ranges = DATA["BaselineRanges"][ibl0:ibl1]
+    bl_ranges = bl_ranges[(bl_ranges[:, 0] != bl_ranges[:, 1]) & (bl_ranges[:, 3] > bl_ranges[:, 2])]
+    nrows_bl = (bl_ranges[:, 3] - bl_ranges[:, 2]).astype(np.int64)
+    if not len(nrows_bl):
+        return np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.float64)
+    # rows of all baselines, in baseline-time order
+    pos = np.repeat(bl_ranges[:, 2], nrows_bl) + _segmentOffsets(nrows_bl)
+    row_index = pos if DATA["BaselineRows"] is None else DATA["BaselineRows"][pos]
+    nrows = len(row_index)
+    # start of each baseline in row_index
+    bl_start = np.cumsum(nrows_bl) - nrows_bl
+    bl_last = bl_start + nrows_bl - 1
+
+    uvw = DATA["uvw"][row_index]
+    dFreq = DATA["dfreqs"]   # channel width
+    freqs = DATA["freqs"]
+    nu0 = np.max(freqs)
+
+    # delta-uvw to next row of the same baseline; last row of a baseline copies the previous one
+    duvw = np.zeros_like(uvw)
+    duvw[:-1] = uvw[:-1] - uvw[1:]
+    multi = nrows_bl > 1
+    duvw[bl_last[multi]] = duvw[bl_last[multi] - 1]
+    duvw[bl_last[~multi]] = 0
+    # max phase change at the facet edge (see GiveBlocksRowsListBL())
+    n_max = abs(math.sqrt(1-l_max**2)-1)
+    delta_phase = (2*np.pi*nu0/C)*(np.sqrt((duvw[:,:2]**2).sum(1))*l_max + abs(duvw[:,2])*n_max)
+
+    uv = np.sqrt((uvw[:,:2]**2).sum(1))*l_max + abs(uvw[:,2])*n_max
+    with np.errstate(divide="ignore"):
+        dnu = (C / (2*np.pi)) * dPhi / uv  # delta-nu for each row
+    fracsizeChanBlock = dnu / dFreq  # max size of averaging block, in fractional channels, for each row
+
+    # time blocks: a new block starts at the start of every baseline, and wherever the integer part of the
+    # (per-baseline) cumulative delta-phase divided by dPhi changes
+    Duv = C*(dPhi)/(2*np.pi*nu0)
+    if Duv:
+        cumphase = np.cumsum(delta_phase)
+        cumphase -= np.repeat(cumphase[bl_start] - delta_phase[bl_start], nrows_bl)
+        rowblock = np.int32(cumphase / dPhi)
+        newblock = np.ones(nrows, bool)
+        newblock[1:] = rowblock[1:] != rowblock[:-1]
+        newblock[bl_start] = True
+        block_start = np.where(newblock)[0]
+    else:
+        block_start = np.arange(nrows)
+    block_len = np.diff(np.append(block_start, nrows)).astype(np.int32)
+
+    # min (fractional) channel block size per time block, at least 1
+    fracmin = np.maximum(np.minimum.reduceat(fracsizeChanBlock, block_start), 1)
+
+    return row_index.astype(np.int32), block_len, fracmin
+
+def _channelCuts(block_len, fracmin, NChan, GridChanMapping):
+    """
+    Helper for GiveChannelBlocks() and GiveRunLengthBlocks(): works out the channel cuts of each time block.
+    Returns tuple of (entry_block, ch0, ch1), with one entry per (time block, channel cut), in block order.
+    """
+    # integer channel block sizes per time block
+    numChanBlocks = np.ceil(NChan/fracmin)
+    sizeChanBlock = np.int32(np.ceil(NChan/numChanBlocks))
+
+    # channel cuts for each unique block size (see GiveBlocksRowsListBL())
+    uniqueChannelBlockSizes, size_index = np.unique(sizeChanBlock, return_inverse=True)
+    num_bs = uniqueChannelBlockSizes.size
+    chanrange = np.arange(0,NChan,dtype=np.int32)
+    chanpairs = np.zeros( (num_bs, NChan+1, 2), np.int32)
+    chanpairs[:,:-1,0] = chanrange[np.newaxis,:] // uniqueChannelBlockSizes[:,np.newaxis]
+    chanpairs[:,:-1,1] = GridChanMapping[np.newaxis,:]
+    chanpairs[:,-1 ,:] = -1
+    changes = (chanpairs != np.roll(chanpairs,1,axis=1)).any(axis=2)
+    changes_where = [ np.where(changes[bs,:])[0] for bs in range(num_bs) ]
+    # flat tables of (ch0,ch1) cuts, and the start and number of cuts for each block size
+    cut_ch0 = np.concatenate([ chwh[:-1] for chwh in changes_where ]).astype(np.int32)
+    cut_ch1 = np.concatenate([ chwh[1:] for chwh in changes_where ]).astype(np.int32)
+    ncuts_bs = np.array([ len(chwh) - 1 for chwh in changes_where ])
+    cut_start_bs = np.cumsum(ncuts_bs) - ncuts_bs
+
+    ncuts = ncuts_bs[size_index.ravel()]
+    entry_block = np.repeat(np.arange(len(block_len)), ncuts)
+    entry_cut = np.repeat(cut_start_bs[size_index.ravel()], ncuts) + _segmentOffsets(ncuts)
+    return entry_block, cut_ch0[entry_cut], cut_ch1[entry_cut]
+
+def GiveChannelBlocks(rows, block_len, fracmin, NChan, GridChanMapping):
+    """
+    Channel layer of the vectorised BDA mapping (see GiveBlocksRowsListBaselines()): splits each time block
+    (as given by GiveTimeBlocksBaselines()) into channel blocks, and writes the mapping straight into int32 arrays.
+
+    Returns tuple of (BlocksSizes, BlocksRowsList): the block sizes, and the concatenated [ch0, ch1, rows...]
+    lists of all blocks.
+    """
+    if not len(block_len):
+        return np.zeros(0, np.int32), np.zeros(0, np.int32)
+    block_start = np.cumsum(block_len) - block_len
+    entry_block, ch0, ch1 = _channelCuts(block_len, fracmin, NChan, GridChanMapping)
+
+    entry_len = block_len[entry_block].astype(np.int64)
+    BlocksSizes = (entry_len + 2).astype(np.int32)
+    entry_offset = np.cumsum(BlocksSizes, dtype=np.int64) - BlocksSizes
+
+    BlocksRowsList = np.empty(BlocksSizes.sum(dtype=np.int64), np.int32)
+    BlocksRowsList[entry_offset] = ch0
+    BlocksRowsList[entry_offset + 1] = ch1
+    within = _segmentOffsets(entry_len)
+    BlocksRowsList[np.repeat(entry_offset + 2, entry_len) + within] = \
+        rows[np.repeat(block_start[entry_block], entry_len) + within]
+
+    return BlocksSizes, BlocksRowsList
+
+def GiveRunLengthBlocks(rows, block_len, fracmin, NChan, GridChanMapping):
+    """
+    Run-length version of GiveChannelBlocks(), for use when the rows of each time block are contiguous
+    (i.e. the data is in baseline-time order, see --Data-Sort). Each block is then described by four numbers.
+
+    Returns Nx4 int32 array of [row0, nrows, ch0, ch1] per block, or None if the rows of some time block are
+    not contiguous.
+    """
+    if not len(block_len):
+        return np.zeros((0, 4), np.int32)
+    block_start = np.cumsum(block_len) - block_len
+    # rows of a block are contiguous if each row (other than the first one of a block) follows its predecessor
+    follows = np.ones(len(rows), bool)
+    follows[1:] = rows[1:] == rows[:-1] + 1
+    follows[block_start] = True
+    if not follows.all():
+        return None
+    entry_block, ch0, ch1 = _channelCuts(block_len, fracmin, NChan, GridChanMapping)
+    blocks = np.empty((len(entry_block), 4), np.int32)
+    blocks[:, 0] = rows[block_start[entry_block]]
+    blocks[:, 1] = block_len[entry_block]
+    blocks[:, 2] = ch0
+    blocks[:, 3] = ch1
+    return blocks
+
+def NumBlocks(mapping):
+    """Returns the number of blocks in a BDA mapping, in either format (see SmearMappingMachine)"""
+    if mapping[0] == RunLengthTag:
+        return int(np.uint32(mapping[2])) + (int(mapping[3])<<32)
+    return int(np.uint32(mapping[0])) + (int(mapping[1])<<32)
+
+def GiveBlocksRowsListBaselines(DATA, ibl0, ibl1, dPhi, l_max, GridChanMapping):
+    """
+    Vectorised version of GiveBlocksRowsListBL(), mapping baselines ibl0:ibl1 of DATA["BaselineRanges"] (skipping
+    autocorrelations) in one pass: time blocks are found by GiveTimeBlocksBaselines(), then split into channel
+    blocks by GiveChannelBlocks().
+
+    Returns tuple of (BlocksSizes, BlocksRowsList): the block sizes, and the concatenated [ch0, ch1, rows...]
+    lists of all blocks, in baseline order.
+    """
+    rows, block_len, fracmin = GiveTimeBlocksBaselines(DATA, ibl0, ibl1, dPhi, l_max)
+    return GiveChannelBlocks(rows, block_len, fracmin, DATA["freqs"].size, GridChanMapping)
+
 #def GiveBlocksRowsListBL_old(a0, a1, DATA, InfoSmearMapping, GridChanMapping):
-def GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping):
-    A0 = DATA["A0"]
-    A1 = DATA["A1"]
-    ind = np.where((A0 == a0) & (A1 == a1))[0]
+def GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping, row_index=None):
+    if row_index is None:
+        A0 = DATA["A0"]
+        A1 = DATA["A1"]
+        ind = np.where((A0 == a0) & (A1 == a1))[0]
+    else:
+        ind = row_index
     #if(ind.size <= 1):
     #    return
     nrows = ind.size
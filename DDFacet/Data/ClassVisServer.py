@@ -31,6 +31,8 @@ if six.PY3:
 else:
     import cPickle
 import math, os, traceback
+import collections
+import multiprocessing
 
 
 from DDFacet.Data import ClassMS
@@ -62,6 +64,11 @@ def test():
     VS.LoadNextVisChunk()
 
 
+def _initMSGroup(ms_kwargs):
+    """Pool process helper for ClassVisServer._initMSList(): initializes a group of ClassMS objects"""
+    return [ClassMS.ClassMS(**kw) for kw in ms_kwargs]
+
+
 class ClassVisServer():
 
     def __init__(self, MSList, GD=None,
@@ -108,7 +115,11 @@ class ClassVisServer():
         if self._use_data_cache == "off":
             self._use_data_cache = None
         self.DATA = None
-        self._saved_data = None  # vis data saved here for single-chunk mode
+        self._saved_data = None  # original vis data held here in single-chunk mode (see collectLoadedChunk())
+        # queue of chunks scheduled for loading (see startChunkLoadInBackground()), in the order they are to be handed out
+        self._prefetch_queue = collections.deque()
+        self._prefetch_io = 0
+        self._end_of_chunks = False
         self.obs_detail = None
         self.Init()
 
@@ -118,7 +129,14 @@ class ClassVisServer():
         # smear mapping machines
         self._smm_grid = ClassSmearMapping.SmearMappingMachine("BDA.Grid")
         self._smm_degrid = ClassSmearMapping.SmearMappingMachine("BDA.Degrid")
-        self._put_vis_column_job_id = self._put_vis_column_label = None
+        # beam evaluation is spread over the compute workers while a chunk loads
+        self._beam_workers = ClassJones.ClassBeamWorkers(self)
+        # column writes staged for the current chunk, as (field, column, likecol) tuples
+        self._put_columns = []
+        # write-behind queue of column write jobs in flight (see startVisPutColumnInBackground())
+        self._put_queue = collections.deque()
+        # chunks whose imaging weights have already been written out
+        self._weights_written = set()
 
 
 
@@ -144,21 +162,23 @@ class ClassVisServer():
         # max chunk shape accumulated here
         self._chunk_shape = [0, 0, 0]
 
+        # form up list of ClassMS constructor arguments
+        ms_kwargs = []
         for msspec in self.MSList:
             if type(msspec) is not str:
                 msname, ddid, field, column = msspec
             else:
                 msname, ddid, field, column = msspec, self.DicoSelectOptions["DDID"], self.DicoSelectOptions["Field"], self.ColName
-            MS = ClassMS.ClassMS(
-                msname, Col=column or self.ColName, DoReadData=False,
-                AverageTimeFreq=(1, 3),
-                Field=field, DDID=ddid, TaQL=self.TaQL,
-                TimeChunkSize=self.TMemChunkSize, ChanSlice=chanslice,
-                GD=self.GD, ResetCache=self.GD["Cache"]["Reset"],
-                DicoSelectOptions = self.DicoSelectOptions,
-                first_ms=self.ListMS[0] if self.ListMS else None)
-            if MS.empty:
-                continue
+            ms_kwargs.append(dict(MSname=msname, Col=column or self.ColName, DoReadData=False,
+                                  AverageTimeFreq=(self.GD["Data"]["AverageTime"], self.GD["Data"]["AverageFreq"]),
+                                  Field=field, DDID=ddid, TaQL=self.TaQL,
+                                  TimeChunkSize=self.TMemChunkSize, ChanSlice=chanslice,
+                                  ChunkMemBytes=(self.GD["Data"]["ChunkMemGB"] or 0)*2**30 or None,
+                                  ChunkFootprint=self._chunkFootprintModel(msname),
+                                  GD=self.GD, ResetCache=self.GD["Cache"]["Reset"],
+                                  DicoSelectOptions=self.DicoSelectOptions))
+
+        for MS in self._initMSList(ms_kwargs):
             self.ListMS.append(MS)
             # accumulate global set of frequencies, and min/max frequency
             global_freqs.update(MS.ChanFreq)
@@ -179,6 +199,8 @@ class ClassVisServer():
             print(ModColor.Str("--Data-MS does not specify any valid Measurement Set(s)"), file=log)
             raise RuntimeError("--Data-MS does not specify any valid Measurement Set(s)")
 
+        self._reportChunkFootprint()
+
         self.obs_detail = self.ListMS[0].get_obs_details()
 
         # main cache is initialized from main cache of first MS
@@ -372,6 +394,58 @@ class ClassVisServer():
         #if not(MS.DTh*60. in TimesVisMin): TimesVisMin.append(MS.DTh*60.)
         # self.TimesVisMin=np.array(TimesVisMin)
 
+    def _initMSList(self, ms_kwargs):
+        """
+        Creates ClassMS objects from list of constructor arguments, and returns list of the non-empty ones.
+        If Parallel.NIOProcesses>1, MSs are initialized concurrently in a pool of forked processes (with multiple
+        DDIDs/fields of the same MS handled by the same process), so that startup time scales with the slowest
+        MS rather than the total. The objects are then pickled back to the parent.
+        """
+        nproc = min(self.GD["Parallel"]["NIOProcesses"], len(ms_kwargs))
+        if self.GD["Parallel"]["NCPU"] == 1:
+            nproc = 1
+        listMS = []
+        ms_kwargs = list(ms_kwargs)
+        # the "align" rephasing mode needs the first valid MS before any others can be initialized
+        while ms_kwargs and (nproc < 2 or self.GD["Image"]["PhaseCenterRADEC"] == "align") and not listMS:
+            MS = ClassMS.ClassMS(first_ms=None, **ms_kwargs.pop(0))
+            if not MS.empty:
+                listMS.append(MS)
+        first_ms = listMS[0] if listMS else None
+        if nproc < 2:
+            for kw in ms_kwargs:
+                MS = ClassMS.ClassMS(first_ms=first_ms, **kw)
+                if not MS.empty:
+                    listMS.append(MS)
+            return listMS
+        if not ms_kwargs:
+            return listMS
+        # group by MS name, preserving order
+        groups = collections.OrderedDict()
+        for kw in ms_kwargs:
+            kw["first_ms"] = first_ms
+            groups.setdefault(kw["MSname"], []).append(kw)
+        print("initializing %d MS(s) using %d processes" % (len(groups), min(nproc, len(groups))), file=log)
+        pool = multiprocessing.Pool(min(nproc, len(groups)))
+        try:
+            results = pool.map(_initMSGroup, list(groups.values()))
+        finally:
+            pool.close()
+            pool.join()
+        # results come back in group order: put them back in list order, and re-link them
+        # to our option dicts (which are shared, and modified later on)
+        ms_by_kw = {}
+        for kwlist, mslist in zip(groups.values(), results):
+            for kw, MS in zip(kwlist, mslist):
+                ms_by_kw[id(kw)] = MS
+        for kw in ms_kwargs:
+            MS = ms_by_kw[id(kw)]
+            MS.GD = self.GD
+            MS.DicoSelectOptions = self.DicoSelectOptions
+            if not MS.empty:
+                listMS.append(MS)
+        return listMS
+
     def SetImagingPars(self, OutImShape, CellSizeRad):
         self.OutImShape = OutImShape
         self.CellSizeRad = CellSizeRad
@@ -383,37 +457,132 @@ class ClassVisServer():
 
     def ReInitChunkCount(self):
         if self.nTotalChunks > 1 and self.DATA is not None:
-            self.DATA.delete()
-            self.DATA = None
+            self._releaseChunkData()
+        self.collectPutColumnResults()
+        self._discardPrefetchedChunks()
         self.iCurrentMS = 0
         self.iCurrentChunk = -1
 
 
+    # max number of column write jobs left in flight behind the current chunk
+    MaxPutBehind = 1
+
     def startVisPutColumnInBackground(self, DATA, field, column, likecol="DATA"):
+        """
+        Called in main process. Schedules DATA[field] of the current chunk to be written to the given MS column.
+        The write is staged, and started when the next chunk load is started, or the current chunk is released,
+        whichever comes first. All columns staged for a chunk (including the imaging weights, if
+        --Weight-OutColName is set) are then written by one job, in a single pass over the table. The job runs
+        on I/O queue 0 (thus ahead of subsequent chunk loads on that queue), and overlaps with the processing of
+        the next chunk. The chunk's data dict is kept until the write completes.
+        """
+        if DATA is not self.DATA:
+            raise RuntimeError("column writes can only be scheduled for the current chunk. This is a bug!")
+        self._put_columns.append((field, column, likecol))
+
+    def _stageWeightsColumn(self, DATA):
+        """Stages imaging weights of the current chunk for writing, if --Weight-OutColName is set"""
+        colname = self.GD["Weight"]["OutColName"]
+        key = DATA["iMS"], DATA["iChunk"]
+        if colname and key not in self._weights_written and isinstance(DATA["Weights"], np.ndarray):
+            self._put_columns.append(("Weights", colname, "IMAGING_WEIGHT"))
+            self._weights_written.add(key)
+
+    def _flushPutColumns(self):
+        """Starts a write job for the columns staged for the current chunk, if any"""
+        if not self._put_columns:
+            return
+        DATA = self.DATA
         iMS, iChunk = DATA["iMS"], DATA["iChunk"]
-        self._put_vis_column_label = "%d.%d" % (iMS+1, iChunk+1)
-        self._put_vis_column_job_id = "PutData:%d:%d" % (iMS, iChunk)
-        APP.runJob(self._put_vis_column_job_id, self. visPutColumnHandler, args=(DATA.readonly(), field, column, likecol), io=0)
+        job = dict(job_id="PutData:%d:%d" % (iMS, iChunk), label="%d.%d" % (iMS+1, iChunk+1), data=DATA,
+                   release=False)
+        APP.runJob(job["job_id"], self.visPutColumnHandler, args=(DATA.readonly(), self._put_columns), io=0)
+        self._put_columns = []
+        self._put_queue.append(job)
+        # don't let writes fall too far behind
+        while len(self._put_queue) > self.MaxPutBehind:
+            self._collectPutJob(self._put_queue.popleft())
+
+    def _collectPutJob(self, job):
+        APP.awaitJobResults(job["job_id"], progress="Writing %s" % job["label"])
+        if job["release"]:
+            job["data"].delete()
+
+    def _releaseChunkData(self):
+        """Releases current data dict. If writes from it are in flight, it is released once they complete"""
+        self._flushPutColumns()
+        if self._put_queue and self._put_queue[-1]["data"] is self.DATA:
+            self._put_queue[-1]["release"] = True
+        else:
+            self.DATA.delete()
+        self.DATA = None
 
-    def visPutColumnHandler (self, DATA, field, column, likecol):
+    def visPutColumnHandler (self, DATA, columns):
+        """Writes columns (list of (field, column, likecol) tuples) of a chunk, in one pass over the table"""
         iMS, iChunk = DATA["iMS"], DATA["iChunk"]
         ms = self.ListMS[iMS]
         row0, row1 = ms.getChunkRow0Row1()[iChunk]
         if ms.ToRADEC is not None:
-            ms.Rotate(DATA,RotateType=["vis"],Sense="ToPhaseCenter",DataFieldName=field)
-            
+            for field, _, likecol in columns:
+                if likecol != "IMAGING_WEIGHT":
+                    ms.Rotate(DATA,RotateType=["vis"],Sense="ToPhaseCenter",DataFieldName=field)
 
-        ms.PutVisColumn(column, DATA[field], row0, row1, likecol=likecol, sort_index=DATA["sort_index"])
+        ms.PutVisColumns([ (column, DATA[field], likecol) for field, column, likecol in columns ],
+                         row0, row1, sort_index=DATA["sort_index"])
 
     def collectPutColumnResults(self):
-        if self._put_vis_column_job_id:
-            APP.awaitJobResults(self._put_vis_column_job_id, progress="Writing %s" % self._put_vis_column_label)
-            self._put_vis_column_job_id = None
+        """Called in main process. Starts any staged column writes, and waits for all writes to complete"""
+        if self.DATA is not None:
+            self._flushPutColumns()
+        while self._put_queue:
+            self._collectPutJob(self._put_queue.popleft())
 
-    def startChunkLoadInBackground(self, last_cycle=False):
+    def _chunkFootprintModel(self, msname):
+        """
+        Returns model of the shared memory footprint of a loaded chunk of the given MS, for the configured
+        beam/DDE setup. See ClassMS.estimateChunkFootprint() for the meaning of the terms.
+        """
+        GD = self.GD
+        # visibilities (if read), packed flags and weights, plus ~64 bytes of per-row metadata (uvw, antennas, times, etc.)
+        model = dict(fixed=0, row=64, chan=4 + 1/8., vis=8 if self.ColName else 0, ant_hour=0, ant_chan_hour=0, span=0)
+        # BDA mappings for gridding and degridding: at worst, one int32 per row and channel each
+        model["chan"] += 2*4
+        # beam Jones matrices: a 2x2 complex64 per facet, antenna and beam channel, every DtBeamMin
+        if GD["Beam"]["Model"]:
+            perhour = GD["Facets"]["NFacets"]**2 * 32 * 60./max(GD["Beam"]["DtBeamMin"], 1e-3)
+            if GD["Beam"]["NBand"]:
+                model["ant_hour"] += perhour*GD["Beam"]["NBand"]
+            else:
+                model["ant_chan_hour"] += perhour
+        # DDE solutions: each chunk only loads its own time slice of them (see ClassJones.GiveKillMSSolsSlice()),
+        # so count their size as spread over the span of the MS
+        for solsfile in ClassJones.solsFileList(GD, msname):
+            if os.path.exists(solsfile):
+                model["span"] += os.path.getsize(solsfile)
+        return model
+
+    def _reportChunkFootprint(self):
+        """Reports the predicted peak shared memory use of the loaded chunks. Called before any data is read"""
+        sizes = [ size for ms in self.ListMS for size in ms.getChunkFootprints() ]
+        largest = max(sizes)
+        # one chunk is being processed, while up to PrefetchChunks are read ahead (see _fillPrefetchQueue())
+        nahead = max(self.GD["Parallel"]["PrefetchChunks"], 1)
+        budget = (self.GD["Parallel"]["PrefetchMemGB"] or 0)*2**30
+        if budget:
+            nahead = min(nahead, max(int(budget // largest), 1))
+        nahead = min(nahead, len(sizes) - 1)
+        peak = largest*(1 + nahead)
+        print(ModColor.Str("predicted peak shared memory use of visibility chunks is %.2f GB (%d chunk(s) of up to %.2f GB)" % (
+            peak/2.**30, 1 + nahead, largest/2.**30), col="green"), file=log)
+
+    def _estimateChunkSize(self, iMS, iChunk):
+        """Returns estimate of the shared memory footprint of a loaded chunk, in bytes"""
+        return self.ListMS[iMS].getChunkFootprints()[iChunk]
+
+    def _scheduleNextChunk(self, last_cycle=False, io=0):
         """
-        Called in main process. Increments chunk counter, initiates chunk load in background thread.
-        Returns None if we get past the last chunk, else returns the chunk label.
+        Advances chunk pointer to the next non-null chunk, and starts it loading on the given I/O queue.
+        Adds the chunk to the end of the prefetch queue, and returns it. Returns None if we get past the last chunk.
         """
         while True:
             # advance chunk pointer
@@ -424,64 +593,134 @@ class ClassVisServer():
                 self.iCurrentMS += 1
                 # no more MSs -- return None
                 if self.iCurrentMS >= len(self.ListMS):
-                    self._next_chunk_name = None
+                    self._end_of_chunks = True
                     self.iCurrentMS = 0
                     self.iCurrentChunk = -1
                     return None
                 # go back up to first chunk of next MS
                 self.iCurrentChunk = -1
                 continue
-            self._next_chunk_name = "DATA:%d:%d" % (self.iCurrentMS, self.iCurrentChunk)
-            self._next_chunk_label = "%d.%d" % (self.iCurrentMS + 1, self.iCurrentChunk + 1)
+            label = "%d.%d" % (self.iCurrentMS + 1, self.iCurrentChunk + 1)
             # null chunk? skip to next chunk, unless we're in the last major cycle
             if not self._ignore_vis_weights and not last_cycle:
                 self.awaitWeights()
                 if self.VisWeights[self.iCurrentMS][self.iCurrentChunk]["null"]:
-                    print(ModColor.Str("chunk %s is null, skipping"%self._next_chunk_label), file=log)
+                    print(ModColor.Str("chunk %s is null, skipping"%label), file=log)
                     continue
+            chunk = dict(name="DATA:%d:%d" % (self.iCurrentMS, self.iCurrentChunk), label=label,
+                         iMS=self.iCurrentMS, iChunk=self.iCurrentChunk,
+                         size=self._estimateChunkSize(self.iCurrentMS, self.iCurrentChunk),
+                         loading=False)
             # ok, now we're good to load
-            print("scheduling loading of chunk %s" % self._next_chunk_label, file=log)
+            print("scheduling loading of chunk %s (I/O queue %d)" % (label, io), file=log)
             # in single-chunk mode, DATA may already be loaded, in which case we do nothing
             if self.nTotalChunks > 1 or self.DATA is None:
                 # tell the IO thread to start loading the chunk
-                APP.runJob(self._next_chunk_name, self._handler_LoadVisChunk,
-                           args=(self._next_chunk_name, self.iCurrentMS, self.iCurrentChunk), 
-                           io=0)#,serial=True)
-            return self._next_chunk_label
+                APP.runJob(chunk["name"], self._handler_LoadVisChunk,
+                           args=(chunk["name"], chunk["iMS"], chunk["iChunk"]),
+                           io=io)
+                chunk["loading"] = True
+            self._prefetch_queue.append(chunk)
+            return chunk
+
+    def _fillPrefetchQueue(self, last_cycle=False, prefetch=True):
+        """Schedules chunks until the prefetch queue is full, or the memory budget or the last chunk is reached."""
+        if prefetch:
+            depth = max(self.GD["Parallel"]["PrefetchChunks"], 1)
+            budget = (self.GD["Parallel"]["PrefetchMemGB"] or 0)*2**30
+        else:
+            depth, budget = 1, 0
+        # writing a weights column: keep all loads on one I/O queue, so they are serialized with the writes
+        nio = APP.num_io_processes if prefetch and not self.GD["Weight"]["OutColName"] else 1
+        while len(self._prefetch_queue) < depth and not self._end_of_chunks:
+            # one chunk is always allowed in flight, further ones only within the memory budget. Since chunk sizes
+            # are only known once the pointer is advanced, check the budget against the size of the last chunk
+            if budget and self._prefetch_queue:
+                inflight = sum([chunk["size"] for chunk in self._prefetch_queue])
+                if inflight + self._prefetch_queue[-1]["size"] > budget:
+                    break
+            if self._scheduleNextChunk(last_cycle=last_cycle, io=self._prefetch_io % nio) is None:
+                break
+            self._prefetch_io = (self._prefetch_io + 1) % nio
+
+    def _discardPrefetchedChunks(self):
+        """Waits for any chunks still in the prefetch queue to finish loading, and releases them"""
+        while self._prefetch_queue:
+            chunk = self._prefetch_queue.popleft()
+            if chunk["loading"]:
+                APP.awaitJobResults(chunk["name"])
+                shared_dict.attach(chunk["name"]).delete()
+        self._end_of_chunks = False
+        self._prefetch_io = 0
+
+    def startChunkLoadInBackground(self, last_cycle=False, prefetch=True):
+        """
+        Called in main process. Advances chunk pointer, initiates chunk load(s) in background I/O processes.
+        If prefetch is True, up to Parallel.PrefetchChunks chunks (within the Parallel.PrefetchMemGB budget) are kept in flight,
+        spread over the I/O queues. Otherwise at most one chunk is kept in flight, loading on I/O queue 0 (and thus
+        after any column writes scheduled by startVisPutColumnInBackground()).
+        Chunks are always handed out by collectLoadedChunk() in MS/chunk order.
+        Returns None if we get past the last chunk, else returns the label of the next chunk to be collected.
+        """
+        # start any staged column writes first, so that they go ahead of the loads on I/O queue 0
+        if self.DATA is not None:
+            self._flushPutColumns()
+        self._fillPrefetchQueue(last_cycle=last_cycle, prefetch=prefetch)
+        if not self._prefetch_queue:
+            return None
+        return self._prefetch_queue[0]["label"]
 
-    def collectLoadedChunk(self, start_next=True, last_cycle=False):
-        # previous data dict can now be discarded from shm
+    def collectLoadedChunk(self, start_next=True, last_cycle=False, prefetch=True):
+        """
+        Called in main process. Releases the previous chunk, waits for the next chunk in the prefetch queue to finish
+        loading, and returns its data dict (or "EndOfObservation" if there are no more chunks). If start_next is True,
+        the prefetch queue is then topped up (see startChunkLoadInBackground() for last_cycle and prefetch).
+        """
+        # previous data dict can now be discarded from shm (once any writes from it are done)
         if self.nTotalChunks > 1 and self.DATA is not None:
-            self.DATA.delete()
-            self.DATA = None
+            self._releaseChunkData()
         # if no next chunk scheduled, we're at end
-        if not self._next_chunk_name:
+        if not self._prefetch_queue:
+            self._end_of_chunks = False
+            # in single-chunk mode, the working copy of the visibilities is not needed until the next pass
+            if self.nTotalChunks == 1 and self._saved_data is not None and "data" in self.DATA:
+                self.collectPutColumnResults()
+                self.DATA.delete_item("data")
             return "EndOfObservation"
+        chunk = self._prefetch_queue.popleft()
         # in single-chunk mode, only read the MS once, then keep it forever,
-        # but re-copy visibility data from original data
-        if self.nTotalChunks == 1 and self.DATA is not None and "data" in self.DATA:
-            np.copyto(self.DATA["data"], self._saved_data)
+        # but make a fresh working copy of the original visibilities for every pass
+        if self.nTotalChunks == 1 and self._saved_data is not None:
+            np.copyto(self.DATA.addSharedArray("data", self._saved_data.shape, self._saved_data.dtype),
+                      self._saved_data)
         else:
             # await completion of data loading jobs (which, presumably, includes smear mapping)
-            APP.awaitJobResults(self._next_chunk_name, timing="Reading %s"%self._next_chunk_label )
+            APP.awaitJobResults(chunk["name"], timing="Reading %s"%chunk["label"])
             # reload the data dict -- background thread will now have populated it
-            self.DATA = shared_dict.attach(self._next_chunk_name)
-            self.DATA["label"] = self._next_chunk_label
-            # in single-chunk mode, keep a copy of the data array
-            if self.nTotalChunks == 1 and "data" in self.DATA and self._saved_data is None:
-                self._saved_data = self.DATA["data"].copy()
-        # schedule next event
+            self.DATA = shared_dict.attach(chunk["name"])
+            self.DATA["label"] = chunk["label"]
+            # in single-chunk mode, the loaded visibilities become the original copy. They're detached from the
+            # data dict (the memory stays mapped by this process only), and the dict gets a working copy instead.
+            # In between passes only the original is held, so there is never more than one copy at rest.
+            if self.nTotalChunks == 1 and "data" in self.DATA:
+                self._saved_data = self.DATA["data"]
+                self.DATA.delete_item("data")
+                np.copyto(self.DATA.addSharedArray("data", self._saved_data.shape, self._saved_data.dtype),
+                          self._saved_data)
+            self._stageWeightsColumn(self.DATA)
+        # top up the prefetch queue
         if start_next:
-            self.startChunkLoadInBackground(last_cycle=last_cycle)
+            self._fillPrefetchQueue(last_cycle=last_cycle, prefetch=prefetch)
         # return the data dict
         return self.DATA
 
     def releaseLoadedChunk(self):
         """Releases memory associated with any saved data"""
         self._saved_data = None
+        self._discardPrefetchedChunks()
         if self.DATA is not None:
-            self.DATA.delete()
-            self.DATA = None
+            self._releaseChunkData()
+        self.collectPutColumnResults()
 
 
     def _handler_LoadVisChunk(self, dictname, iMS, iChunk):
@@ -538,16 +777,8 @@ class ClassVisServer():
         # get weights
         weights = self.GetVisWeights(iMS, iChunk)
         DATA["Weights"] = weights
-        
-        if self.GD["Weight"]["OutColName"]:
-            ms.PutVisColumn(self.GD["Weight"]["OutColName"],
-                            DATA["Weights"],
-                            DATA["ROW0"],
-                            DATA["ROW1"],
-                            likecol="IMAGING_WEIGHT",
-                            sort_index=DATA["sort_index"])
+        # (if --Weight-OutColName is set, weights are written out by collectLoadedChunk(), see _stageWeightsColumn())
 
-        
         if weights is None:
             print(ModColor.Str("This chunk is all flagged or has zero weight."), file=log)
             return
@@ -558,7 +789,7 @@ class ClassVisServer():
             ChanMappingGridding=DATA["ChanMapping"],
             ChanMappingDeGridding=DATA["ChanMappingDegrid"])
 
-        JonesMachine = ClassJones.ClassJones(self.GD, ms, self.FacetMachine)
+        JonesMachine = ClassJones.ClassJones(self.GD, ms, self.FacetMachine, BeamWorkers=self._beam_workers)
         JonesMachine.InitDDESols(DATA)
 
         if data is not None and self.AddNoiseJy is not None:
@@ -587,12 +818,65 @@ class ClassVisServer():
             print(ModColor.Str("  Effective compression [grid]  :   %.2f%%" % fact, col="green"), file=log)
             np.save(open(self._bda_grid_cachename, 'wb'), FinalMapping)
             self.cache.saveCache("BDA.Grid")
+            self._saveBDATimeBlocks(self._smm_grid, "BDA.Grid")
         if "BDA.Degrid" not in DATA:
             FinalMapping, fact = self._smm_degrid.collectSmearMapping(DATA, "BDA.Degrid")
             print(ModColor.Str("  Effective compression [degrid]:   %.2f%%" % fact, col="green"), file=log)
             DATA["BDA.Degrid"] = FinalMapping
             np.save(open(self._bda_degrid_cachename, 'wb'), FinalMapping)
             self.cache.saveCache("BDA.Degrid")
+            self._saveBDATimeBlocks(self._smm_degrid, "BDA.Degrid")
+
+    def _saveBDATimeBlocks(self, smm, field):
+        """Helper for collectBDA(): caches the time blocks of a freshly computed BDAMode=2 mapping"""
+        path, valid = self._bda_timeblocks[field]
+        if path is not None and not valid:
+            np.savez(path, **smm.timeblocks)
+            self.cache.saveCache(field + ".TimeBlocks")
+
+    def _computeBDAMappingInBackground(self, base_job_id, ms, DATA, smm, field, fov, decorr, ChanMapping,
+                                       CriticalCacheParms):
+        """
+        Helper for computeBDAInBackground(). Loads the BDA mapping 'field' from the cache, or starts computing it.
+        Returns the cache path of the mapping.
+
+        With BDAMode=2, the time blocks of the mapping are cached separately (see
+        SmearMappingMachine.computeSmearMappingInBackground()), keyed on the data geometry, FoV and decorrelation
+        only. A change of channel mapping (e.g. --Freq-NBand or --Freq-NDegridBand) then only needs the cheap
+        channel blocking to be redone.
+        """
+        cachename, valid = self.cache.checkCache(field, CriticalCacheParms)
+        self._bda_timeblocks[field] = None, False
+        if valid:
+            print("  using cached BDA mapping %s" % cachename, file=log)
+            DATA[field] = np.load(cachename)
+            return cachename
+        if self.GD["Comp"][fov] == "Facet":
+            _, _, nx, ny = self.FacetShape
+        elif self.GD["Comp"][fov] == "Full":
+            _, _, nx, ny = self.FullImShape
+        mode = self.GD["Comp"]["BDAMode"]
+        FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
+        timeblocks = None
+        if mode == 2:
+            # geometry only: the rows and uvw of the chunk (MS, row/channel selection, sorting and averaging), and the
+            # frequencies, FoV and decorrelation. The chunk boundaries are implied by the per-chunk cache
+            TimeBlocksCacheParms = dict(MS=self.GD["Data"]["MS"],
+                                        Sorting=self.GD["Data"]["Sort"],
+                                        Averaging=dict([ (key, self.GD["Data"][key]) for key in
+                                                         ("AverageTime", "AverageFreq", "AverageMaxDecorr") ]),
+                                        DataSelection=CriticalCacheParms["DataSelection"],
+                                        FOV=float(FOV), Decorr=self.GD["Comp"][decorr], BDAMode=mode)
+            path, valid = self.cache.checkCache(field + ".TimeBlocks", TimeBlocksCacheParms)
+            self._bda_timeblocks[field] = path, valid
+            if valid:
+                print("  using cached BDA time blocks %s" % path, file=log)
+                timeblocks = dict(np.load(path))
+        # sorted data has contiguous block rows, so a (much smaller) run-length mapping can be used
+        runlength = bool(self.GD["Comp"]["BDARunLength"] and self.GD["Data"]["Sort"])
+        smm.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV, (1. - self.GD["Comp"][decorr]),
+                                            ChanMapping, mode, timeblocks=timeblocks, runlength=runlength)
+        return cachename
 
     def computeBDAInBackground(self, base_job_id, ms, DATA, ChanMappingGridding=None, ChanMappingDeGridding=None):
 
@@ -602,41 +886,19 @@ class ClassVisServer():
                                 Freq=GD["Freq"],
                                 DataSelection=GD["Selection"],
                                 Sorting=GD["Data"]["Sort"])
-        del CriticalCacheParms["Data"]["ColName"],CriticalCacheParms["DataSelection"]["FlagAnts"]
-        
+        # FlagAnts stays in the key: deselected antennas are skipped by the row selection index, so they change the rows
+        del CriticalCacheParms["Data"]["ColName"]
+        self._bda_timeblocks = {}
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompGridMode"]:
-            self._bda_grid_cachename, valid = self.cache.checkCache("BDA.Grid",CriticalCacheParms)
-            if valid:
-                print("  using cached BDA mapping %s" % self._bda_grid_cachename, file=log)
-                DATA["BDA.Grid"] = np.load(self._bda_grid_cachename)
-            else:
-                if self.GD["Comp"]["GridFoV"] == "Facet":
-                    _, _, nx, ny = self.FacetShape
-                elif self.GD["Comp"]["GridFoV"] == "Full":
-                    _, _, nx, ny = self.FullImShape
-                mode = self.GD["Comp"]["BDAMode"]
-                FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
-                self._smm_grid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
-                                                          (1. - self.GD["Comp"]["GridDecorr"]),
-                                                          ChanMappingGridding, mode)
+            self._bda_grid_cachename = self._computeBDAMappingInBackground(base_job_id, ms, DATA, self._smm_grid,
+                                                                           "BDA.Grid", "GridFoV", "GridDecorr",
+                                                                           ChanMappingGridding, CriticalCacheParms)
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompDeGridMode"]:
-            self._bda_degrid_cachename, valid = self.cache.checkCache("BDA.Degrid",CriticalCacheParms)
-
-            if valid:
-                print("  using cached BDA mapping %s" % self._bda_degrid_cachename, file=log)
-                DATA["BDA.Degrid"] = np.load(self._bda_degrid_cachename)
-            else:
-                if self.GD["Comp"]["DegridFoV"] == "Facet":
-                    _, _, nx, ny = self.FacetShape
-                elif self.GD["Comp"]["DegridFoV"] == "Full":
-                    _, _, nx, ny = self.FullImShape
-                mode = self.GD["Comp"]["BDAMode"]
-                FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
-                self._smm_degrid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
-                                                          (1. - self.GD["Comp"]["DegridDecorr"]),
-                                                          ChanMappingDeGridding, mode)
+            self._bda_degrid_cachename = self._computeBDAMappingInBackground(base_job_id, ms, DATA, self._smm_degrid,
+                                                                             "BDA.Degrid", "DegridFoV", "DegridDecorr",
+                                                                             ChanMappingDeGridding, CriticalCacheParms)
 
     def GetVisWeights(self, iMS, iChunk):
         """
@@ -695,10 +957,7 @@ class ClassVisServer():
     def CalcWeightsBackground(self):
         """Starts parallel jobs to load weights in the background"""
         self.VisWeights = None
-        if self.GD["Misc"]["ConserveMemory"]:
-            APP.runJob("VisWeights", self._CalcWeights_serial, io=0, singleton=True, event=self._calcweights_event)
-        else:
-            APP.runJob("VisWeights", self._CalcWeights_handler, io=0, singleton=True, event=self._calcweights_event)
+        APP.runJob("VisWeights", self._CalcWeights_handler, io=0, singleton=True, event=self._calcweights_event)
         # APP.awaitEvents(self._calcweights_event)
 
     def _sigtaper(self, msw, chanfreq, inner_cut, outer_cut, outer_taper_strength, inner_taper_strength): 
@@ -729,14 +988,14 @@ class ClassVisServer():
                 __sigmoid(-uvdistlda * inner_taper_strength - inner_cut * inner_taper_strength)) - 2.0
         visweights *= (y / y.max())
 
-    def _CalcSigmoidTaper(self):
+    def _reportSigmoidTaper(self):
         """
-            Sets up the UV crafter using Sigmoids to taper inner and outer
+            Reports settings of the UV crafter, which uses Sigmoids to taper inner and outer
             The cuts are specified in uvlambda and the rolloff tuning parameter will be clamped to
             0 < tuner <= 1.0.
 
-            Provide visibility weights of the form nrow x nchan (by now they should be padded
-            to that form either way by the visreader)
+            The taper itself is applied to each chunk's visibility weights (of the form nrow x nchan)
+            by _calcChunkWeights_handler()
         """
         if self.EnableSigmoidTaper:
             print("Tapering visibilities with the uv-crafter:", file=log)
@@ -744,150 +1003,248 @@ class ClassVisServer():
             print("\t Outer Cutoff {0:.2f} klda".format(self.SigmoidOutCut * 1.0e-3), file=log)
             print("\t Inner Rolloff Strength {0:.2f}".format(self.SigmoidInRoll), file=log)
             print("\t Outer Rolloff Strength {0:.2f}".format(self.SigmoidOutRoll), file=log)
-            for ims, ms in enumerate(self.ListMS):
-                for ichunk in range(len(ms.getChunkRow0Row1())):
-                    # APP will handle any serialization if NCPU == 1
-                    APP.runJob("SigmoidTaper:%d:%d" % (ims, ichunk), self._sigtaper,
-                            args=(self._weight_dict[ims][ichunk].readwrite(),
-                                    ms.ChanFreq,
-                                    self.SigmoidInCut, self.SigmoidOutCut, 
-                                    self.SigmoidOutRoll, self.SigmoidInRoll),
-                            counter=self._weightjob_counter, collect_result=False)
-            APP.awaitJobCounter(self._weightjob_counter, progress="Sigmoid Tapering")
+
+    def _weightCacheKeys(self):
+        """
+        Returns dict of cache keys for the products of the weights computation. Each key only includes the
+        options that product actually depends on, so that e.g. changing the DDE solutions or the phase centre
+        doesn't throw away any weights:
+
+            "uvmax":  max w and uv extent (MS list and data selection)
+            "raw":    per-chunk raw weights, uvs and flags as read from the MS (data selection and weight column)
+            "density": sparse uv-density, before any Briggs adjustment (the above, plus uv-taper, weighting
+                      cell size and band mapping)
+            "final":  per-chunk imaging weights. For natural weighting, raw weights plus uv-taper, else the density
+                      key plus weighting mode and robustness
+        """
+        GDw = self.GD["Weight"]
+        selection = dict(self.GD["Selection"])
+        taper = dict(EnableSigmoidTaper=bool(GDw["EnableSigmoidTaper"]))
+        if GDw["EnableSigmoidTaper"]:
+            taper.update([(key, GDw[key]) for key in ("SigmoidTaperInnerCutoff", "SigmoidTaperOuterCutoff",
+                                                      "SigmoidTaperInnerRolloffStrength",
+                                                      "SigmoidTaperOuterRolloffStrength")])
+        mode = "briggs" if self.Weighting == "robust" else self.Weighting
+        # pre-averaging (see ClassMS.giveAveragingMap()) changes the rows and channels the weights refer to
+        average = dict([(key, self.GD["Data"][key]) for key in ("AverageTime", "AverageFreq", "AverageMaxDecorr")])
+        if average["AverageTime"] > 1:
+            average.update(NPix=self.GD["Image"]["NPix"], Cell=self.GD["Image"]["Cell"])
+        keys = dict(uvmax=dict(Data=dict(MS=self.GD["Data"]["MS"]), Selection=selection),
+                    raw=dict(Selection=selection, Weight=dict(ColName=GDw["ColName"]), Average=average))
+        if mode == "natural":
+            keys["final"] = dict(Selection=selection, Weight=dict(ColName=GDw["ColName"], Mode=mode, **taper),
+                                 Average=average)
+            return keys
+        nbands = 1 if self.MFSWeighting or self.NFreqBands < 2 else self.NFreqBands
+        keys["density"] = dict(Data=dict(MS=self.GD["Data"]["MS"]), Selection=selection, Average=average,
+                               Weight=dict(ColName=GDw["ColName"], MFS=nbands == 1, SuperUniform=self.Super, **taper),
+                               Image=dict(NPix=self.FullImShape[-1], CellSizeRad=self.CellSizeRad),
+                               Freq=dict(NBand=nbands,
+                                         ChanMapping=[self.DicoMSChanMapping[ims].tolist() for ims in
+                                                      range(self.nMS)] if nbands > 1 else None))
+        keys["final"] = copy.deepcopy(keys["density"])
+        keys["final"]["Weight"].update(Mode=mode, Robust=self.Robust if mode == "briggs" else None)
+        return keys
+
+    # cells of the weighting grid are identified by int64 ids packing together the band number,
+    # the v cell number, and the (offset) u cell number, using this many bits for u and v
+    _WCELL_UBITS = 24
+    _WCELL_VBITS = 24
+
+    def _weightCellSize(self):
+        """Returns cell size (in wavelengths) and number of bands of the weighting grid"""
+        nch, npol, npixIm, _ = self.FullImShape
+        FOV = self.CellSizeRad * npixIm
+        cell = 1. / (self.Super * FOV)
+        if self.MFSWeighting or self.NFreqBands < 2:
+            nbands = 1
+            print("weighting grid is single band (or MFS weighting), cellsize %g" % cell, file=log)
+        else:
+            nbands = self.NFreqBands
+            print("weighting grids for %d bands, cellsize %g" % (nbands, cell), file=log)
+        return cell, nbands
 
     def _CalcWeights_handler(self):
+        """
+        Computes imaging weights in a single streaming pass over the data. Each chunk is handled by one
+        _calcChunkWeights_handler() job, which reads its uvw/flags/weights once, and reduces them to sums over
+        the uv-cells of the weighting grid. The per-cell sums of all chunks are then merged into a (sparse)
+        uv-density, and _finalizeWeights_handler() jobs apply the density correction to each chunk's weights
+        using the compact per-chunk cell index saved by the first pass.
+        """
         self._weight_dict = shared_dict.create("VisWeights")
+        cache_keys = self._weightCacheKeys()
+        reset = self.GD["Cache"]["Weight"] == "reset"
         # check for wmax in cache
-        cache_keys = dict([(section, self.GD[section]) for section
-              in ("Data", "Selection", "Freq", "Image", "Weight", "DDESolutions")])
-        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys)
-        uvmax_path, uvmax_valid = self.maincache.checkCache("uvmax", cache_keys)
+        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys["uvmax"])
+        uvmax_path, uvmax_valid = self.maincache.checkCache("uvmax", cache_keys["uvmax"])
         if wmax_valid:
             self._weight_dict["wmax"] = cPickle.load(open(wmax_path,'rb'))
         if uvmax_valid:
-            self._weight_dict["uvmax"] = cPickle.load(open(uvmax_path,'rb'))
+            self._weight_dict["uvmax"] = self._uvmax = cPickle.load(open(uvmax_path,'rb'))
         # check cache first
         have_all_weights = wmax_valid and uvmax_valid
         for iMS, MS in enumerate(self.ListMS):
             msweights = self._weight_dict.addSubdict(iMS)
             for ichunk, (row0, row1) in enumerate(MS.getChunkRow0Row1()):
                 msw = msweights.addSubdict(ichunk)
-                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys, reset=(self.GD["Cache"]["Weight"]=="reset"))
+                chunk_cache = MS.getChunkCache(row0, row1)
+                path, valid = chunk_cache.checkCache("ImagingWeights.npy", cache_keys["final"], reset=reset)
                 have_all_weights = have_all_weights and valid
                 msw["cachepath"] = path
+                msw["cellpath"] = chunk_cache.getElementPath("WeightCells.npy")
+                msw["valid"] = valid
                 if valid:
                     msw["null"] = not os.path.getsize(path)
+                msw["rawcachepath"], msw["rawvalid"] = chunk_cache.checkCache("RawWeights.npz", cache_keys["raw"],
+                                                                               reset=reset)
 
         # if every weight is in cache, then we're done here
         if have_all_weights:
             print("all imaging weights, wmax, and uvmax are available in cache", file=log)
             return
-        # spawn parallel jobs to load weights
-        for ims,ms in enumerate(self.ListMS):
+
+        natural = self.Weighting == "natural"
+        cell = nbands = None
+        # for non-natural weighting, check for a cached uv-density. If this needs to be recomputed, all chunks do
+        need_density = not natural and not self._ignore_vis_weights
+        if need_density:
+            cell, nbands = self._weightCellSize()
+            density_path, density_valid = self.maincache.checkCache("WeightDensity.npz", cache_keys["density"],
+                                                                    reset=reset)
+            if not density_valid:
+                for ims, ms in enumerate(self.ListMS):
+                    for ichunk in range(len(ms.getChunkRow0Row1())):
+                        self._weight_dict[ims][ichunk]["valid"] = False
+        if not self._ignore_vis_weights:
+            self._reportSigmoidTaper()
+        # with ConserveMemory, run the chunk jobs serially in this process, else in parallel.
+        # Either way, only the chunks being processed are ever held in memory.
+        serial = bool(self.GD["Misc"]["ConserveMemory"])
+        # chunks with valid imaging weights still need to be scanned if wmax/uvmax is to be recomputed
+        scan_all = not (wmax_valid and uvmax_valid)
+        for ims, ms in enumerate(self.ListMS):
             msweights = self._weight_dict[ims]
             for ichunk in range(len(ms.getChunkRow0Row1())):
                 msw = msweights[ichunk]
-                APP.runJob("LoadWeights:%d:%d"%(ims,ichunk), self._loadWeights_handler,
-                           args=(msw.writeonly(), ims, ichunk, self._ignore_vis_weights),
-                           counter=self._weightjob_counter, collect_result=False)
+                if scan_all or not msw["valid"]:
+                    APP.runJob("CalcWeights:%d:%d" % (ims, ichunk), self._calcChunkWeights_handler,
+                               args=(msw.readwrite(), ims, ichunk, cell, nbands,
+                                     self._ignore_vis_weights or msw["valid"]),
+                               counter=self._weightjob_counter, collect_result=False, serial=serial)
         # wait for results
-        APP.awaitJobCounter(self._weightjob_counter, progress="Load weights")
+        APP.awaitJobCounter(self._weightjob_counter, progress="Compute weights")
         self._weight_dict.reload()
-        wmax = self._uvmax = 0
-        num_valid_chunks = 0
-        # now work out weight grid sizes, etc.
+        wmax = uvmax = 0
+        # check for errors, collect wmax and uvmax
         for ims, ms in enumerate(self.ListMS):
             msweights = self._weight_dict[ims]
-            for ichunk in range(len(ms.getChunkRow0Row1())):
+            for ichunk, (row0, row1) in enumerate(ms.getChunkRow0Row1()):
                 msw = msweights[ichunk]
                 if "error" in msw:
                     raise msw["error"]
-                if "weight" in msw:
-                    num_valid_chunks += 1
+                # mark freshly read raw weights as valid
+                if msw.get("rawsaved"):
+                    ms.getChunkCache(row0, row1).saveCache("RawWeights.npz")
+                if "wmax" in msw:
                     wmax = max(wmax, msw["wmax"])
-                    self._uvmax = max(self._uvmax, msw["uvmax_wavelengths"])
-        # save wmax to cache
-        cPickle.dump(wmax,open(wmax_path, "wb"))
-        self.maincache.saveCache("wmax")
-        self._weight_dict["wmax"] = wmax
-        # LB - Need to cache this to set scales in ScaleMachine
-        cPickle.dump(self._uvmax, open(uvmax_path, "wb"))
-        self.maincache.saveCache("uvmax")
-        self._weight_dict["uvmax"] = self._uvmax
+                    uvmax = max(uvmax, msw["uvmax_wavelengths"])
+        if scan_all:
+            # save wmax to cache
+            cPickle.dump(wmax,open(wmax_path, "wb"))
+            self.maincache.saveCache("wmax")
+            self._weight_dict["wmax"] = wmax
+            # LB - Need to cache this to set scales in ScaleMachine
+            self._uvmax = uvmax
+            cPickle.dump(self._uvmax, open(uvmax_path, "wb"))
+            self.maincache.saveCache("uvmax")
+            self._weight_dict["uvmax"] = self._uvmax
+            print("overall max W is %.2f meters" % wmax, file=log)
         if self._ignore_vis_weights:
             return
         if not self._uvmax:
             UserWarning("data appears to be fully flagged: can't compute imaging weights")
-        
-        # compute and apply tapers
-        self._CalcSigmoidTaper()
-
-        # in natural mode, leave the weights as is. In other modes, setup grid for calculations
-        self._weight_grid = shared_dict.create("VisWeights.Grid")
-        cell = npix = npixx = nbands = xymax = None    
 
-        if self.Weighting != "natural":
-            nch, npol, npixIm, _ = self.FullImShape
-            FOV = self.CellSizeRad * npixIm
-            nbands = self.NFreqBands
-            
-            cell = 1. / (self.Super * FOV)
-            if self.MFSWeighting or self.NFreqBands < 2:
-                nbands = 1
-                print("initializing weighting grid for single band (or MFS weighting)", file=log)
+        # in natural mode, the weights are final as written. In other modes, make the uv-density
+        if need_density:
+            if density_valid:
+                print("using cached uv-density %s" % density_path, file=log)
+                cached = np.load(density_path)
+                cells, density = cached["cells"], cached["density"]
             else:
-                print("initializing weighting grids for %d bands" % nbands, file=log)
-            # find max grid extent by considering _unflagged_ UVs
-            xymax = int(math.floor(self._uvmax / cell)) + 1
-            # grid will be from [-xymax,xymax] in U and [0,xymax] in V
-            npixx = xymax * 2 + 1
-            npixy = xymax + 1
-            npix = npixx * npixy
-            print("Calculating imaging weights on an [%i,%i]x%i grid with cellsize %g" % (npixx, npixy, nbands, cell), file=log)
-            grid0 = self._weight_grid.addSharedArray("grid", (nbands, npix), np.float64)
-            # now run parallel jobs to accumulate weights
-            parallel = num_valid_chunks > 1
-            for ims, ms in enumerate(self.ListMS):
-                for ichunk in range(len(ms.getChunkRow0Row1())):
-                    if "weight" in self._weight_dict[ims][ichunk]:
-                        APP.runJob("AccumWeights:%d:%d" % (ims, ichunk), self._accumulateWeights_handler,
-                                   args=(self._weight_grid.readonly(),
-                                         self._weight_dict[ims][ichunk].readwrite(),
-                                         ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax, parallel),
-                                   counter=self._weightjob_counter, collect_result=False)
-            # wait for results
-            APP.awaitJobCounter(self._weightjob_counter, progress="Accumulate weights")
+                chunk_cells = [ (msw["cells"], msw["cellweights"]) for ims in range(len(self.ListMS))
+                                for msw in self._weight_dict[ims].values() if "cells" in msw ]
+                if chunk_cells:
+                    cells, index = np.unique(np.concatenate([c for c, _ in chunk_cells]), return_inverse=True)
+                    density = np.bincount(index, weights=np.concatenate([w for _, w in chunk_cells]),
+                                          minlength=len(cells))
+                    del index
+                else:
+                    cells, density = np.zeros(0, np.int64), np.zeros(0, np.float64)
+                del chunk_cells
+                np.savez(density_path, cells=cells, density=density)
+                self.maincache.saveCache("WeightDensity.npz")
+            print("uv-density has %d non-empty cells" % len(cells), file=log)
             if self.Weighting == "briggs" or self.Weighting == "robust":
                 numeratorSqrt = 5.0 * 10 ** (-self.Robust)
-                grid0 = self._weight_grid["grid"]
+                bands = cells >> (self._WCELL_UBITS + self._WCELL_VBITS)
                 for band in range(nbands):
-                    grid1 = grid0[band, :]
-                    avgW = (grid1 ** 2).sum() / grid1.sum()
+                    inband = bands == band
+                    d = density[inband]
+                    if not d.size:
+                        continue
+                    avgW = (d ** 2).sum() / d.sum()
                     sSq = numeratorSqrt ** 2 / avgW
-                    grid1[...] = 1 + grid1 * sSq
-
-        # launch jobs to finalize weights and save them to the cache
-        for ims, ms in enumerate(self.ListMS):
-            for ichunk in range(len(ms.getChunkRow0Row1())):
-                APP.runJob("FinalizeWeights:%d:%d" % (ims, ichunk), self._finalizeWeights_handler,
-                           args=(self._weight_grid.readonly(),
-                                 self._weight_dict[ims][ichunk].readwrite(),
-                                 ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax),
-                           counter=self._weightjob_counter, collect_result=False)
-        APP.awaitJobCounter(self._weightjob_counter, progress="Finalize weights")
-        # delete stuff
-        if self._weight_grid is not None:
+                    density[inband] = 1 + d * sSq
+            self._weight_grid = shared_dict.create("VisWeights.Density")
+            self._weight_grid["cells"] = cells
+            self._weight_grid["density"] = density
+            del cells, density
+            # launch jobs to renormalize the weights by the density
+            for ims, ms in enumerate(self.ListMS):
+                for ichunk in range(len(ms.getChunkRow0Row1())):
+                    msw = self._weight_dict[ims][ichunk]
+                    if not msw["valid"] and not msw["null"]:
+                        APP.runJob("FinalizeWeights:%d:%d" % (ims, ichunk), self._finalizeWeights_handler,
+                                   args=(self._weight_grid.readonly(), msw.readwrite(), ims, ichunk),
+                                   counter=self._weightjob_counter, collect_result=False, serial=serial)
+            APP.awaitJobCounter(self._weightjob_counter, progress="Finalize weights")
             self._weight_grid.delete()
-        # check for errors
-        self._weight_dict.reload()
+            self._weight_grid = None
+            self._weight_dict.reload()
+        # check for errors, and mark cache as valid
         for ims, ms in enumerate(self.ListMS):
             for ichunk, (row0, row1) in enumerate(ms.getChunkRow0Row1()):
-                if not self._weight_dict[ims][ichunk].get("success"):
+                msw = self._weight_dict[ims][ichunk]
+                if msw["valid"]:
+                    continue
+                if "error" in msw or not (msw["null"] or natural or msw.get("success")):
                     raise RuntimeError("weight computation has failed, see error messages above")
-        # mark cache as valid
-        for ims, ms in enumerate(self.ListMS):
-            for ichunk, (row0, row1) in enumerate(ms.getChunkRow0Row1()):
                 ms.getChunkCache(row0, row1).saveCache("ImagingWeights.npy")
+                for field in "cells", "cellweights":
+                    if field in msw:
+                        msw.delete_item(field)
+
+    def _saveRawWeights(self, msw):
+        """Helper method: saves raw weights (as loaded by _loadWeights_handler) to the chunk cache"""
+        arrays = dict([(field, msw[field]) for field in ("wmax", "uvmax_wavelengths", "uv", "flags", "weight")
+                       if field in msw])
+        np.savez(msw["rawcachepath"], **arrays)
+        msw["rawsaved"] = True
+
+    def _loadRawWeights(self, msw, ims, wmax_only=False):
+        """Helper method: loads raw weights from the chunk cache (see _saveRawWeights())"""
+        raw = np.load(msw["rawcachepath"])
+        if "wmax" in raw.files:
+            msw["wmax"] = float(raw["wmax"])
+            msw["uvmax_wavelengths"] = float(raw["uvmax_wavelengths"])
+        if wmax_only or "weight" not in raw.files:
+            return
+        msw["uv"] = raw["uv"]
+        msw["flags"] = raw["flags"]
+        weight = raw["weight"]
+        msw.addSharedArray("weight", weight.shape, np.float32)[...] = weight
+        msw["bandmap"] = self.DicoMSChanMapping[ims]
 
     def _loadWeights_handler(self, msw, ims, ichunk, wmax_only=False):
         """If wmax_only is True, then don't actually read or compute weighs -- only read UVWs
@@ -898,26 +1255,37 @@ class ClassVisServer():
             msname = "%s chunk %d"%(ms.MSName, ichunk)
             row0, row1 = ms.getChunkRow0Row1()[ichunk]
             msfreqs = ms.ChanFreq
-            nrows = row1 - row0
-            chanslice = ms.ChanSlice
+            # only rows selected by the row selection index are read (see ClassMS.giveChunkRows())
+            selection = ms.giveChunkRows(row0, row1)
+            nrows = row1 - row0 if selection is None else len(selection)
             if not nrows:
     #            print>> log, "  0 rows: empty chunk"
                 return
+            # raw weights already cached? Load them from there instead of the MS
+            if msw.get("rawvalid"):
+                self._loadRawWeights(msw, ims, wmax_only)
+                return
             tab = ms.GiveMainTable()
     #        print>>log,"  %d.%d reading %s UVW" % (ims+1, ichunk+1, ms.MSName)
-            uvw = tab.getcol("UVW", row0, nrows)
-            flags = np.empty((nrows, len(ms.ChanFreq), len(ms.CorrelationIds)), np.bool)
-            # print>>log,(ms.cs_tlc,ms.cs_brc,ms.cs_inc,flags.shape)
-    #        print>>log,"  reading FLAG"
-            tab.getcolslicenp("FLAG", flags, ms.cs_tlc, ms.cs_brc, ms.cs_inc, row0, nrows)
+            uvw = ms.readColumn(tab, "UVW", row0, nrows, selection)
+            # if any polarization is flagged, flag all 4 correlations. This is done block by block as the
+            # flags are read, so the shape of flags is nrow,nchan
+            flags = np.empty((nrows, ms.ReadNchan), np.bool)
+            ms.readColumnSorted(tab, "FLAG", flags, row0, nrows, reduce=lambda block: block.any(axis=2),
+                                selection=selection)
             if ms._reverse_channel_order:
-                flags = flags[:,::-1,:]
-            # if any polarization is flagged, flag all 4 correlations. Shape of flags becomes nrow,nchan
-    #        print>>log,"  adjusting flags"
-            # if any polarization is flagged, flag all 4 correlations. Shape
-            # of flags becomes nrow,nchan
-            flags = flags.max(axis=2)
+                flags = flags[:,::-1]
             valid = ~flags
+            # pre-averaged MS: reduce to the averaged rows and channels. The averaged weights are needed
+            # for this, so read them here already
+            avgweight = None
+            if ms.AverageSteps is not None:
+                avgweight = ms.readVisWeights(tab, row0, nrows, self.GD["Weight"]["ColName"],
+                                              selection=selection) * valid
+                uvw, avgweight = ms.averageWeights(row0, row1, uvw, avgweight)
+                valid = avgweight != 0
+                flags = ~valid
+                nrows = len(uvw)
             # if all channels are flagged, flag whole row. Shape of flags becomes nrow
             rowflags = flags.min(axis=1)
             # if everything is flagged, skip this entry
@@ -925,6 +1293,8 @@ class ClassVisServer():
     #            print>> log, "  all flagged: marking as null"
                 msw["wmax"] = 0
                 msw["uvmax_wavelengths"] = 0
+                if "rawcachepath" in msw:
+                    self._saveRawWeights(msw)
                 return
             # max of |u|, |v| in wavelengths
             uv = uvw[:, :2]
@@ -939,31 +1309,11 @@ class ClassVisServer():
             msw["flags"] = rowflags
             # now read the weights
             weight = msw.addSharedArray("weight", (nrows, ms.Nchan), np.float32)
-            weight_col = self.GD["Weight"]["ColName"]
-            if weight_col == "WEIGHT_SPECTRUM":
-                w = tab.getcol(weight_col, row0, nrows)[:, chanslice]
-    #            print>> log, "  reading column %s for the weights, shape is %s" % (weight_col, w.shape)
-                if ms._reverse_channel_order:
-                    w = w[:, ::-1, :]
-                # take mean weight across correlations and apply this to all
-                weight[...] = w.mean(axis=2)
-            elif weight_col == "None" or weight_col == None:
-    #            print>> log, "  Selected weights columns is None, filling weights with ones"
-                weight.fill(1)
-            elif weight_col == "WEIGHT":
-                w = tab.getcol(weight_col, row0, nrows)
-    #            print>> log, "  reading column %s for the weights, shape is %s, will expand frequency axis" % (weight_col, w.shape)
-                # take mean weight across correlations, and expand to have frequency axis
-                weight[...] = w.mean(axis=1)[:, np.newaxis]
+            if avgweight is not None:
+                weight[...] = avgweight
+                del avgweight
             else:
-                # in all other cases (i.e. IMAGING_WEIGHT) assume a column
-                # of shape NRow,NFreq to begin with, check for this:
-                w = tab.getcol(weight_col, row0, nrows)[:, chanslice]
-    #            print>> log, "  reading column %s for the weights, shape is %s" % (weight_col, w.shape)
-                if w.shape != valid.shape:
-                    raise TypeError("weights column expected to have shape of %s" %
-                        (valid.shape,))
-                weight[...] = w
+                ms.readVisWeights(tab, row0, nrows, self.GD["Weight"]["ColName"], out=weight, selection=selection)
             # flagged points get zero weight
             weight *= valid
             nullweight = (weight==0).all()
@@ -973,6 +1323,8 @@ class ClassVisServer():
                 msw.delete_item("flags")
             else:
                 msw["bandmap"] = self.DicoMSChanMapping[ims]
+            if "rawcachepath" in msw:
+                self._saveRawWeights(msw)
         except Exception as exc:
             print(ModColor.Str("Error loading weights from %s:"%msname), file=log)
             for line in traceback.format_exc().split("\n"):
@@ -982,231 +1334,100 @@ class ClassVisServer():
             msw.delete_item("uv")
             msw.delete_item("flags")
 
-    def _uv_to_index(self, ims, uv, weights, freqs, cell, npix, npixx, nbands, xymax):
-        """Helper method: converts UV coordinates to indices into a UV-grid"""
+    def _uv_to_cells(self, ims, uv, weights, freqs, cell, nbands):
+        """
+        Helper method: converts UV coordinates to cells of the weighting grid.
+        Returns tuple of (cells, cellweights, index), where cells is a sorted array of the (int64) ids of all cells
+        with non-zero weights, cellweights gives the sum of the weights in each cell, and index is an int32 array
+        of the same shape as weights, giving the number of each visibility's cell in cells. (Zero weights
+        refer to cell 0, which is harmless, since they will remain zero.)
+        """
+        ubits, vbits = self._WCELL_UBITS, self._WCELL_VBITS
         # flip sign of negative v values -- we'll only grid the top half of the plane
-        uv[uv[:, 1] < 0] *= -1
-        # convert u/v to lambda, and then to pixel offset
-        uv = uv[..., np.newaxis] * freqs[np.newaxis, np.newaxis, :] / _cc
-        uv = np.floor(uv / cell).astype(int)
-        # u is offset, v isn't since it's the top half
-        x = uv[:, 0, :]
-        y = uv[:, 1, :]
-        x += xymax  # offset, since X grid starts at -xymax
-        # convert to index array -- this gives the number of the uv-bin on the grid
-        #index = msw.addSharedArray("index", (uv.shape[0], len(freqs)), np.int64)
-        index = np.zeros((uv.shape[0], len(freqs)), np.int32)
-        index[...] = y * npixx + x
-        # if we're in per-band weighting mode, then adjust the index to refer to each band's grid
+        uv = uv * np.where(uv[:, 1:2] < 0, -1, 1)
+        # convert u/v to lambda, and then to cell number
+        scale = (freqs.ravel() / (_cc * cell))[np.newaxis, :]
+        nonzero = weights != 0
+        ucell = np.floor(uv[:, 0:1] * scale).astype(np.int64)[nonzero]
+        vcell = np.floor(uv[:, 1:2] * scale).astype(np.int64)[nonzero]
+        if ucell.size and (abs(ucell).max() >= 1 << (ubits - 1) or vcell.max() >= 1 << vbits):
+            raise ValueError("uv-coverage exceeds the weighting grid: is the weighting cell size (%g) too small?" % cell)
+        ids = (vcell << ubits) + (ucell + (1 << (ubits - 1)))
+        del ucell, vcell
+        # if we're in per-band weighting mode, then tag cell ids with the band number
         if nbands > 1:
-            index += self.DicoMSChanMapping[ims][np.newaxis, :] * npix
-        # zero weight refers to zero cell (otherwise it may end up outside the grid, since grid is
-        # only big enough to accommodate the *unflagged* uv-points)
-        index[weights == 0] = 0
-        return index
-
-    def _accumulateWeights_handler (self, wg, msw, ims, ichunk, freqs, cell, npix, npixx, nbands, xymax, parallel=False):
+            bandmap = self.DicoMSChanMapping[ims].astype(np.int64) << (ubits + vbits)
+            ids += np.broadcast_to(bandmap[np.newaxis, :], weights.shape)[nonzero]
+        cells, ids = np.unique(ids, return_inverse=True)
+        cellweights = np.bincount(ids, weights=weights[nonzero], minlength=len(cells))
+        index = np.zeros(weights.shape, np.int32)
+        index[nonzero] = ids
+        return cells, cellweights, index
+
+    def _calcChunkWeights_handler(self, msw, ims, ichunk, cell, nbands, wmax_only=False):
+        """
+        Weights computation for one chunk. Loads the raw weights (from the MS or the raw weights cache), applies
+        the uv-taper, and writes the result to the imaging weights cache. For non-natural weighting, the weights
+        are also reduced to per-cell sums on the weighting grid (kept in msw), and a compact per-visibility cell
+        index is saved to a scratch file in the chunk cache, for use by _finalizeWeights_handler().
+        If wmax_only is True, only wmax and uvmax are determined.
+        """
+        self._loadWeights_handler(msw, ims, ichunk, wmax_only)
+        if wmax_only or "error" in msw:
+            return
         msname = "MS %d chunk %d"%(ims, ichunk)
         try:
             ms = self.ListMS[ims]
             msname = "%s chunk %d"%(ms.MSName, ichunk)
-            weights = msw["weight"]
-            index = self._uv_to_index(ims, msw["uv"], weights, freqs, cell, npix, npixx, nbands, xymax)
-            msw.delete_item("flags")
-            if parallel:
-                _pyGridderSmearPols.pyAccumulateWeightsOntoGrid(wg["grid"], weights.ravel(), index.ravel())
-            else:
-                _pyGridderSmearPols.pyAccumulateWeightsOntoGridNoSem(wg["grid"], weights.ravel(), index.ravel())
+            if "weight" not in msw:
+                msw["null"] = True
+                open(msw["cachepath"], 'w').truncate(0)
+                return
+            weight = msw["weight"]
+            if self.EnableSigmoidTaper:
+                self._sigtaper(msw, ms.ChanFreq, self.SigmoidInCut, self.SigmoidOutCut,
+                               self.SigmoidOutRoll, self.SigmoidInRoll)
+            if self.Weighting != "natural":
+                cells, cellweights, index = self._uv_to_cells(ims, msw["uv"], weight, ms.ChanFreq, cell, nbands)
+                np.save(msw["cellpath"], index)
+                del index
+                msw["cells"] = cells
+                msw["cellweights"] = cellweights
+            np.save(msw["cachepath"], weight)
+            msw["null"] = False
         except Exception as exc:
-            print(ModColor.Str("Error accumulating weights from %s:"%msname), file=log)
+            print(ModColor.Str("Error computing weights for %s:"%msname), file=log)
             for line in traceback.format_exc().split("\n"):
                 print(ModColor.Str("  "+line), file=log)
             msw["error"] = exc
-            os.unlink(msw["cachepath"])
-            msw.delete_item("weight")
-            msw.delete_item("uv")
-            msw.delete_item("flags")
+        finally:
+            for field in "weight", "uv", "flags", "bandmap":
+                if field in msw:
+                    msw.delete_item(field)
 
-    def _finalizeWeights_handler(self, wg, msw, ims, ichunk, freqs, cell, npix, npixx, nbands, xymax):
+    def _finalizeWeights_handler(self, wd, msw, ims, ichunk):
+        """Renormalizes the cached weights of one chunk by the uv-density wd (see _CalcWeights_handler())"""
         msname = "MS %d chunk %d"%(ims, ichunk)
         try:
             ms = self.ListMS[ims]
             msname = "%s chunk %d"%(ms.MSName, ichunk)
+            # density of this chunk's cells
+            density = wd["density"][np.searchsorted(wd["cells"], msw["cells"])]
+            index = np.load(msw["cellpath"], mmap_mode="r")
+            weight = np.load(msw["cachepath"], mmap_mode="r+")
+            # go through in blocks of rows to keep memory use down
+            nrow_block = max(2**24 // max(weight.shape[1], 1), 1)
+            for row0 in range(0, weight.shape[0], nrow_block):
+                weight[row0:row0+nrow_block] /= density[index[row0:row0+nrow_block]]
+            weight.flush()
+            del weight, index
+            os.unlink(msw["cellpath"])
             msw["success"] = True
-            if "weight" in msw:
-                weight = msw["weight"]
-                # renormalize to density, for uniform/briggs
-                if self.Weighting != "natural":
-                    index = self._uv_to_index(ims, msw["uv"], weight, freqs, cell, npix, npixx, nbands, xymax)
-                    grid = wg["grid"].reshape((wg["grid"].size,))
-                    #weight /= grid[msw["index"]]
-                    index[index>=len(grid)]=0
-                    weight /= grid[index]
-    #                import pdb; pdb.set_trace()
-
-                np.save(msw["cachepath"], weight)
-                msw.delete_item("weight")
-                msw.delete_item("uv")
-                if "flags" in msw:
-                    msw.delete_item("flags")
-                if "index" in msw:
-                    msw.delete_item("index")
-                msw["null"] = False
-            elif "error" in msw:
-                msw["null"] = True
-                msw["success"] = False
-                os.unlink(msw["cachepath"])
-            else:
-                msw["null"] = True
-                open(msw["cachepath"], 'w').truncate(0)
         except Exception as exc:
-            print(ModColor.Str("Error accumulating weights from %s:"%msname), file=log)
+            print(ModColor.Str("Error finalizing weights for %s:"%msname), file=log)
             for line in traceback.format_exc().split("\n"):
                 print(ModColor.Str("  "+line), file=log)
             msw["error"] = exc
             msw["success"] = False
-            os.unlink(msw["cachepath"])
-
-    def _CalcWeights_serial(self):
-        self._weight_dict = shared_dict.create("VisWeights")
-        # check for wmax in cache
-        cache_keys = dict([(section, self.GD[section]) for section
-                           in ("Data", "Selection", "Freq", "Image", "Weight")])
-        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys)
-        uvmax_path, uvmax_valid = self.maincache.checkCache("uvmax", cache_keys)
-        if wmax_valid:
-            self._weight_dict["wmax"] = cPickle.load(open(wmax_path, "rb"))
-        if uvmax_valid:
-            self._weight_dict["uvmax"] = cPickle.load(open(uvmax_path, "rb"))
-        # check cache first
-        have_all_weights = wmax_valid and uvmax_valid
-        for iMS, MS in enumerate(self.ListMS):
-            msweights = self._weight_dict.addSubdict(iMS)
-            for ichunk, (row0, row1) in enumerate(MS.getChunkRow0Row1()):
-                msw = msweights.addSubdict(ichunk)
-                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys)
-                have_all_weights = have_all_weights and valid
-                msw["cachepath"] = path
-                if valid:
-                    msw["null"] = not os.path.getsize(path)
-
-        # if every weight is in cache, then we're done here
-        if have_all_weights:
-            print("all imaging weights, wmax, and uvmax are available in cache", file=log)
-            return
-
-        wmax = self._uvmax = 0
-        # scan through MSs to determine uv-max
-        for ims, ms in enumerate(self.ListMS):
-            ms = self.ListMS[ims]
-            max_freq = ms.ChanFreq.max()
-            for ichunk in range(len(ms.getChunkRow0Row1())):
-                print("scanning UVWs %d.%d" % (ims, ichunk), file=log)
-                row0, row1 = ms.getChunkRow0Row1()[ichunk]
-                nrows = row1 - row0
-                if not nrows:
-                    continue
-                tab = ms.GiveMainTable()
-                uvw = tab.getcol("UVW", row0, nrows)
-                rowflags = tab.getcol("FLAG_ROW", row0, nrows)
-                # max of |u|, |v| in wavelengths
-                if not rowflags.all():
-                    uvmax_wavelengths = abs(uvw[~rowflags, :2]).max() * max_freq / _cc
-                    self._uvmax = max(self._uvmax, uvmax_wavelengths)
-                    wmax = max(wmax, abs(uvw[~rowflags, 2]).max())
-        
-        # setup uv-grid for non-natural weights
-        if self.Weighting != "natural":
-            self._weight_grid = shared_dict.create("VisWeights.Grid")
-            nch, npol, npixIm, _ = self.FullImShape
-            FOV = self.CellSizeRad * npixIm
-            nbands = self.NFreqBands
-            cell = 1. / (self.Super * FOV)
-            if self.MFSWeighting or self.NFreqBands < 2:
-                nbands = 1
-                print("initializing weighting grid for single band (or MFS weighting)", file=log)
-            else:
-                print("initializing weighting grids for %d bands" % nbands, file=log)
-            # find max grid extent by considering _unflagged_ UVs
-            xymax = int(math.floor(self._uvmax / cell)) + 1
-            # grid will be from [-xymax,xymax] in U and [0,xymax] in V
-            npixx = xymax * 2 + 1
-            npixy = xymax + 1
-            npix = npixx * npixy
-            print("Calculating imaging weights on an [%i,%i]x%i grid with cellsize %g" % (npixx, npixy, nbands, cell), file=log)
-            self._weight_grid.addSharedArray("grid", (nbands, npix), np.float64)
-
-        # scan through MSs one by one
-        for ims, ms in enumerate(self.ListMS):
-            msweights = self._weight_dict[ims]
-            for ichunk in range(len(ms.getChunkRow0Row1())):
-                msw = msweights[ichunk]
-                print("loading weights %d.%d"%(ims, ichunk), file=log)
-                self._loadWeights_handler(msw, ims, ichunk, self._ignore_vis_weights)
-
-                # if nothing in MS, handler will not return a "weight" field. Mark this chunk as null then, and truncate the cache
-                msw["null"] = "weight" not in msw
-                if "error" in msw:
-                    raise RuntimeError("weights computation failed for one or more MSs")
-                if "weight" not in msw:
-                    open(msw["cachepath"], 'wb').truncate(0)
-                    continue
-
-                # in Natural mode, we're done: dump weights out
-                if self.Weighting == "natural":
-                    self._finalizeWeights_handler(None, msw, ims, ichunk, 0)
-                # else accumulate onto uv grid
-                else:
-                    self._accumulateWeights_handler(self._weight_grid, msw,
-                                         ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax)
-                    # delete to save memory
-                    for field in "weight", "uv", "flags", "index":
-                        if field in msw:
-                            msw.delete_item(field)
-                            
-        # save wmax to cache
-        cPickle.dump(wmax, open(wmax_path, "wb"))
-        self.maincache.saveCache("wmax")
-        self._weight_dict["wmax"] = wmax
-        # LB - Need to cache this to set scales in ScaleMachine
-        cPickle.dump(self._uvmax, open(uvmax_path, "wb"))
-        self.maincache.saveCache("uvmax")
-        self._weight_dict["uvmax"] = self._uvmax
-        print("overall max W is %.2f meters"%wmax, file=log)
-        if self._ignore_vis_weights:
-            return
-        if not self._uvmax:
-            raise RuntimeError("data appears to be fully flagged: can't compute imaging weights")
-
-        if self.Weighting != "natural":
-            # adjust uv-grid for robust weighting
-            if self.Weighting == "briggs" or self.Weighting == "robust":
-                numeratorSqrt = 5.0 * 10 ** (-self.Robust)
-                grid0 = self._weight_grid["grid"]
-                for band in range(nbands):
-                    grid1 = grid0[band, :]
-                    avgW = (grid1 ** 2).sum() / grid1.sum()
-                    sSq = numeratorSqrt ** 2 / avgW
-                    grid1[...] = 1 + grid1 * sSq
-
-            # rescan through MSs one by one to re-adjust the weights
-            for ims, ms in enumerate(self.ListMS):
-                msweights = self._weight_dict[ims]
-                for ichunk in range(len(ms.getChunkRow0Row1())):
-                    msw = msweights[ichunk]
-                    if msw["null"]:
-                        print("skipping weights %d.%d (null)" % (ims, ichunk), file=log)
-                        open(msw["cachepath"], 'w').truncate(0)
-                        continue
-                    print("reloading weights %d.%d" % (ims, ichunk), file=log)
-                    self._loadWeights_handler(msw, ims, ichunk, self._ignore_vis_weights)
-                    self._finalizeWeights_handler(self._weight_grid, msw,
-                                                      ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax)
-
-            if self._weight_grid is not None:
-                self._weight_grid.delete()
-
-        # mark caches as valid
-        for ims, ms in enumerate(self.ListMS):
-            for ichunk, (row0, row1) in enumerate(ms.getChunkRow0Row1()):
-                ms.getChunkCache(row0, row1).saveCache("ImagingWeights.npy")
+            if os.path.exists(msw["cachepath"]):
+                os.unlink(msw["cachepath"])
@@ -0,0 +1,144 @@
+/**
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+*/
+
+#ifndef GRIDDER_BDAMAPPING_H
+#define GRIDDER_BDAMAPPING_H
+
+#include <cstdint>
+#include <cstddef>
+#include <stdexcept>
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+
+namespace DDF {
+  namespace py=pybind11;
+
+  /* One BDA block: channels [chStart,chEnd) of nrows rows. The rows are either listed (rows!=0),
+     or are the contiguous run row0, row0+1, ..., row0+nrows-1 */
+  struct BDABlock
+    {
+    size_t chStart, chEnd;
+    int nrows;
+    const int *rows;
+    int row0;
+
+    inline int row(int inx) const
+      { return rows ? rows[inx] : row0+inx; }
+    };
+
+  /* Read-only view of a BDA mapping, as produced by DDFacet/Data/ClassSmearMapping.py. Two formats are accepted:
+
+       row lists:  [NTotBlocks (two words), block sizes..., then for each block: ch0, ch1, rows...]
+       run-length: [RUNLENGTH_TAG, 0, NTotBlocks (two words), then for each block: row0, nrows, ch0, ch1]
+
+     The run-length format is used for baseline-sorted data, where the rows of a block are contiguous. */
+  class BDAMapping
+    {
+    private:
+      const int *mapping;
+      size_t nblocks;
+      bool runlength;
+
+    public:
+      enum { RUNLENGTH_TAG=-1 };
+
+      explicit BDAMapping(const py::array_t<int32_t, py::array::c_style>& SmearMapping)
+	: mapping(SmearMapping.data(0))
+	{
+	if (SmearMapping.ndim()!=1 || SmearMapping.shape(0)<2)
+	  throw std::invalid_argument("BDA mapping must be a 1D int32 array");
+	runlength = mapping[0]==RUNLENGTH_TAG;
+	if (runlength)
+	  {
+	  mapping += 2;
+	  if (SmearMapping.shape(0)<4)
+	    throw std::invalid_argument("truncated run-length BDA mapping");
+	  }
+	/* total size is in two words */
+	nblocks = size_t(uint32_t(mapping[0])) + (size_t(mapping[1])<<32);
+	if (runlength && size_t(SmearMapping.shape(0))!=4+4*nblocks)
+	  throw std::invalid_argument("run-length BDA mapping has inconsistent size");
+	}
+
+      inline size_t size() const
+	{ return nblocks; }
+
+      inline bool isRunLength() const
+	{ return runlength; }
+
+      /* Sequential reader of blocks, starting from a given block */
+      class Cursor
+	{
+	private:
+	  const BDAMapping &map;
+	  size_t iBlock;
+	  const int *pos;
+
+	public:
+	  Cursor(const BDAMapping &m, size_t iBlock0)
+	    : map(m), iBlock(iBlock0)
+	    {
+	    if (map.runlength)
+	      pos = map.mapping+2+4*iBlock;
+	    else
+	      {
+	      /* skip the row lists of the preceding blocks */
+	      pos = map.mapping+2+map.nblocks;
+	      for (size_t i=0; i<iBlock; ++i)
+		pos += map.mapping[2+i];
+	      }
+	    }
+
+	  inline size_t index() const
+	    { return iBlock; }
+
+	  /* returns the current block, and advances to the next one */
+	  inline BDABlock next()
+	    {
+	    BDABlock blk;
+	    if (map.runlength)
+	      {
+	      blk.row0 = pos[0];
+	      blk.nrows = pos[1];
+	      blk.chStart = size_t(pos[2]);
+	      blk.chEnd = size_t(pos[3]);
+	      blk.rows = 0;
+	      pos += 4;
+	      }
+	    else
+	      {
+	      blk.chStart = size_t(pos[0]);
+	      blk.chEnd = size_t(pos[1]);
+	      blk.nrows = map.mapping[2+iBlock]-2;
+	      blk.rows = pos+2;
+	      blk.row0 = 0;
+	      pos += map.mapping[2+iBlock];
+	      }
+	    ++iBlock;
+	    return blk;
+	    }
+	};
+
+      inline Cursor cursor(size_t iBlock0=0) const
+	{ return Cursor(*this, iBlock0); }
+    };
+}
+
+#endif /*GRIDDER_BDAMAPPING_H*/
@@ -72,7 +72,8 @@ namespace DDF {
   void pyGridderWPol(py::array_t<std::complex<float>, py::array::c_style>& np_grid,
 		    const py::array_t<std::complex<float>, py::array::c_style>& vis,
 		    const py::array_t<double, py::array::c_style>& uvw,
-		    const py::array_t<bool, py::array::c_style>& flags,
+		    const py::array_t<uint8_t, py::array::c_style>& flags,
+		    const py::array_t<uint8_t, py::array::c_style>& rowflags,
 		    const py::array_t<float, py::array::c_style>& weights,
 		    py::array_t<double, py::array::c_style>& sumwt,
 		    bool dopsf,
@@ -89,7 +90,8 @@ namespace DDF {
 		    const py::list& LSmearing,
 		    const py::array_t<int32_t, py::array::c_style>& np_ChanMapping,
 		    const py::array_t<uint16_t, py::array::c_style>& LDataCorrFormat,
-		    const py::array_t<uint16_t, py::array::c_style>& LExpectedOutStokes
+		    const py::array_t<uint16_t, py::array::c_style>& LExpectedOutStokes,
+		    int nthreads
 		    )
   {
     using svec = vector<string>;
@@ -113,7 +115,7 @@ namespace DDF {
       }
     #define callgridder(stokesgrid, nVisPol) \
       {\
-      gridder::gridder<readcorr, mulaccum, stokesgrid>(np_grid, vis, uvw, flags, weights, sumwt, bool(dopsf), Lcfs, LcfsConj, WInfos, increment, freqs, Lmaps, LJones, SmearMapping, Sparsification, LOptimisation,LSmearing,np_ChanMapping, expstokes); \
+      gridder::gridder<readcorr, mulaccum, stokesgrid>(np_grid, vis, uvw, flags, rowflags, weights, sumwt, bool(dopsf), Lcfs, LcfsConj, WInfos, increment, freqs, Lmaps, LJones, SmearMapping, Sparsification, LOptimisation,LSmearing,np_ChanMapping, expstokes, nthreads); \
       done=true;\
       }
     using namespace DDF::gridder::policies;
@@ -191,7 +193,8 @@ namespace DDF {
 			    const py::array_t<std::complex<float>, py::array::c_style>& np_grid,
 			    py::array_t<std::complex<float>, py::array::c_style>& np_vis,
 			    const py::array_t<double, py::array::c_style>& uvw,
-			    const py::array_t<bool, py::array::c_style>& flags,
+			    const py::array_t<uint8_t, py::array::c_style>& flags,
+			    const py::array_t<uint8_t, py::array::c_style>& rowflags,
 			    py::array_t<double, py::array::c_style>& /*sumwt*/,
 			    bool /*dopsf*/,
 			    const py::list& Lcfs,
@@ -207,7 +210,8 @@ namespace DDF {
 			    const py::list& LSmear,
 			    const py::array_t<int, py::array::c_style>& np_ChanMapping,
 			    const py::array_t<uint16_t, py::array::c_style>& LDataCorrFormat,
-			    const py::array_t<uint16_t, py::array::c_style>& LExpectedOutStokes
+			    const py::array_t<uint16_t, py::array::c_style>& LExpectedOutStokes,
+			    int nslices
 		    )
   {
       using svec = vector<string>;
@@ -232,7 +236,7 @@ namespace DDF {
     bool done=false;
     #define CALL_DEGRIDDER(STOKES, NVISPOL, NVISCORR)\
       {\
-      DDF::degridder::degridder<STOKES, NVISPOL, NVISCORR>(np_grid, np_vis, uvw, flags, Lcfs, LcfsConj, WInfos, increment, freqs, Lmaps, LJones, SmearMapping, LOptimisation, LSmear,np_ChanMapping);\
+      DDF::degridder::degridder<STOKES, NVISPOL, NVISCORR>(np_grid, np_vis, uvw, flags, rowflags, Lcfs, LcfsConj, WInfos, increment, freqs, Lmaps, LJones, SmearMapping, LOptimisation, LSmear,np_ChanMapping, nslices);\
       done=true;\
       }
     using namespace DDF::degridder::policies;
@@ -0,0 +1,70 @@
+/**
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+*/
+
+#ifndef GRIDDER_PACKEDFLAGS_H
+#define GRIDDER_PACKEDFLAGS_H
+
+#include <cstdint>
+#include <stdexcept>
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+
+namespace DDF {
+  namespace py=pybind11;
+
+  /* Read-only view of bit-packed flags, as produced by DDFacet/Array/PackedFlags.py:
+     a (nrow, ceil(nchan/8)) uint8 mask with one bit per row/channel (big-endian bit order
+     within each byte), plus a per-row summary (ROW_UNFLAGGED, ROW_PARTIAL or ROW_FLAGGED). */
+  class PackedFlags
+    {
+    private:
+      const uint8_t *flagsdata;
+      const uint8_t *rowdata;
+      size_t nbytes;
+
+    public:
+      enum { ROW_UNFLAGGED=0, ROW_PARTIAL=1, ROW_FLAGGED=2 };
+
+      PackedFlags(const py::array_t<uint8_t, py::array::c_style>& flags,
+		  const py::array_t<uint8_t, py::array::c_style>& rowflags,
+		  size_t nrows, size_t nchan)
+	: flagsdata(flags.data(0)), rowdata(rowflags.data(0)), nbytes((nchan+7)/8)
+	{
+	if (flags.ndim()!=2 || size_t(flags.shape(0))!=nrows || size_t(flags.shape(1))!=nbytes)
+	  throw std::invalid_argument("packed flags must have shape (nrow, ceil(nchan/8))");
+	if (rowflags.ndim()!=1 || size_t(rowflags.shape(0))!=nrows)
+	  throw std::invalid_argument("row flags must have shape (nrow,)");
+	}
+
+      /* per-row summary */
+      inline uint8_t row(size_t irow) const
+	{ return rowdata[irow]; }
+
+      /* pointer to packed channel bits of row */
+      inline const uint8_t *bits(size_t irow) const
+	{ return flagsdata + irow*nbytes; }
+
+      /* true if channel is flagged, given the packed bits of a row */
+      static inline bool isset(const uint8_t *rowbits, size_t chan)
+	{ return (rowbits[chan>>3] >> (7-(chan&7))) & 1; }
+    };
+}
+
+#endif /*GRIDDER_PACKEDFLAGS_H*/
@@ -23,6 +23,8 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 #include "common.h"
 #include "Semaphores.h"
+#include "PackedFlags.h"
+#include "BDAMapping.h"
 #include <iostream>
 #include <vector>
 #include <string>
@@ -55,12 +57,35 @@ namespace DDF{
         visPtr[1] -= visBuff[3];
     }
 
+    /* Splits a run-length block mapping into (at most) nslices runs of consecutive blocks, such that no two
+       runs share a row. Cuts are only made where a block starts past the rows of all preceding blocks, which
+       is the case between baselines of baseline-sorted data. Returns the nslice+1 slice boundaries. */
+    inline vector<size_t> RowSlices(const BDAMapping &bdamap, size_t nslices)
+    {
+        const size_t NTotBlocks = bdamap.size();
+        const size_t target = max(NTotBlocks/max(nslices, size_t(1)), size_t(1));
+        vector<size_t> sliceStart(1, 0);
+        BDAMapping::Cursor blocks = bdamap.cursor();
+        size_t maxEnd = 0;
+        for (size_t iBlock=0; iBlock<NTotBlocks; iBlock++)
+          {
+          const BDABlock blk = blocks.next();
+          const size_t row0 = size_t(blk.row0);
+          if (iBlock-sliceStart.back()>=target && row0>=maxEnd)
+            sliceStart.push_back(iBlock);
+          maxEnd = max(maxEnd, row0+size_t(blk.nrows));
+          }
+        sliceStart.push_back(NTotBlocks);
+        return sliceStart;
+    }
+
     template <StokesDegridType StokesDegrid, int nVisPol, int nVisCorr>
     void degridder(
       const py::array_t<std::complex<float>, py::array::c_style>& grid,
       py::array_t<std::complex<float>, py::array::c_style>& vis,
       const py::array_t<double, py::array::c_style>& uvw,
-      const py::array_t<bool, py::array::c_style>& flags,
+      const py::array_t<uint8_t, py::array::c_style>& flags,
+      const py::array_t<uint8_t, py::array::c_style>& rowflags,
       const py::list& Lcfs,
       const py::list& LcfsConj,
       const py::array_t<double, py::array::c_style>& Winfos,
@@ -71,7 +96,8 @@ namespace DDF{
       const py::array_t<int32_t, py::array::c_style>& SmearMapping,
       const py::list& LOptimisation,
       const py::list& LSmearing,
-      const py::array_t<int, py::array::c_style>& np_ChanMapping)
+      const py::array_t<int, py::array::c_style>& np_ChanMapping,
+      int nslices)
       {
       DDEs::DecorrelationHelper decorr(LSmearing, uvw);
 
@@ -81,7 +107,7 @@ namespace DDF{
       const double l0=ptrFacetInfos[2];
       const double m0=ptrFacetInfos[3];
       const double n0=sqrt(1-l0*l0-m0*m0)-1;
-      //const int facet = ptrFacetInfos[4];
+      const int facet = int(ptrFacetInfos[4]);
 
       /* Get size of grid. */
       const double *ptrWinfo = Winfos.data(0);
@@ -96,8 +122,11 @@ namespace DDF{
       const int nGridChan = int(grid.shape(0));
 
       /* Get visibility data size. */
-      const size_t nVisChan = size_t(flags.shape(1));
+      const size_t nVisChan = size_t(vis.shape(1));
       const size_t nrows    = size_t(uvw.shape(0));
+      /* flags are bit-packed per row/channel; they are not needed to degrid, but are checked for consistency */
+      const PackedFlags packedflags(flags, rowflags, nrows, nVisChan);
+      (void)packedflags;
       const double *uvwdata = uvw.data(0);
 
       /* MR FIXME: should this be "/2" or "/2."? */
@@ -107,11 +136,8 @@ namespace DDF{
       /* MR FIXME: should the second entry depend on nGridY instead of nGridX? */
       const double uvwScale_p[]= {nGridX*incr[0], nGridX*incr[1]};
 
-      const int *MappingBlock = SmearMapping.data(0);
-      /* total size is in two words */
-      const size_t NTotBlocks = size_t(MappingBlock[0]) + (size_t(MappingBlock[1])<<32);
-      const int *NRowBlocks = MappingBlock+2;
-      const int *StartRow = MappingBlock+2+NTotBlocks;
+      const BDAMapping bdamap(SmearMapping);
+      const size_t NTotBlocks = bdamap.size();
 
       CorrectionCalculator Corrcalc(LOptimisation);
       /* ######################################################## */
@@ -129,17 +155,16 @@ namespace DDF{
       fcmplx* __restrict__ visdata = vis.mutable_data(0);
       JS.resetJonesServerCounter();
 
-      for (size_t iBlock=0; iBlock<NTotBlocks; iBlock++)
+      /* degrids one block, and subtracts it from its rows. If lockrows is set, the rows are locked (by
+	 row-group semaphores) while they are being written to, since other facets may be working on the same rows */
+      auto degridBlock = [&](const BDABlock &blk, bool lockrows)
 	{
-	const int NRowThisBlock=NRowBlocks[iBlock]-2;
-	const size_t chStart = size_t(StartRow[0]),
-		    chEnd   = size_t(StartRow[1]);
-	const int *Row = StartRow+2;
-	/* advance pointer to next blocklist */
-	StartRow += NRowBlocks[iBlock];
+	const int NRowThisBlock=blk.nrows;
+	const size_t chStart = blk.chStart,
+		    chEnd   = blk.chEnd;
 
 	const int gridChan = p_ChanMapping[chStart];
-	if (gridChan<0 || gridChan>=nGridChan) continue;
+	if (gridChan<0 || gridChan>=nGridChan) return;
 
 	double FreqMean=0;
 	for (auto visChan=chStart; visChan<chEnd; ++visChan)
@@ -150,7 +175,7 @@ namespace DDF{
 	double Umean=0, Vmean=0, Wmean=0;
 	for (auto inx=0; inx<NRowThisBlock; inx++)
 	  {
-	  const size_t irow = size_t(Row[inx]);
+	  const size_t irow = size_t(blk.row(inx));
 	  if (irow>nrows) continue;
 	  const double* __restrict__ uvwPtr = uvwdata + irow*3;
 	  const double U=uvwPtr[0];
@@ -163,7 +188,7 @@ namespace DDF{
 	  ++NVisThisblock;
 	  }
 
-	if (NVisThisblock==0) continue;
+	if (NVisThisblock==0) return;
 
 	Umean/=NVisThisblock;
 	Vmean/=NVisThisblock;
@@ -172,7 +197,7 @@ namespace DDF{
 
 	/* ############## W-projection #################### */
 	const int iwplane = int(lrint((NwPlanes-1)*abs(Wmean)*(WaveRefWave*recipWvl)/wmax));
-	if (iwplane>=NwPlanes) continue;
+	if (iwplane>=NwPlanes) return;
 
 	auto cfs=py::array_t<complex<float>, py::array::c_style>(
 	  (Wmean>0) ? Lcfs[iwplane] : LcfsConj[iwplane]);
@@ -191,7 +216,7 @@ namespace DDF{
 
 	/* Only use visibility point if the full support is within grid. */
 	if (locx-supx<0 || locx+supx>=nGridX || locy-supy<0 || locy+supy>=nGridY)
-	  continue;
+	  return;
 
 	dcMat stokes_vis;
 
@@ -218,26 +243,27 @@ namespace DDF{
 	dcMat corr_vis = StokesDegrid(stokes_vis);
         if (JS.DoApplyJones==2)
           {
-          size_t irow = Row[NRowThisBlock/2];
+          size_t irow = blk.row(NRowThisBlock/2);
 	  const double* __restrict__ uvwPtr = uvwdata + irow*3;
 	  JS.updateJones(irow, (chStart+chEnd)/2, uvwPtr, false, false);
 	  ApplyJones(JS, corr_vis, 1., corr_vis);
 	  }
 
 	/*################### Now do the correction #################*/
-	double DeCorrFactor=decorr.get(FreqMean, Row[NRowThisBlock/2]);
+	double DeCorrFactor=decorr.get(FreqMean, blk.row(NRowThisBlock/2));
 
 	for (auto inx=0; inx<NRowThisBlock; inx++)
 	  {
-	  size_t irow = size_t(Row[inx]);
+	  size_t irow = size_t(blk.row(inx));
 	  if (irow>nrows) continue;
 	  const double* __restrict__ uvwPtr = uvwdata + irow*3;
 	  const double angle = 2.*PI*(uvwPtr[0]*l0+uvwPtr[1]*m0+uvwPtr[2]*n0)/C;
 
 	  Corrcalc.update();
 
-	  auto Sem_mutex = GiveSemaphoreFromCell(irow);
-	  sem_wait(Sem_mutex);
+	  sem_t *Sem_mutex = lockrows ? GiveSemaphoreFromCell(irow) : 0;
+	  if (Sem_mutex)
+	    sem_wait(Sem_mutex);
 
 	  for (auto visChan=chStart; visChan<chEnd; ++visChan)
 	    {
@@ -263,9 +289,53 @@ namespace DDF{
 	    /* Finally subtract visibilities from current residues */
 	    subtractVis<nVisCorr>(visPtr, visBuff);
 	    }/*endfor vischan*/
-	  sem_post(Sem_mutex);
+	  if (Sem_mutex)
+	    sem_post(Sem_mutex);
 	  }/*endfor RowThisBlock*/
-	} /*end for Block*/
+	}; /*end degridBlock*/
+
+      if (bdamap.isRunLength() && nslices>0)
+	{
+	/* Baseline-sorted data: the chunk is split into slices of blocks with disjoint rows (see RowSlices()).
+	   A slice is only ever worked on by one facet at a time, so rows need not be locked individually: the
+	   slice is locked once, and facets that find it busy move on to another slice. Facets start out at
+	   different slices, so they rarely have to wait. */
+	const vector<size_t> sliceStart = RowSlices(bdamap, size_t(nslices));
+	const size_t nSlice = sliceStart.size()-1;
+	vector<size_t> pending;
+	const size_t firstSlice = size_t(facet) % nSlice;
+	for (size_t i=0; i<nSlice; ++i)
+	  pending.push_back((firstSlice+i) % nSlice);
+	while (!pending.empty())
+	  {
+	  /* take the first slice that is not busy, or else wait for the first pending one */
+	  size_t ipend = 0;
+	  sem_t *Sem_slice = 0;
+	  for (size_t i=0; i<pending.size() && !Sem_slice; ++i)
+	    if (sem_trywait(GiveSemaphoreFromCell(pending[i]))==0)
+	      {
+	      ipend = i;
+	      Sem_slice = GiveSemaphoreFromCell(pending[i]);
+	      }
+	  if (!Sem_slice)
+	    {
+	    Sem_slice = GiveSemaphoreFromCell(pending[0]);
+	    sem_wait(Sem_slice);
+	    }
+	  const size_t islice = pending[ipend];
+	  pending.erase(pending.begin()+long(ipend));
+	  BDAMapping::Cursor blocks = bdamap.cursor(sliceStart[islice]);
+	  for (size_t iBlock=sliceStart[islice]; iBlock<sliceStart[islice+1]; iBlock++)
+	    degridBlock(blocks.next(), false);
+	  sem_post(Sem_slice);
+	  }
+	}
+      else
+	{
+	BDAMapping::Cursor blocks = bdamap.cursor();
+	for (size_t iBlock=0; iBlock<NTotBlocks; iBlock++)
+	  degridBlock(blocks.next(), true);
+	}
       } /* end */
   }
 }
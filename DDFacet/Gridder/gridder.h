@@ -23,11 +23,14 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 #include "common.h"
 #include "Semaphores.h"
+#include "PackedFlags.h"
+#include "BDAMapping.h"
 #include <stdio.h>
 #include <iostream>
 #include <vector>
 #include <string>
 #include <algorithm>
+#include <omp.h>
 #include "JonesServer.h"
 #include "Stokes.h"
 #include "DecorrelationHelper.h"
@@ -75,11 +78,25 @@ namespace DDF {
 	  Vis[0] += VisMeas[0]*Weight;
 	}
     }
+    /* Result of averaging one BDA block, ready to be gridded */
+    struct GridBlock
+      {
+      dcMat stokes_vis;
+      const fcmplx *cf;   /* convolution function, at the block's oversampling offset */
+      int gridChan, locx, locy, supx, supy;
+      double ThisWeight, ThisSumJones, ThisSumSqWeights;
+      bool valid;
+      };
+
+    /* number of BDA blocks averaged per gridding batch */
+    const size_t GridBatchSize = 16384;
+
     template<policies::ReadCorrType readcorr, policies::MulaccumType mulaccum, policies::StokesGridType stokesgrid>
     void gridder(py::array_t<std::complex<float>, py::array::c_style>& grid,
 		const py::array_t<std::complex<float>, py::array::c_style>& vis,
 		const py::array_t<double, py::array::c_style>& uvw,
-		const py::array_t<bool, py::array::c_style>& flags,
+		const py::array_t<uint8_t, py::array::c_style>& flags,
+		const py::array_t<uint8_t, py::array::c_style>& rowflags,
 		const py::array_t<float, py::array::c_style>& weights,
 		py::array_t<double, py::array::c_style>& sumwt,
 		bool dopsf,
@@ -95,7 +112,8 @@ namespace DDF {
 		const py::list& LOptimisation,
 		const py::list& LSmearing,
 		const py::array_t<int, py::array::c_style>& np_ChanMapping,
-		const vector<string> &expstokes)
+		const vector<string> &expstokes,
+		int nthreads)
       {
       auto nVisPol = expstokes.size();
       DDEs::DecorrelationHelper decorr(LSmearing, uvw);
@@ -123,10 +141,11 @@ namespace DDF {
       const fcmplx *visdata = vis.data(0);
 
       /* Get visibility data size. */
-      const size_t nVisCorr = size_t(flags.shape(2));
-      const size_t nVisChan = size_t(flags.shape(1));
-      const bool *flagsdata = flags.data(0);
+      const size_t nVisCorr = size_t(vis.shape(2));
+      const size_t nVisChan = size_t(vis.shape(1));
       const size_t nrows    = size_t(uvw.shape(0));
+      /* flags are bit-packed per row/channel (see DDFacet/Array/PackedFlags.py) */
+      const PackedFlags packedflags(flags, rowflags, nrows, nVisChan);
       const double *uvwdata = uvw.data(0);
 
       const float *weightsdata = weights.data(0);
@@ -140,11 +159,8 @@ namespace DDF {
       /* MR FIXME: should the second entry depend on nGridY instead of nGridX? */
       const double uvwScale_p[]= {nGridX*incr[0], nGridX*incr[1]};
 
-      const int *MappingBlock = SmearMapping.data(0);
-      /* total size is in two words */
-      const size_t NTotBlocks = size_t(MappingBlock[0]) + (size_t(MappingBlock[1])<<32);
-      const int *NRowBlocks = MappingBlock+2;
-      const int *StartRow = MappingBlock+2+NTotBlocks;
+      const BDAMapping bdamap(SmearMapping);
+      const size_t NTotBlocks = bdamap.size();
 
       /* in sparsification mode, the Sparsification argument is an array of length NTotBlocks flags. */
       /* Only blocks with a True flag will be gridded. */
@@ -174,30 +190,84 @@ namespace DDF {
 //      if( !facet )
 //        cerr<<"BDAJones grid mode "<<JS.DoApplyJones<<endl<<endl;
 
-      vector<double> ThisSumJonesChan(nVisChan),      // accumulates sum of w*decorr*decorr*||M||
-                     ThisSumSqWeightsChan(nVisChan);  // accumulates sum of w*decorr*decorr
+      /* w-plane convolution functions. These are extracted up front, since the gridding threads
+         can't touch Python objects */
+      vector<py::array_t<complex<float>, py::array::c_style>> cfsPlanes, cfsPlanesConj;
+      for (size_t iw=0; iw<Lcfs.size(); ++iw)
+	{
+	cfsPlanes.push_back(py::array_t<complex<float>, py::array::c_style>(Lcfs[iw]));
+	cfsPlanesConj.push_back(py::array_t<complex<float>, py::array::c_style>(LcfsConj[iw]));
+	}
 
       const int *p_ChanMapping=np_ChanMapping.data(0);
-      for (size_t iBlock=0; iBlock<NTotBlocks; iBlock++)
+
+      /* Gridding is done in batches of blocks, in two phases. In the first phase, the blocks of the batch are
+	 averaged (in parallel) into GridBlock entries. In the second, these are convolved onto the grid, which is
+	 split into stripes of rows: each thread grids all blocks overlapping its stripe, in block order, and only
+	 writes to the rows of its stripe. Each grid cell thus sees the same sequence of updates as in a
+	 single-threaded run, and the result does not depend on the number of threads. */
+      const int nthr = max(nthreads, 1);
+      vector<DDEs::JonesServer> threadJS(size_t(nthr), JS);
+      vector<CorrectionCalculator> threadCorrcalc(size_t(nthr), Corrcalc);
+      const int StripeHeight = max(nGridY/(4*nthr), 1);
+      const int nStripes = (nGridY+StripeHeight-1)/StripeHeight;
+
+      vector<BDABlock> batchBlocks;
+      vector<GridBlock> batch;
+      vector<size_t> batchChanOffset;
+      vector<double> batchChanSums;       // per-channel ThisSumJonesChan and ThisSumSqWeightsChan of each block
+      vector<size_t> stripeStart(size_t(nStripes)+1);
+      vector<size_t> stripeBlocks;
+
+      /* compute workers run with dynamic OpenMP threads (see AsyncProcessPool), which would let the runtime cut
+	 down the thread budget */
+      const int omp_dynamic = omp_get_dynamic();
+      omp_set_dynamic(0);
+
+      BDAMapping::Cursor blocks = bdamap.cursor();
+      for (size_t iBatch=0; iBatch<NTotBlocks; iBatch+=GridBatchSize)
 	{
-        JS.resetJonesServerCounter();
-	const int NRowThisBlock=NRowBlocks[iBlock]-2;
-	const size_t chStart = size_t(StartRow[0]),
-		    chEnd   = size_t(StartRow[1]);
-	const int *Row = StartRow+2;
-	/* advance pointer to next blocklist */
-	StartRow += NRowBlocks[iBlock];
+	const size_t nBatch = min(GridBatchSize, NTotBlocks-iBatch);
+	batchBlocks.resize(nBatch);
+	batch.resize(nBatch);
+	batchChanOffset.resize(nBatch);
+	size_t nChanSums = 0;
+	for (size_t i=0; i<nBatch; ++i)
+	  {
+	  batchBlocks[i] = blocks.next();
+	  batchChanOffset[i] = nChanSums;
+	  nChanSums += batchBlocks[i].chEnd-batchBlocks[i].chStart;
+	  }
+	batchChanSums.resize(2*nChanSums);
 
+	/* ############## Phase 1: averaging ############## */
+	#pragma omp parallel for num_threads(nthr) schedule(dynamic, 64)
+	for (size_t i=0; i<nBatch; ++i)
+	{
+	const size_t iBlock = iBatch+i;
+	DDEs::JonesServer &JS = threadJS[size_t(omp_get_thread_num())];
+	CorrectionCalculator &Corrcalc = threadCorrcalc[size_t(omp_get_thread_num())];
+	const BDABlock &blk = batchBlocks[i];
+	GridBlock &gb = batch[i];
+	gb.valid = false;
+
+        JS.resetJonesServerCounter();
+	const int NRowThisBlock=blk.nrows;
+	const size_t chStart = blk.chStart,
+		    chEnd   = blk.chEnd;
 
 	if (sparsificationFlag && !sparsificationFlag[iBlock])
 	  continue;
 
 	dcMat Vis(0,0,0,0); // this is what will get gridded in the end
 
-	for (size_t visChan=0; visChan<nVisChan; ++visChan)
+	/* per-channel sums of this block, for channels chStart to chEnd */
+	double *ThisSumJonesChan = batchChanSums.data() + 2*batchChanOffset[i] - chStart;
+	double *ThisSumSqWeightsChan = ThisSumJonesChan + (chEnd-chStart);
+	for (size_t visChan=chStart; visChan<chEnd; ++visChan)
 	  ThisSumJonesChan[visChan] = ThisSumSqWeightsChan[visChan] = 0;
 
-	double DeCorrFactor = decorr.get(FreqMean0, Row[NRowThisBlock/2]);
+	double DeCorrFactor = decorr.get(FreqMean0, blk.row(NRowThisBlock/2));
 
 	double visChanMean=0., FreqMean=0;
 	double ThisWeight=0., ThisSumJones=0., ThisSumSqWeights=0.;
@@ -209,8 +279,11 @@ namespace DDF {
 
 	for (auto inx=0; inx<NRowThisBlock; inx++)
 	  {
-	  const size_t irow = size_t(Row[inx]);
+	  const size_t irow = size_t(blk.row(inx));
 	  if (irow>nrows) continue;
+	  const uint8_t rowflag = packedflags.row(irow);
+	  if (rowflag==PackedFlags::ROW_FLAGGED) continue;
+	  const uint8_t *rowflagbits = packedflags.bits(irow);
 	  const double* __restrict__ uvwPtr = uvwdata + irow*3;
 	  const double U=uvwPtr[0];
 	  const double V=uvwPtr[1];
@@ -224,8 +297,8 @@ namespace DDF {
 	    size_t doff = size_t((irow*nVisChan + visChan) * nVisCorr);
 	    const float *imgWtPtr = weightsdata + irow*nVisChan + visChan;
 
-	    /* We can do that since all flags in 4-pols are equalised in ClassVisServer */
-	    if (flagsdata[doff]) continue;
+	    /* flags are equalised across correlations, so there is one flag bit per channel */
+	    if (rowflag!=PackedFlags::ROW_UNFLAGGED && PackedFlags::isset(rowflagbits, visChan)) continue;
 
 	    dcmplx corr = dopsf ? 1 : Corrcalc.getCorr(Pfreqs, visChan, angle);
 
@@ -260,9 +333,6 @@ namespace DDF {
 	      /*Compute per channel and overall approximate matrix sqroot:*/
 	      ThisSumJones += JS.BB*FWeightDecorr;
 	      ThisSumJonesChan[visChan] += JS.BB*FWeightDecorr;
-//  	      if(facet==0 && visChan==0)
-//                std::fprintf(stderr,"F%dB%dR%d weight %f jones %f %f BB %f wsq %f sj %f\n",facet,iBlock,irow,FWeight,JS.J0.v[0].real(),JS.J0.v[0].imag(),
-//				JS.BB,FWeightSq,ThisSumJonesChan[0]);
 	      }
 	    else /* Don't apply Jones */
 	      mulaccum(VisMeas, Weight, Vis);
@@ -290,7 +360,7 @@ namespace DDF {
         if (JS.DoApplyJones==2)
             {
             double uvw_mean[] = { Umean, Vmean, Wmean };
-            JS.updateJones(Row[NRowThisBlock/2], (chStart+chEnd)/2, uvw_mean, 0, 1);
+            JS.updateJones(blk.row(NRowThisBlock/2), (chStart+chEnd)/2, uvw_mean, 0, 1);
             if (dopsf)
               Vis = ((JS.J0).times(Vis)).times(JS.J1H);
             Vis = (JS.J0H.times(Vis)).times(JS.J1);
@@ -311,7 +381,7 @@ namespace DDF {
 
 	/* ################################################ */
 	/* ######## Convert correlations to stokes ######## */
-	const dcMat stokes_vis(stokesgrid(Vis));
+	gb.stokes_vis = stokesgrid(Vis);
 
 	/* ################################################ */
 	/* ############## Start Gridding visibility ####### */
@@ -323,8 +393,7 @@ namespace DDF {
 	const int iwplane = int(lrint((NwPlanes-1)*abs(Wmean)*(WaveRefWave*recipWvl)/wmax));
 	if (iwplane>=NwPlanes) continue;
 
-	auto cfs=py::array_t<complex<float>, py::array::c_style>(
-	  (Wmean>0) ? Lcfs[iwplane] : LcfsConj[iwplane]);
+	const auto &cfs = (Wmean>0) ? cfsPlanes[size_t(iwplane)] : cfsPlanesConj[size_t(iwplane)];
 	const int nConvX = int(cfs.shape(0));
 	const int nConvY = int(cfs.shape(1));
 	const int supx = (nConvX/OverS-1)/2;
@@ -349,30 +418,91 @@ namespace DDF {
 	const int jo = offx - supx*OverS;
 	const int cfoff = (io*OverS + jo)*SupportCF*SupportCF;
 
-	for (size_t ipol=0; ipol<nVisPol; ++ipol)
+	gb.cf = cfsdata + cfoff;
+	gb.gridChan = gridChan;
+	gb.locx = locx;
+	gb.locy = locy;
+	gb.supx = supx;
+	gb.supy = supy;
+	gb.ThisWeight = ThisWeight;
+	gb.ThisSumJones = ThisSumJones;
+	gb.ThisSumSqWeights = ThisSumSqWeights;
+	gb.valid = true;
+	} /*end for Block (phase 1)*/
+
+	/* ############## Phase 2: gridding ############### */
+	/* list the blocks overlapping each stripe, in block order */
+	std::fill(stripeStart.begin(), stripeStart.end(), 0);
+	for (size_t i=0; i<nBatch; ++i)
+	  if (batch[i].valid)
+	    for (int s=(batch[i].locy-batch[i].supy)/StripeHeight; s<=(batch[i].locy+batch[i].supy)/StripeHeight; ++s)
+	      ++stripeStart[size_t(s)+1];
+	for (size_t s=0; s<size_t(nStripes); ++s)
+	  stripeStart[s+1] += stripeStart[s];
+	stripeBlocks.resize(stripeStart[size_t(nStripes)]);
+	{
+	vector<size_t> fill(stripeStart.begin(), stripeStart.end()-1);
+	for (size_t i=0; i<nBatch; ++i)
+	  if (batch[i].valid)
+	    for (int s=(batch[i].locy-batch[i].supy)/StripeHeight; s<=(batch[i].locy+batch[i].supy)/StripeHeight; ++s)
+	      stripeBlocks[fill[size_t(s)]++] = i;
+	}
+
+	#pragma omp parallel for num_threads(nthr) schedule(dynamic, 1)
+	for (int s=0; s<nStripes; ++s)
 	  {
-	  if (ipol>=size_t(nGridPol)) continue;
-	  const size_t goff = size_t((gridChan*nGridPol + ipol) * nGridX*nGridY);
-	  const dcmplx VisVal =stokes_vis[ipol];
-	  const fcmplx* __restrict__ cf0 = cfsdata + cfoff;
-	  fcmplx* __restrict__ gridPtr = griddata + goff + (locy-supy)*nGridX + locx;
-	  for (int sy=-supy; sy<=supy; ++sy, gridPtr+=nGridX)
-	    for (int sx=-supx; sx<=supx; ++sx)
-	      gridPtr[sx] += VisVal * dcmplx(*cf0++);
-	  sumWtPtr[ipol+gridChan*nGridPol] += ThisWeight;
-	  if (JS.DoApplyJones)
+	  const int yStart = s*StripeHeight,
+		    yEnd   = min(yStart+StripeHeight, nGridY);
+	  for (size_t k=stripeStart[size_t(s)]; k<stripeStart[size_t(s)+1]; ++k)
 	    {
-	    JS.ptrSumJones[gridChan]+=ThisSumJones;
-	    JS.ptrSumJones[gridChan+nGridChan]+=ThisSumSqWeights;
-
-	    for(size_t visChan=chStart; visChan<chEnd; visChan++)
+	    const GridBlock &gb = batch[stripeBlocks[k]];
+	    const int supx = gb.supx, supy = gb.supy;
+	    /* rows of the support that fall within this stripe */
+	    const int sy0 = max(-supy, yStart-gb.locy),
+		      sy1 = min(supy, yEnd-1-gb.locy);
+	    for (size_t ipol=0; ipol<nVisPol; ++ipol)
 	      {
-	      JS.ptrSumJonesChan[visChan]+=ThisSumJonesChan[visChan];
-	      JS.ptrSumJonesChan[nVisChan+visChan]+=ThisSumSqWeightsChan[visChan];
+	      if (ipol>=size_t(nGridPol)) continue;
+	      const size_t goff = size_t((gb.gridChan*nGridPol + int(ipol)) * nGridX*nGridY);
+	      const dcmplx VisVal =gb.stokes_vis[ipol];
+	      const fcmplx* __restrict__ cf0 = gb.cf + (sy0+supy)*(2*supx+1);
+	      fcmplx* __restrict__ gridPtr = griddata + goff + (gb.locy+sy0)*nGridX + gb.locx;
+	      for (int sy=sy0; sy<=sy1; ++sy, gridPtr+=nGridX)
+		for (int sx=-supx; sx<=supx; ++sx)
+		  gridPtr[sx] += VisVal * dcmplx(*cf0++);
 	      }
 	    }
-	  } /* end for ipol */
-	} /*end for Block*/
+	  }
+
+	/* weight and Jones sums, in block order */
+	for (size_t i=0; i<nBatch; ++i)
+	  {
+	  const GridBlock &gb = batch[i];
+	  if (!gb.valid) continue;
+	  const size_t chStart = batchBlocks[i].chStart,
+		      chEnd   = batchBlocks[i].chEnd;
+	  const double *ThisSumJonesChan = batchChanSums.data() + 2*batchChanOffset[i] - chStart;
+	  const double *ThisSumSqWeightsChan = ThisSumJonesChan + (chEnd-chStart);
+	  const int gridChan = gb.gridChan;
+	  for (size_t ipol=0; ipol<nVisPol; ++ipol)
+	    {
+	    if (ipol>=size_t(nGridPol)) continue;
+	    sumWtPtr[ipol+gridChan*nGridPol] += gb.ThisWeight;
+	    if (JS.DoApplyJones)
+	      {
+	      JS.ptrSumJones[gridChan]+=gb.ThisSumJones;
+	      JS.ptrSumJones[gridChan+nGridChan]+=gb.ThisSumSqWeights;
+
+	      for(size_t visChan=chStart; visChan<chEnd; visChan++)
+		{
+		JS.ptrSumJonesChan[visChan]+=ThisSumJonesChan[visChan];
+		JS.ptrSumJonesChan[nVisChan+visChan]+=ThisSumSqWeightsChan[visChan];
+		}
+	      }
+	    } /* end for ipol */
+	  }
+	} /*end for batch*/
+      omp_set_dynamic(omp_dynamic);
       } /* end */
     }
 }
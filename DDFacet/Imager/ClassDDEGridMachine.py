@@ -49,6 +49,7 @@ from DDFacet.ToolsDir.ModToolBox import EstimateNpix
 from DDFacet.ToolsDir import ModFFTW
 from DDFacet.Parset import ReadCFG
 from DDFacet.Other import ClassTimeIt
+from DDFacet.Array import PackedFlags
 from DDFacet.Data import ClassVisServer
 from DDFacet.Other import logger
 log = logger.getLogger("ClassDDEGridMachine")
@@ -166,7 +167,7 @@ def testGrid():
 
     # uvw.fill(0)
     
-    flag = np.bool8(DATA["flags"])  # [row0:row1,:,:].copy()
+    flag = DATA["flags"]  # [row0:row1,:,:].copy()
     # ind=np.where(np.logical_not((A0==12)&(A1==14)))[0]
     # flag[ind,:,:]=1
     # flag.fill(0)
@@ -678,14 +679,15 @@ class ClassDDEGridMachine():
 
     def put(self, times, uvw, visIn, flag, A0A1, W=None,
             PointingID=0, DoNormWeights=True, DicoJonesMatrices=None,
-            freqs=None, DoPSF=0, ChanMapping=None, ResidueGrid=None, sparsification=None):
+            freqs=None, DoPSF=0, ChanMapping=None, ResidueGrid=None, sparsification=None, rowflags=None,
+            nthreads=1):
         """
         Gridding routine, wraps external python extension C gridder
         Args:
             times:
             uvw:
             visIn:
-            flag:
+            flag: packed flags (see PackedFlags), or a bool array of the same shape as visIn
             A0A1:
             W:
             PointingID:
@@ -695,6 +697,9 @@ class ClassDDEGridMachine():
             DoPSF:
             ChanMapping:
             ResidueGrid:
+            sparsification:
+            rowflags: per-row flag summary accompanying packed flags. Computed if not supplied.
+            nthreads: number of threads used by the BDA gridder
         Returns:
 
         """
@@ -733,12 +738,7 @@ class ClassDDEGridMachine():
             W = np.ones((uvw.shape[0], NVisChan), dtype=np.float64)
 
         SumWeigths = self.SumWeigths
-        if vis.shape != flag.shape:
-            raise Exception(
-                'vis[%s] and flag[%s] should have the same shape' %
-                (str(
-                    vis.shape), str(
-                    flag.shape)))
+        flag, rowflags = self.GivePackedFlags(vis, flag, rowflags)
 
         u, v, w = uvw.T
 
@@ -788,6 +788,7 @@ class ClassDDEGridMachine():
                                           vis,
                                           uvw,
                                           flag,
+                                          rowflags,
                                           W,
                                           SumWeigths,
                                           DoPSF,
@@ -809,7 +810,8 @@ class ClassDDEGridMachine():
                                           self.LSmear,
                                           np.int32(ChanMapping),
                                           np.array(self.DataCorrelationFormat).astype(np.uint16),
-                                          np.array(self.ExpectedOutputStokes).astype(np.uint16))
+                                          np.array(self.ExpectedOutputStokes).astype(np.uint16),
+                                          int(nthreads))
 
             T.timeit("gridder")
             T.timeit("grid %d" % self.IDFacet)
@@ -822,7 +824,7 @@ class ClassDDEGridMachine():
             _pyGridderSmearClassic.pyGridderWPol(Grid,
                                           vis,
                                           uvw,
-                                          flag,
+                                          PackedFlags.unpack(flag, vis.shape[1], vis.shape[2]),
                                           W,
                                           SumWeigths,
                                           DoPSF,
@@ -851,6 +853,28 @@ class ClassDDEGridMachine():
         T.timeit("gridder")
         T.timeit("grid %d" % self.IDFacet)
 
+    def GivePackedFlags(self, vis, flag, rowflags=None):
+        """
+        Returns packed flags and per-row summary (see PackedFlags) to be passed to the gridder/degridder.
+        A bool flag array of the same shape as vis is also accepted (and packed on the fly).
+        """
+        if flag.dtype == np.bool_:
+            if vis.shape != flag.shape:
+                raise Exception(
+                    'vis[%s] and flag[%s] should have the same shape' %
+                    (str(vis.shape), str(flag.shape)))
+            return PackedFlags.pack(flag)
+        packed_shape = PackedFlags.packedShape(vis.shape[0], vis.shape[1])
+        if flag.shape != packed_shape:
+            raise Exception(
+                'vis[%s] expects packed flags of shape %s, got flag[%s]' %
+                (str(vis.shape), str(packed_shape), str(flag.shape)))
+        if rowflags is None:
+            rowflags = PackedFlags.rowSummary(flag, vis.shape[1])
+        elif rowflags.shape != (vis.shape[0],) or rowflags.dtype != np.uint8:
+            raise TypeError("rowflags must be a uint8 vector of length %d" % vis.shape[0])
+        return flag, rowflags
+
     def CheckTypes(
         self,
         Grid=None,
@@ -882,7 +906,7 @@ class ClassDDEGridMachine():
             if not(uvw.flags.c_contiguous):
                 raise NameError("uvw has to be contiguous")
         if not isinstance(flag, type(None)):
-            if not(flag.dtype == np.bool8):
+            if not(flag.dtype == np.uint8):
                 raise NameError('flag.dtype %s' % (str(flag.dtype)))
             if not(flag.flags.c_contiguous):
                 raise NameError("flag to be contiguous")
@@ -920,7 +944,18 @@ class ClassDDEGridMachine():
             PointingID=0,
             Row0Row1=(0, -1),
             DicoJonesMatrices=None, freqs=None, ImToGrid=True,
-            TranformModelInput="", ChanMapping=None, sparsification=None):
+            TranformModelInput="", ChanMapping=None, sparsification=None, rowflags=None,
+            nslices=0):
+        """
+        Degridding routine, wraps external python extension C degridder. The
+        model is subtracted from visIn in place.
+        Args:
+            nslices: with a run-length BDA mapping, number of row slices that
+                facets lock in turn while subtracting the model (see
+                Parallel.DegridRowSlices). 0 locks individual rows instead.
+        Returns:
+            the model-subtracted visibilities
+        """
         T = ClassTimeIt.ClassTimeIt("get")
         T.disable()
         vis = visIn.view()
@@ -965,12 +1000,7 @@ class ClassDDEGridMachine():
         npol = self.npol
         NChan = self.NChan
         SumWeigths = self.SumWeigths
-        if vis.shape != flag.shape:
-            raise Exception(
-                'vis[%s] and flag[%s] should have the same shape' %
-                (str(
-                    vis.shape), str(
-                    flag.shape)))
+        flag, rowflags = self.GivePackedFlags(vis, flag, rowflags)
 
         l0, m0 = self.lmShift
         FacetInfos = np.float64(
@@ -1020,21 +1050,18 @@ class ClassDDEGridMachine():
         if self.GD["RIME"]["ForwardMode"]=="Classic":
             # this bastard only does 4 pol data.... put in an ugly kludge to support dual and single corr data
             assert vis.ndim == 3
+            # packed flags are already equalized across correlations, which is what the degridder expects
+            flag_padded = PackedFlags.unpack(flag, vis.shape[1], 4)
             if vis.shape[2] == 4:
                 vis_padded = vis.view()
-                flag_padded = flag.view()
             elif vis.shape[2] == 2:
                 vis_padded = np.zeros((vis.shape[0], vis.shape[1], 4), dtype=vis.dtype)
-                flag_padded = np.zeros((vis.shape[0], vis.shape[1], 4), dtype=flag.dtype)
                 vis_padded[:, :, 0] = vis[:, :, 0]
                 vis_padded[:, :, 3] = vis[:, :, 1]
-                flag_padded[:, :, :] = np.max(flag, axis=2)[:, :, None] # equalize flags since this is what the degridder expects
             elif vis.shape[2] == 1:
                 vis_padded = np.zeros((vis.shape[0], vis.shape[1], 4), dtype=vis.dtype)
-                flag_padded = np.zeros((vis.shape[0], vis.shape[1], 4), dtype=flag.dtype)
                 vis_padded[:, :, 0] = vis[:, :, 0]
                 vis_padded[:, :, 3] = vis[:, :, 0]
-                flag_padded[:, :, :] = np.max(flag, axis=2)[:, :, None] # equalize flags since this is what the degridder expects
             else:
                 raise ValueError("Expected visibility shape either 4, 2 or 1. Nothing else is supported")
 
@@ -1077,6 +1104,7 @@ class ClassDDEGridMachine():
                 vis, 
                 uvw, 
                 flag, 
+                rowflags,
                 SumWeigths, 
                 0, 
                 self.WTerm.WplanesConj,
@@ -1096,7 +1124,8 @@ class ClassDDEGridMachine():
                 OptimisationInfos,
                 self.LSmear, np.int32(ChanMapping),
                 np.array(self.DataCorrelationFormat).astype(np.uint16),
-                np.array(self.ExpectedOutputStokes).astype(np.uint16))
+                np.array(self.ExpectedOutputStokes).astype(np.uint16),
+                int(nslices))
         elif self.GD["RIME"]["ForwardMode"]=="BDA-degrid-classic":
             OptimisationInfos = [
                 self.JonesType,
@@ -1110,7 +1139,7 @@ class ClassDDEGridMachine():
                 Grid, 
                 vis, 
                 uvw, 
-                flag, 
+                PackedFlags.unpack(flag, vis.shape[1], vis.shape[2]),
                 SumWeigths, 
                 0, 
                 self.WTerm.WplanesConj,
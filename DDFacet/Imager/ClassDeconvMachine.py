@@ -184,6 +184,7 @@ class ClassImagerDeconv():
         AsyncProcessPool.init(ncpu=self.GD["Parallel"]["NCPU"],
                               affinity=self.GD["Parallel"]["Affinity"],
                               parent_affinity=self.GD["Parallel"]["MainProcessAffinity"],
+                              num_io_processes=self.GD["Parallel"]["NIOProcesses"],
                               verbose=self.GD["Debug"]["APPVerbose"],
                               pause_on_start=self.GD["Debug"]["PauseWorkers"])
 
@@ -629,9 +630,11 @@ class ClassImagerDeconv():
         # run FM loop if need to generate either
         if not (dirty_valid and psf_valid):
             print(ModColor.Str("============================== Making Dirty Image and/or PSF ===================="), file=log)
+            # don't read ahead more than one chunk if residuals are written back to the MS as we go
+            prefetch = not (self.DoDirtySub and self.GD["Output"]["Mode"] == "Dirty" and self.GD["Predict"]["ColName"])
             # tell the I/O thread to go load the first chunk
             self.VS.ReInitChunkCount()
-            self.VS.startChunkLoadInBackground()
+            self.VS.startChunkLoadInBackground(prefetch=prefetch)
             if not dirty_valid:
                 self.FacetMachine.ReinitDirty()
             if psf and not psf_valid and self.FacetMachinePSF is not None:
@@ -649,7 +652,7 @@ class ClassImagerDeconv():
 
                 # get loaded chunk from I/O thread, schedule next chunk
                 # self.VS.startChunkLoadInBackground()
-                DATA = self.VS.collectLoadedChunk(start_next=True)
+                DATA = self.VS.collectLoadedChunk(start_next=True, prefetch=prefetch)
 
                 if type(DATA) is str:
                     print(ModColor.Str("no more data: %s"%DATA, col="red"), file=log)
@@ -865,9 +868,10 @@ class ClassImagerDeconv():
         if not self.GD["Predict"]["FromImage"] and not self.GD["Predict"]["InitDicoModel"]:
             raise ValueError("--Predict-FromImage or --Predict-InitDicoModel must be set")
 
-        # tell the I/O thread to go load the first chunk
+        # tell the I/O thread to go load the first chunk. No read-ahead beyond that, since each chunk
+        # is written back to the MS
         self.VS.ReInitChunkCount()
-        self.VS.startChunkLoadInBackground(last_cycle=True)
+        self.VS.startChunkLoadInBackground(last_cycle=True, prefetch=False)
 
         self.FacetMachine.ReinitDirty()
 
@@ -938,11 +942,13 @@ class ClassImagerDeconv():
         while True:
             # get loaded chunk from I/O thread, schedule next chunk
             # self.VS.startChunkLoadInBackground()
-            DATA = self.VS.collectLoadedChunk(start_next=True, last_cycle=True)
+            DATA = self.VS.collectLoadedChunk(start_next=True, last_cycle=True, prefetch=False)
             if self.VS.StokesConverter.RequiredStokesProducts() != ['I']:
                 raise RuntimeError("Unsupported: Polarization prediction is not defined")
             if type(DATA) is str:
                 print(ModColor.Str("no more data: %s" % DATA, col="red"), file=log)
+                # wait for outstanding column writes
+                self.VS.collectPutColumnResults()
                 break
             # None weights indicates an all-flagged chunk: go on to the next chunk
             if DATA["Weights"] is None:
@@ -1041,9 +1047,8 @@ class ClassImagerDeconv():
                 predict *= -1   # model was subtracted from (zero) data, so need to invert sign
             # run job in I/O thread
 
+            # (write starts when the next chunk is collected, and overlaps with its degridding)
             self.VS.startVisPutColumnInBackground(DATA, "data", self.GD["Predict"]["ColName"], likecol=self.GD["Data"]["ColName"])
-            # and wait for it to finish (we don't want DATA destroyed, which collectLoadedChunk() above will)
-            self.VS.collectPutColumnResults()
 
 
 
@@ -1224,7 +1229,7 @@ class ClassImagerDeconv():
 
             # in the meantime, tell the I/O thread to go reload the first data chunk
             self.VS.ReInitChunkCount()
-            self.VS.startChunkLoadInBackground(last_cycle=predict_colname)
+            self.VS.startChunkLoadInBackground(last_cycle=predict_colname, prefetch=not predict_colname)
 
             # determine whether data still needs to be sparsified
             # last major cycle is always done at full precision, but also if the sparsification_list ends we go to full precision
@@ -1277,7 +1282,8 @@ class ClassImagerDeconv():
                     self.FacetMachinePSF.collectGriddingResults()
                 self.VS.collectPutColumnResults()  # if these were going on
                 # get loaded chunk from I/O thread, schedule next chunk
-                # note that if we're writing predict data out, DON'T schedule until we're done writing this one
+                # note that if we're writing predict data out, DON'T schedule until we're done writing this one,
+                # and don't read ahead more than one chunk (the next load is queued behind the write on I/O queue 0)
                 DATA = self.VS.collectLoadedChunk(start_next=not predict_colname)
                 if type(DATA) is str:
                     print(ModColor.Str("no more data: %s"%DATA, col="red"), file=log)
@@ -1290,7 +1296,7 @@ class ClassImagerDeconv():
                         predict[...] = 0.0
                         # schedule jobs for saving visibilities, then start reading next chunk (both are on io queue)
                         self.VS.startVisPutColumnInBackground(DATA, "predict", predict_colname, likecol=self.GD["Data"]["ColName"])
-                        self.VS.startChunkLoadInBackground(last_cycle=predict_colname)
+                        self.VS.startChunkLoadInBackground(last_cycle=predict_colname, prefetch=not predict_colname)
                     continue # next chunk
 
                 visdata = DATA["data"]
@@ -1341,7 +1347,7 @@ class ClassImagerDeconv():
                     predict -= visdata
                     # schedule jobs for saving visibilities, then start reading next chunk (both are on io queue)
                     self.VS.startVisPutColumnInBackground(DATA, "predict", predict_colname, likecol=self.GD["Data"]["ColName"])
-                    self.VS.startChunkLoadInBackground(last_cycle=predict_colname)
+                    self.VS.startChunkLoadInBackground(last_cycle=predict_colname, prefetch=not predict_colname)
 
                 # Stacks average beam if not computed
                 self.FacetMachine.StackAverageBeam(DATA)
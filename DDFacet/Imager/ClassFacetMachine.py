@@ -45,6 +45,7 @@ from DDFacet.ToolsDir.ModToolBox import EstimateNpix
 from DDFacet.ToolsDir.GiveEdges import GiveEdges
 from DDFacet.Imager.ClassImToGrid import ClassImToGrid
 from DDFacet.Data.ClassStokes import ClassStokes
+from DDFacet.Data import ClassSmearMapping
 log=logger.getLogger("ClassFacetMachine")
 from DDFacet.Other.AsyncProcessPool import APP
 import numexpr
@@ -1429,14 +1430,14 @@ class ClassFacetMachine():
             DATA["Sparsification"] = np.array([])
         else:
             # randomly select blocks with 1/sparsification probability
-            num_blocks = DATA["BDA.Grid"][0]
+            num_blocks = ClassSmearMapping.NumBlocks(DATA["BDA.Grid"])
             DATA["Sparsification.Grid"] = np.random.sample(num_blocks) < 1.0 / factor
             print("applying sparsification factor of %f to %d BDA grid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Grid"].sum()), file=log)
             #num_blocks = DATA["BDADegrid"][0]
             #DATA["Sparsification.Degrid"] = np.random.sample(num_blocks) < 1.0 / factor
             #print>> log, "applying sparsification factor of %f to %d BDA degrid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Degrid"].sum())
 
-    def _grid_worker(self, iFacet, DATA, cf_dict, griddict):
+    def _grid_worker(self, iFacet, DATA, cf_dict, griddict, nthreads=1):
         T = ClassTimeIt.ClassTimeIt()
         T.disable()
 
@@ -1493,14 +1494,17 @@ class ClassFacetMachine():
         if Apply_Beam:
             DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
 
-        GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
-                        DoNormWeights=False,
-                        DicoJonesMatrices=DicoJonesMatrices,
-                        freqs=freqs, DoPSF=self.DoPSF,
-                        ChanMapping=ChanMapping,
-                        ResidueGrid=griddict[iFacet],
-                        sparsification=DATA.get("Sparsification.Grid")
-                        )
+        with APP.workerThreads(nthreads):
+            GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
+                            DoNormWeights=False,
+                            DicoJonesMatrices=DicoJonesMatrices,
+                            freqs=freqs, DoPSF=self.DoPSF,
+                            ChanMapping=ChanMapping,
+                            ResidueGrid=griddict[iFacet],
+                            sparsification=DATA.get("Sparsification.Grid"),
+                            rowflags=DATA["rowflags"],
+                            nthreads=nthreads
+                            )
         T.timeit("put %s" % iFacet)
 
         T.timeit("Grid")
@@ -1526,10 +1530,12 @@ class ClassFacetMachine():
         self._grid_iMS, self._grid_iChunk = DATA["iMS"], DATA["iChunk"]
         self._grid_job_label = DATA["label"]
         self._grid_job_id = "%s.Grid.%s:" % (self._app_id, self._grid_job_label)
+        # thread budget of each facet job: with fewer facets than cores, the spare cores help grid the facets
+        nthreads = self.GD["Parallel"]["GridThreads"] or max(1, APP.ncpu // max(len(self.DicoImager), 1))
         for iFacet in self.DicoImager.keys():
             APP.runJob("%sF%d" % (self._grid_job_id, iFacet), self._grid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  self._facet_grids.readonly()))
+                                  self._facet_grids.readonly(), nthreads))
 
     # ##############################################
     # ##### Smooth beam ############################
@@ -1796,7 +1802,7 @@ class ClassFacetMachine():
     # #####################################################"
 
     # DeGrid worker that is called by Multiprocessing.Process
-    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict):
+    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict, nslices=0):
         ModelGrid = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel)
 
         # Create a new GridMachine
@@ -1844,7 +1850,9 @@ class ClassFacetMachine():
                           DicoJonesMatrices=DicoJonesMatrices,
                           freqs=freqs, TranformModelInput="FT",
                           ChanMapping=ChanMapping,
-                          sparsification=DATA.get("Sparsification.Degrid")
+                          sparsification=DATA.get("Sparsification.Degrid"),
+                          rowflags=DATA["rowflags"],
+                          nslices=nslices
                         )
 
         return {"iFacet": iFacet}
@@ -1877,10 +1885,13 @@ class ClassFacetMachine():
         self._degrid_job_label = DATA["label"]
         self._degrid_job_id = "%s.Degrid.%s:" % (self._app_id, self._degrid_job_label)
 
+        # facets subtract from the visibilities one row slice at a time; with a few slices per core,
+        # concurrent facets mostly find a free slice rather than contending for rows
+        nslices = self.GD["Parallel"]["DegridRowSlices"] or 4 * APP.ncpu
         for iFacet in self.DicoImager.keys():
             APP.runJob("%sF%d" % (self._degrid_job_id, iFacet), self._degrid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  ChanSel, self._model_dict.readonly()))#,serial=True)
+                                  ChanSel, self._model_dict.readonly(), max(nslices, 0)))#,serial=True)
         #APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
 
 
@@ -42,6 +42,7 @@ import glob
 import re
 import numexpr
 import time
+from contextlib import contextmanager
 
 from DDFacet.Other import logger
 from DDFacet.Other import ClassTimeIt
@@ -161,6 +162,7 @@ class AsyncProcessPool (object):
     """
     def __init__ (self):
         self._started = False
+        self.num_io_processes = 1
         # init these here so that jobs can be registered
         self._job_handlers = {}
         self._events = {}
@@ -179,7 +181,8 @@ class AsyncProcessPool (object):
             ncpu:
             affinity:
             parent_affinity:
-            num_io_processes:
+            num_io_processes: number of I/O worker processes (and queues). Jobs are placed on a given I/O queue
+                via runJob(io=N).
             verbose:
 
         Returns:
@@ -310,7 +313,8 @@ class AsyncProcessPool (object):
         self._compute_workers = []
         self._io_workers = []
         self._compute_queue   = multiprocessing.Queue()
-        self._io_queues       = [ multiprocessing.Queue() for x in range(num_io_processes) ]
+        self.num_io_processes = max(num_io_processes, 1)
+        self._io_queues       = [ multiprocessing.Queue() for x in range(self.num_io_processes) ]
         self._result_queue    = multiprocessing.Queue()
         self._termination_event = multiprocessing.Event()
         # this event is set when all workers have been started, an cleared when a restart is requested
@@ -603,7 +607,7 @@ class AsyncProcessPool (object):
             if io is None:
                 self._compute_queue.put(jobitem)
             else:
-                io = max(len(self._io_queues)-1, io)
+                io = min(len(self._io_queues)-1, io)
                 self._io_queues[io].put(jobitem)
         # serial mode: process job in this process, and raise any exceptions up
         else:
@@ -802,6 +806,34 @@ class AsyncProcessPool (object):
         if self.verbose > 1:
             print("shutdown complete", file=log)
 
+    @contextmanager
+    def workerThreads(self, nthreads):
+        """
+        Context manager for use in jobs: lets threaded (OpenMP) code inside the block use nthreads threads.
+        Compute workers are pinned to a single core (see --Parallel-Affinity), so for nthreads>1 the worker's
+        affinity is widened to all worker cores for the duration of the block.
+        """
+        affinity = getattr(self, "_worker_affinity", None)
+        widen = nthreads > 1 and affinity
+        if widen:
+            psutil.Process().cpu_affinity(list(self._cores))
+        try:
+            yield
+        finally:
+            if widen:
+                psutil.Process().cpu_affinity(affinity)
+
+    def ioProcessIndex(self):
+        """
+        Returns the number of the I/O queue served by the calling process if it is an I/O worker (see
+        runJob(io=N)), or 0 otherwise. Useful for picking per-I/O-process job counters, since jobs submitted
+        from concurrent I/O workers should not share a counter.
+        """
+        proc_id = self.proc_id or ""
+        if not proc_id.startswith("io"):
+            return 0
+        return min(int(proc_id[2:]), self.num_io_processes-1)
+
     @staticmethod
     def _start_worker (object, proc_id, affinity, worker_queue, pause_on_start=False):
         """
@@ -824,6 +856,7 @@ class AsyncProcessPool (object):
         _pyArrays.pySetOMPDynamicNumThreads(1)
         AsyncProcessPool.proc_id = proc_id
         logger.subprocess_id = proc_id
+        object._worker_affinity = affinity
         if affinity:
             psutil.Process().cpu_affinity(affinity)
         object._run_worker(worker_queue)
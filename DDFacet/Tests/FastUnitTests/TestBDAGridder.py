@@ -0,0 +1,120 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import six
+from DDFacet.Data import ClassSmearMapping
+if six.PY3:
+    from DDFacet.cbuild.Gridder import _pyGridderSmearPols3x as _pyGridderSmear
+else:
+    from DDFacet.cbuild.Gridder import _pyGridderSmearPols27 as _pyGridderSmear
+
+
+def _makeSortedChunk(na=12, nt=60, nchan=16):
+    # rows in baseline-time order (as with --Data-Sort)
+    A0, A1 = np.triu_indices(na)
+    T = np.repeat(np.arange(nt, dtype=float), len(A0))
+    A0, A1 = np.tile(A0, nt), np.tile(A1, nt)
+    pos = np.random.RandomState(1).normal(size=(na, 3)) * 300
+    bl = pos[A1] - pos[A0]
+    uvw = bl * np.cos(T * .002)[:, np.newaxis] + bl[:, [1, 0, 2]] * np.sin(T * .002)[:, np.newaxis]
+    perm = np.lexsort((T, A1, A0))
+    A0, A1, uvw = A0[perm], A1[perm], uvw[perm]
+    change = np.where((A0[1:] != A0[:-1]) | (A1[1:] != A1[:-1]))[0] + 1
+    i0 = np.concatenate(([0], change))
+    i1 = np.append(i0[1:], len(A0))
+    freqs = np.linspace(1e8, 1.5e8, nchan)
+    return dict(A0=A0, A1=A1, uvw=uvw, freqs=freqs, dfreqs=freqs[1] - freqs[0],
+                BaselineRanges=np.stack((A0[i0], A1[i0], i0, i1), axis=1), BaselineRows=None)
+
+def _makeGridderInputs():
+    # a sorted chunk with its row-list and run-length mappings, and random visibilities and convolution function
+    DATA = _makeSortedChunk()
+    nrow, nchan = len(DATA["A0"]), DATA["freqs"].size
+    chan_mapping = np.int32(np.repeat(np.arange(4), nchan // 4))
+    args = ClassSmearMapping.GiveTimeBlocksBaselines(DATA, 0, len(DATA["BaselineRanges"]), np.sqrt(6 * .02), .02) + \
+           (nchan, chan_mapping)
+    sizes, rows = ClassSmearMapping.GiveChannelBlocks(*args)
+    blocks = ClassSmearMapping.GiveRunLengthBlocks(*args)
+    rowlist = np.concatenate(([len(sizes), 0], sizes, rows)).astype(np.int32)
+    runlength = np.concatenate(([ClassSmearMapping.RunLengthTag, 0, len(blocks), 0], blocks.ravel())).astype(np.int32)
+
+    rs = np.random.RandomState(2)
+    vis = (rs.normal(size=(nrow, nchan, 4)) + 1j * rs.normal(size=(nrow, nchan, 4))).astype(np.complex64)
+    weights = rs.uniform(size=(nrow, nchan)).astype(np.float32)
+    flags = np.zeros((nrow, (nchan + 7) // 8), np.uint8)
+    rowflags = np.zeros(nrow, np.uint8)
+    OverS, support = 11, 7
+    cf = rs.normal(size=(support * OverS, support * OverS)).astype(np.complex64)
+    umax = np.abs(DATA["uvw"][:, :2]).max() * DATA["freqs"].max() / 3e8
+    incr = np.array([.4 / umax] * 2)
+    return dict(DATA=DATA, chan_mapping=chan_mapping, rowlist=rowlist, runlength=runlength, vis=vis,
+                weights=weights, flags=flags, rowflags=rowflags, OverS=OverS, cf=cf, incr=incr)
+
+def _grid(G, mapping, nthreads, npix=256):
+    grid = np.zeros((4, 1, npix, npix), np.complex64)
+    sumwt = np.zeros((4, 1), np.float64)
+    _pyGridderSmear.pyGridderWPol(grid, G["vis"], G["DATA"]["uvw"], G["flags"], G["rowflags"], G["weights"], sumwt,
+                                  False, [G["cf"]], [G["cf"].conj()],
+                                  np.array([2.4, 1e9, 1, G["OverS"]], np.float64), G["incr"],
+                                  G["DATA"]["freqs"], [np.array([0, 5, 5, 0], np.int32),
+                                                       np.array([0., 0., .01, .02, 0], np.float64)],
+                                  [], mapping, np.array([], bool), [0, True, 0, 0], [], G["chan_mapping"],
+                                  np.array([9, 10, 11, 12], np.uint16), np.array([1], np.uint16), nthreads)
+    return grid, sumwt
+
+def testGridderThreads():
+    # row-list and run-length mappings, and any number of threads, all give exactly the same grid
+    G = _makeGridderInputs()
+    grid0, sumwt0 = _grid(G, G["rowlist"], 1)
+    assert (grid0 != 0).any()
+    for mapping, nthreads in (G["runlength"], 1), (G["rowlist"], 3), (G["runlength"], 4):
+        grid1, sumwt1 = _grid(G, mapping, nthreads)
+        assert (grid1 == grid0).all()
+        assert (sumwt1 == sumwt0).all()
+
+def testDegridderRowSlices():
+    # locking rows by slice rather than by row group leaves the subtracted visibilities unchanged
+    G = _makeGridderInputs()
+    grid, _ = _grid(G, G["rowlist"], 1)
+
+    def degrid(mapping, nslices, facet):
+        vis = G["vis"].copy()
+        _pyGridderSmear.pyDeGridderWPol(grid, vis, G["DATA"]["uvw"], G["flags"], G["rowflags"], np.zeros((4, 1)),
+                                        False, [G["cf"]], [G["cf"].conj()],
+                                        np.array([2.4, 1e9, 1, G["OverS"]], np.float64), G["incr"],
+                                        G["DATA"]["freqs"], [np.array([0, 5, 5, 0], np.int32),
+                                                             np.array([0., 0., .01, .02, facet], np.float64), None],
+                                        [], mapping, np.array([], bool), [0, True, 0, 0], [], G["chan_mapping"],
+                                        np.array([9, 10, 11, 12], np.uint16), np.array([1], np.uint16), nslices)
+        return vis
+
+    _pyGridderSmear.pySetSemaphores(["/TestBDAGridder.sem%d" % i for i in range(8)])
+    try:
+        vis0 = degrid(G["rowlist"], 0, 0)
+        assert (vis0 != G["vis"]).any()
+        for mapping, nslices, facet in (G["runlength"], 0, 0), (G["runlength"], 1, 0), \
+                                       (G["runlength"], 5, 3), (G["runlength"], 100, 7), (G["rowlist"], 5, 1):
+            assert (degrid(mapping, nslices, facet) == vis0).all()
+    finally:
+        _pyGridderSmear.pyDeleteSemaphore()
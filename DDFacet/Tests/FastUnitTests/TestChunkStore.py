@@ -0,0 +1,62 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import shutil
+import tempfile
+import numpy as np
+from DDFacet.Other.CacheManager import CacheManager
+from DDFacet.Data.ClassChunkStore import ClassChunkStore
+from nose.tools import *
+
+
+def testChunkStoreRoundTrip():
+    cachedir = tempfile.mkdtemp()
+    try:
+        chunks = [[0, 10], [10, 25]]
+        store = ClassChunkStore(CacheManager(cachedir), "VisData.store", chunks, 4, 2)
+        chunk_cache = CacheManager(cachedir + "/R10:25")
+        path, valid = store.checkCache(chunk_cache, "VisStore.meta", dict(key=1))
+        assert not valid
+        A0 = np.arange(15, dtype=np.int32)
+        data = (np.random.rand(15, 4, 2) + 1j).astype(np.complex64)
+        store.save(path, 10, 25, dict(A0=A0, data=data, sort_index=None))
+        chunk_cache.saveCache("VisStore.meta")
+
+        # re-open store: layout is unchanged, so item remains valid
+        store = ClassChunkStore(CacheManager(cachedir), "VisData.store", chunks, 4, 2)
+        path, valid = store.checkCache(CacheManager(cachedir + "/R10:25"), "VisStore.meta", dict(key=1))
+        assert valid
+        assert (store.load(path, "A0") == A0).all()
+        assert store.load(path, "sort_index") is None
+        out = np.zeros_like(data)
+        store.load(path, "data", out=out)
+        assert (out == data).all()
+
+        # re-open store with a different layout: store is re-made, so item descriptor is stale
+        store = ClassChunkStore(CacheManager(cachedir), "VisData.store", chunks, 8, 2)
+        path, valid = store.checkCache(CacheManager(cachedir + "/R10:25"), "VisStore.meta", dict(key=1))
+        assert not valid
+    finally:
+        shutil.rmtree(cachedir)
@@ -0,0 +1,65 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import numpy as np
+from DDFacet.Array import PackedFlags
+from nose.tools import *
+
+
+def testPackUnpack():
+    flags = np.random.rand(100, 13) < .3
+    flags[1, :] = True
+    flags[2, :] = False
+    packed, rowflags = PackedFlags.pack(np.repeat(flags[:, :, np.newaxis], 4, axis=2))
+    assert packed.shape == PackedFlags.packedShape(100, 13)
+    assert rowflags[1] == PackedFlags.ROW_FLAGGED
+    assert rowflags[2] == PackedFlags.ROW_UNFLAGGED
+    assert (PackedFlags.unpack(packed, 13) == flags).all()
+    assert (PackedFlags.unpack(packed, 13, 4)[:, :, 3] == flags).all()
+    assert (PackedFlags.rowSummary(packed, 13) == rowflags).all()
+    rows = PackedFlags.flaggedRows(rowflags)
+    assert (PackedFlags.unpack(packed, 13, rows=rows) == flags[rows]).all()
+
+def testBitOrder():
+    # the C++ gridder expects channel c in bit 7-(c%8) of byte c//8
+    flags = np.zeros((1, 10), bool)
+    flags[0, 9] = True
+    packed, _ = PackedFlags.pack(flags)
+    assert packed[0, 1] == 1 << 6
+
+def testPackIntoRows():
+    # packing blocks of rows into scattered positions gives the same result as packing in one go
+    flags = np.random.rand(50, 11, 2) < .5
+    flags[7] = True
+    perm = np.random.permutation(50)
+    packed0, rowflags0 = PackedFlags.pack(flags[perm])
+    inverse = np.empty_like(perm)
+    inverse[perm] = np.arange(50)
+    packed = np.zeros_like(packed0)
+    rowflags = np.zeros_like(rowflags0)
+    for i0 in range(0, 50, 16):
+        PackedFlags.packInto(flags[i0:i0+16], packed, rowflags, rows=inverse[i0:i0+16])
+    assert (packed == packed0).all()
+    assert (rowflags == rowflags0).all()
@@ -0,0 +1,91 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+import numpy as np
+from DDFacet.Data import ClassSmearMapping
+from nose.tools import *
+
+
+def _makeChunk(na=6, nt=40, scale=30.):
+    # rows in time-baseline order, as in an MS, with a sort index into baseline-time order
+    A0, A1 = np.triu_indices(na)
+    T = np.repeat(np.arange(nt, dtype=float), len(A0))
+    A0, A1 = np.tile(A0, nt), np.tile(A1, nt)
+    pos = np.random.RandomState(1).normal(size=(na, 3)) * scale
+    bl = pos[A1] - pos[A0]
+    uvw = bl * np.cos(T * .05)[:, np.newaxis] + bl[:, [1, 0, 2]] * np.sin(T * .05)[:, np.newaxis]
+    perm = np.lexsort((T, A1, A0))
+    a0, a1 = A0[perm], A1[perm]
+    change = np.where((a0[1:] != a0[:-1]) | (a1[1:] != a1[:-1]))[0] + 1
+    i0 = np.concatenate(([0], change))
+    i1 = np.append(i0[1:], len(a0))
+    freqs = np.linspace(1e8, 1.5e8, 16)
+    return dict(A0=A0, A1=A1, uvw=uvw, freqs=freqs, dfreqs=freqs[1] - freqs[0],
+                BaselineRanges=np.stack((a0[i0], a1[i0], i0, i1), axis=1), BaselineRows=perm)
+
+def testVectorisedMapping():
+    # whole-chunk mapping gives the same blocks, in baseline order, as the per-baseline mapping
+    DATA = _makeChunk()
+    chan_mapping = np.repeat(np.arange(4), 4)
+    for dPhi, l in (np.sqrt(6 * (1 - .98)), .05), (.1, .02), (0., .05):
+        sizes0, rows0 = [], []
+        for a0, a1, i0, i1 in DATA["BaselineRanges"]:
+            if a0 != a1:
+                rows, sizes, _ = ClassSmearMapping.GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, chan_mapping,
+                                                                        row_index=DATA["BaselineRows"][i0:i1])
+                sizes0 += sizes
+                rows0 += rows
+        nbl = len(DATA["BaselineRanges"])
+        sizes, rows = ClassSmearMapping.GiveBlocksRowsListBaselines(DATA, 0, nbl, dPhi, l, chan_mapping)
+        assert (sizes == sizes0).all()
+        assert (rows == rows0).all()
+        # splitting into baseline ranges doesn't change the result
+        sizes1, rows1 = ClassSmearMapping.GiveBlocksRowsListBaselines(DATA, 0, 5, dPhi, l, chan_mapping)
+        sizes2, rows2 = ClassSmearMapping.GiveBlocksRowsListBaselines(DATA, 5, nbl, dPhi, l, chan_mapping)
+        assert (np.concatenate((sizes1, sizes2)) == sizes).all()
+        assert (np.concatenate((rows1, rows2)) == rows).all()
+
+def testRunLengthMapping():
+    # on baseline-sorted data, run-length blocks describe the same rows and channels as the row-list blocks
+    DATA = _makeChunk()
+    perm = DATA["BaselineRows"]
+    for key in "A0", "A1", "uvw":
+        DATA[key] = DATA[key][perm]
+    DATA["BaselineRows"] = None
+    chan_mapping = np.repeat(np.arange(4), 4)
+    nbl = len(DATA["BaselineRanges"])
+    for dPhi, l in (np.sqrt(6 * (1 - .98)), .05), (.1, .02):
+        args = ClassSmearMapping.GiveTimeBlocksBaselines(DATA, 0, nbl, dPhi, l) + (16, chan_mapping)
+        sizes, rows = ClassSmearMapping.GiveChannelBlocks(*args)
+        blocks = ClassSmearMapping.GiveRunLengthBlocks(*args)
+        assert_equal(len(blocks), len(sizes))
+        assert (blocks[:, 1] == sizes - 2).all()
+        offsets = np.cumsum(sizes) - sizes
+        for offset, (row0, nrows, ch0, ch1) in zip(offsets, blocks):
+            assert_equal((rows[offset], rows[offset + 1]), (ch0, ch1))
+            assert (rows[offset + 2:offset + 2 + nrows] == np.arange(row0, row0 + nrows)).all()
+        # unsorted rows are not contiguous
+        rows, block_len, fracmin = args[:3]
+        assert ClassSmearMapping.GiveRunLengthBlocks(perm[rows], block_len, fracmin, 16, chan_mapping) is None